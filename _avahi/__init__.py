@@ -66,47 +66,36 @@ DBUS_INTERFACE_HOST_NAME_RESOLVER = DBUS_NAME + ".HostNameResolver"
 DBUS_INTERFACE_SERVICE_RESOLVER = DBUS_NAME + ".ServiceResolver"
 DBUS_INTERFACE_RECORD_BROWSER = DBUS_NAME + ".RecordBrowser"
 
-def byte_array_to_string(s):
-    r = ""
-    
-    for c in s:
-        
-        if c >= 32 and c < 127:
-            r += "%c" % c
-        else:
-            r += "."
+# Non-printable bytes show up as "."
+_PRINTABLE = bytes(bytearray(c if c >= 32 and c < 127 else ord(".") for c in range(256)))
 
-    return r
+# Encoded strings, since the same TXT data tends to be published over and over
+_BYTE_ARRAY_CACHE_SIZE = 4096
+_byte_arrays = {}
+
+def byte_array_to_string(s):
+    return bytes(bytearray(s)).translate(_PRINTABLE).decode("ascii")
 
 def txt_array_to_string_array(t):
-    l = []
+    return [byte_array_to_string(s) for s in t]
 
-    for s in t:
-        l.append(byte_array_to_string(s))
 
-    return l
+def string_to_byte_array(s):
+    if isinstance(s, bytes):
+        return dbus.ByteArray(s)
 
+    r = _byte_arrays.get(s)
 
-def string_to_byte_array(s):
-    r = []
+    if r is None:
+        if len(_byte_arrays) >= _BYTE_ARRAY_CACHE_SIZE:
+            _byte_arrays.clear()
 
-    for c in s:
-        r.append(dbus.Byte(ord(c)))
+        r = _byte_arrays[s] = dbus.ByteArray(s.encode("utf-8"))
 
     return r
 
 def string_array_to_txt_array(t):
-    l = []
-
-    for s in t:
-        l.append(string_to_byte_array(s))
-
-    return l
+    return [string_to_byte_array(s) for s in t]
 
 def dict_to_txt_array(txt_dict):
-    l = []
-
-    for k,v in txt_dict.items():
-        l.append(string_to_byte_array("%s=%s" % (k,v)))
-
-    return l
+    return [string_to_byte_array("%s=%s" % (k,v)) for k,v in txt_dict.items()]
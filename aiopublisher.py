@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# aiopublisher.py - Avahi/mDNS name publisher for asyncio applications.
+#
+
+
+import asyncio
+import logging
+import threading
+import time
+
+import dbus
+
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+from dnsrecords import GroupFill
+from mpublisher import (BasePublisher, NetworkView, avahi, AVAHI_DNS_CLASS_IN, MAX_ENTRIES_PER_GROUP,
+                        DEFAULT_RESOLVE_TIMEOUT, MAX_CONCURRENT_LOOKUPS, NO_ANSWER_ERRORS, DBUS_CALLS, DBUS_ERRORS,
+                        DBUS_LATENCY)
+
+
+# Nothing is introspected (that would be a blocking call), so method signatures must be explicit...
+SIGNATURE_ADD_RECORD = "iiussqquay"
+SIGNATURE_RESOLVE_HOST_NAME = "iisiu"
+
+
+def _settle(future, result, error):
+    """Complete "future", unless its caller gave up on it already."""
+
+    if future.done():
+        return
+
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class _BusThread(object):
+    """A system bus connection, serviced by a GLib main loop running in a background thread.
+
+    Every D-Bus call is issued from that thread with a reply handler, and completes an asyncio
+    future when the reply arrives. Any number of calls can be in flight at the same time.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """Return the shared connection, creating it on first use (this blocks, briefly)."""
+
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+
+            return cls._instance
+
+
+    def __init__(self):
+        self.bus = dbus.SystemBus(private=True, mainloop=DBusGMainLoop())
+
+        self._thread = threading.Thread(target=GLib.MainLoop().run, name="dbus", daemon=True)
+        self._thread.start()
+
+
+    def call(self, path, interface, method, signature="", args=(), timeout=None):
+        """Call "method" on an Avahi object, returning a future for its result."""
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        start = time.perf_counter()
+
+        DBUS_CALLS.labels(method).inc()
+
+        def reply(*result):
+            DBUS_LATENCY.labels(method).observe(time.perf_counter() - start)
+
+            result = result[0] if len(result) == 1 else (result or None)
+            loop.call_soon_threadsafe(_settle, future, result, None)
+
+        def error(e):
+            DBUS_LATENCY.labels(method).observe(time.perf_counter() - start)
+            DBUS_ERRORS.labels(method).inc()
+
+            loop.call_soon_threadsafe(_settle, future, None, e)
+
+        def issue():
+            try:
+                self.bus.call_async(avahi.DBUS_NAME, path, interface, method, signature, args,
+                                    reply, error, timeout=-1.0 if timeout is None else timeout)
+            except dbus.exceptions.DBusException as e:
+                error(e)
+
+            return False  # ...just once.
+
+        GLib.idle_add(issue)
+        return future
+
+
+class _EntryGroup(object):
+    """An Avahi entry group, reached through the shared connection."""
+
+    def __init__(self, conn, object_path):
+        self.object_path = object_path
+        self._conn = conn
+
+
+    def call(self, method, signature="", args=()):
+        return self._conn.call(self.object_path, avahi.DBUS_INTERFACE_ENTRY_GROUP, method, signature, args)
+
+
+class AsyncAvahiPublisher(BasePublisher):
+    """Publish mDNS records to Avahi from asyncio code, without ever blocking the event loop.
+
+    All instances share a single D-Bus connection, so concurrent operations (from different tasks,
+    or from the same "publish_many()" call) are multiplexed over it instead of waiting in line.
+    """
+
+    errors = (dbus.exceptions.DBusException,)
+
+    def __init__(self, record_ttl=60, group_size=MAX_ENTRIES_PER_GROUP,
+                 resolve_timeout=DEFAULT_RESOLVE_TIMEOUT, max_lookups=MAX_CONCURRENT_LOOKUPS, probe=False):
+        """Initialize the publisher, which must still be connected (see "create()")."""
+
+        super().__init__(record_ttl, group_size)
+
+        self.resolve_timeout = resolve_timeout
+        self.max_lookups = max_lookups
+        self.probe = probe  # ...see "AvahiPublisher".
+        self.view = NetworkView()
+        self._conn = None
+
+
+    @classmethod
+    async def create(cls, *args, **kwargs):
+        """Create a publisher and connect it to Avahi."""
+
+        publisher = cls(*args, **kwargs)
+        await publisher.connect()
+
+        return publisher
+
+
+    async def connect(self):
+        """Connect to Avahi and find out the local host name."""
+
+        loop = asyncio.get_event_loop()
+        self._conn = await loop.run_in_executor(None, _BusThread.get)
+        self.hostname = await self._server_call("GetHostNameFqdn")
+
+        logging.debug("Avahi mDNS publisher for: %s", self.hostname)
+
+
+    def _server_call(self, method, signature="", args=(), timeout=None):
+        return self._conn.call(avahi.DBUS_PATH_SERVER, avahi.DBUS_INTERFACE_SERVER, method, signature, args, timeout)
+
+
+    async def reset(self):
+        """Remove all published records from mDNS."""
+
+        results = await asyncio.gather(*(group.call("Reset") for group in self._unique_groups()),
+                                       return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, dbus.exceptions.DBusException):
+                if result.get_dbus_name() != "org.freedesktop.DBus.Error.ServiceUnknown":
+                    raise result
+
+        self.forget()
+
+
+    async def resolve(self, name, timeout=None):
+        """Lookup the current owner for "name", from the network view if it's known, using mDNS otherwise."""
+
+        known, owner = self.view.lookup(name)
+
+        if known:
+            return owner
+
+        timeout = self.resolve_timeout if timeout is None else timeout
+        args = (avahi.IF_UNSPEC, avahi.PROTO_UNSPEC, name, avahi.PROTO_UNSPEC, dbus.UInt32(0))
+
+        try:
+            response = await self._server_call("ResolveHostName", SIGNATURE_RESOLVE_HOST_NAME, args, timeout)
+            owner = self.hostname if response[5] & avahi.LOOKUP_RESULT_OUR_OWN else response[2]
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() not in NO_ANSWER_ERRORS:
+                return None
+
+            owner = None
+
+        self.view.update(name, owner)
+        return owner
+
+
+    async def resolve_many(self, names, timeout=None):
+        """Lookup the current owners for all "names" concurrently, returning a "name -> owner" mapping."""
+
+        names = list(names)
+        semaphore = asyncio.Semaphore(self.max_lookups)
+
+        async def lookup(name):
+            async with semaphore:
+                return await self.resolve(name, timeout)
+
+        owners = await asyncio.gather(*(lookup(name) for name in names))
+        return dict(zip(names, owners))
+
+
+    async def check_many(self, names, timeout=None):
+        """Return those "names" which are free to be published by this host (checked concurrently)."""
+
+        owners = await self.resolve_many(names, timeout)
+        return [name for name in owners if self._check(name, owners[name])]
+
+
+    async def _new_group(self):
+        """Create a new (empty) entry group."""
+
+        return _EntryGroup(self._conn, await self._server_call("EntryGroupNew"))
+
+
+    def _add_record(self, group, record, flags=0):
+        """Add a single record to an entry group, returning a future for the reply."""
+
+        ttl = self.record_ttl if record.ttl is None else record.ttl
+        flags |= avahi.PUBLISH_UNIQUE if self.probe else 0
+
+        args = (record.interface, record.protocol, dbus.UInt32(flags), record.name, AVAHI_DNS_CLASS_IN,
+                record.type, dbus.UInt32(ttl), record.rdata)
+
+        return group.call("AddRecord", SIGNATURE_ADD_RECORD, args)
+
+
+    async def _fill_group(self, group, batch):
+        """Add the records for all (name, records) in "batch" to an entry group, returning the names that failed."""
+
+        fill = GroupFill(batch)
+
+        while True:
+            # All records are sent at once, the replies are only looked at afterwards...
+            pending = [(name, [self._add_record(group, record) for record in records])
+                       for name, records in fill.batch]
+
+            failed = []
+            partial = False
+
+            for name, futures in pending:
+                results = await asyncio.gather(*futures, return_exceptions=True)
+                errors = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+
+                if errors:
+                    logging.error("Unable to add record for '%s': %s", name, results[errors[0]])
+                    failed.append(name)
+                    partial = partial or len(errors) < len(results)
+
+            if not fill.settle(failed, partial):
+                return fill.failed
+
+            # Some name left part of its records behind, and groups can't drop single entries...
+            await group.call("Reset")
+
+
+    async def _publish_batch(self, batch, entries):
+        """Publish a single batch of names in a new entry group, returning the names that made it."""
+
+        group = await self._new_group()
+        failed = await self._fill_group(group, batch)
+        names = set(name for name, _ in batch if name not in failed)
+
+        try:
+            if not names:
+                await group.call("Free")
+                return names
+
+            await group.call("Commit")
+        except dbus.exceptions.DBusException as e:
+            logging.error("Unable to commit records for %d names: %s", len(names), e.get_dbus_name())
+            await group.call("Free")
+            return set()
+
+        self._track(group, names, entries)
+        return names
+
+
+    async def publish_many(self, records, force=False):
+        """Publish many records at once, returning a "name -> success" mapping."""
+
+        entries = self._entries(records)
+        results = dict((name, False) for name in entries)
+
+        if not force:
+            logging.info("Checking for availability of %d names...", len(entries))
+
+            entries = dict((name, entries[name]) for name in await self.check_many(entries))
+
+        batches = list(self._batches((name, entries[name]) for name in results if name in entries))
+        logging.info("Adding records for %d names in %d groups", len(entries), len(batches))
+
+        for names in await asyncio.gather(*(self._publish_batch(batch, entries) for batch in batches)):
+            results.update((name, True) for name in names)
+
+        return results
+
+
+    async def publish_cname(self, cname, force=False):
+        """Publish a CNAME record."""
+
+        return (await self.publish_many([self.cname_record(cname)], force))[cname]
+
+
+    async def publish_address(self, cname, address, force=False):
+        """Publish an address (A/AAAA) record."""
+
+        logging.info("Adding name %s to address %s", cname, address)
+        return (await self.publish_many([self.address_record(cname, address)], force))[cname]
+
+
+    async def _rebuild(self, group):
+        """Replace "group" with a new one, holding the current records of all names in it (see "AvahiPublisher")."""
+
+        members = self._members.pop(group.object_path)
+
+        if not members:
+            await group.call("Free")
+            return
+
+        # Committing a new group before freeing the old one keeps the other names resolving throughout,
+        # but Avahi won't have the same unique record in two groups...
+        if self.probe:
+            replacement = group
+            await group.call("Reset")
+        else:
+            replacement = await self._new_group()
+
+        failed = await self._fill_group(replacement, [(member, self._records[member]) for member in members])
+
+        for member in failed:
+            members.discard(member)
+            del self.published[member]
+            del self._records[member]
+
+        if members:
+            await replacement.call("Commit")
+            self._track(replacement, members, self._records)
+        else:
+            await replacement.call("Free")
+
+        if replacement is not group:
+            await group.call("Free")
+
+
+    async def unpublish(self, name):
+        """Remove a published record from mDNS."""
+
+        await self.unpublish_many([name])
+
+
+    async def unpublish_many(self, names):
+        """Remove the records for many names from mDNS, rebuilding each affected group only once (concurrently)."""
+
+        groups = {}
+
+        for name in names:
+            group = self.published.pop(name)
+            del self._records[name]
+
+            self._members[group.object_path].discard(name)
+            groups[group.object_path] = group
+
+        await asyncio.gather(*(self._rebuild(group) for group in groups.values()))
+
+
+    async def reconcile(self, records, force=False):
+        """Make the published records match "records", changing only what differs (see "AvahiPublisher")."""
+
+        added, removed, updated, rebuilt = self._diff(self._entries(records))
+        results = {}
+        groups = {}
+
+        for name in removed:
+            group = self.published.pop(name)
+            del self._records[name]
+
+            self._members[group.object_path].discard(name)
+            groups[group.object_path] = group
+
+        for name, records in rebuilt.items():
+            self._records[name] = records
+            groups[self.published[name].object_path] = self.published[name]
+
+        async def update(name, records, changes):
+            group = self.published[name]
+            self._records[name] = records
+
+            if group.object_path in groups:  # ...it's being rebuilt anyway.
+                return
+
+            try:
+                await asyncio.gather(*(self._add_record(group, record, avahi.PUBLISH_UPDATE) for record in changes))
+            except dbus.exceptions.DBusException as e:
+                logging.warning("Unable to update records for '%s' in place: %s", name, e.get_dbus_name())
+                groups[group.object_path] = group
+
+        await asyncio.gather(*(update(name, records, changes) for name, (records, changes) in updated.items()))
+        await asyncio.gather(*(self._rebuild(group) for group in groups.values()))
+
+        results.update((name, name in self.published) for name in list(rebuilt) + list(updated))
+        if added:
+            results.update(await self.publish_many([record for name in added for record in added[name]], force))
+
+        logging.info("Reconciled records: %d added, %d removed, %d updated in place, %d rebuilt",
+                     len(added), len(removed), len(updated), len(rebuilt))
+
+        return results
+
+
+    async def resolve_collision(self, path):
+        """Handle a collision signaled for the entry group at "path", returning the names withdrawn because of it."""
+
+        names = self.group_names(path)
+
+        if not names:
+            return []
+
+        group = self.published[next(iter(names))]
+
+        self.view.discard(names)  # ...see "AvahiPublisher".
+        owners = await self.resolve_many(names)
+        taken = [name for name in names if owners[name] and owners[name] != self.hostname]
+
+        if taken:
+            await self.unpublish_many(taken)
+        else:  # ...whoever it was is gone already.
+            await self._rebuild(group)
+
+        return taken
+
+
+    async def available(self):
+        """Check if the connection to Avahi is still available."""
+
+        try:
+            # This is just a dummy call to test the connection...
+            await self._server_call("GetVersionString")
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() != "org.freedesktop.DBus.Error.ServiceUnknown":
+                raise
+
+            return False
+
+        return True
+
+
+# vim: set expandtab ts=4 sw=4:
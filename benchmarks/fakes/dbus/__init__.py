@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# dbus - Stand-in for "dbus-python", connected to an in-process fake Avahi daemon (for benchmarks and tests only).
+#
+# Only what the publishers use is here. Every call to the fake daemon takes "LATENCY" seconds (like
+# a D-Bus round trip), and lookups for names nobody owns take "RESOLVE_LATENCY" before timing out.
+#
+
+
+import itertools
+import time
+
+from . import exceptions
+
+
+# Knobs for the benchmarks (in seconds)...
+LATENCY = 0.0
+RESOLVE_LATENCY = 0.0
+
+# Names owned by other hosts on the "network" (name -> owner)...
+OWNERS = {}
+
+# Whether the daemon is running (see "FakeAvahi.stop()" and "FakeAvahi.start()")...
+RUNNING = True
+
+HOSTNAME = "benchmark.local"
+
+# From "avahi-common/defs.h"...
+_SERVER_RUNNING = 2
+_ENTRY_GROUP_UNCOMMITED, _ENTRY_GROUP_ESTABLISHED = 0, 2
+_MAX_ENTRIES = 32
+
+
+class UInt32(int): pass
+class Int32(int): pass
+class UInt16(int): pass
+class Byte(int): pass
+class Boolean(int): pass
+class String(str): pass
+class ByteArray(bytes): pass
+
+
+class Array(list):
+    def __init__(self, items=(), signature=None):
+        super().__init__(items)
+
+
+def _error(name, message=""):
+    return exceptions.DBusException(message, name=name)
+
+
+class _EntryGroup(object):
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.state = _ENTRY_GROUP_UNCOMMITED
+
+
+    def AddRecord(self, interface, protocol, flags, name, rclass, rtype, ttl, rdata):
+        if len(self.records) >= _MAX_ENTRIES and not flags & 64:
+            raise _error("org.freedesktop.Avahi.TooManyEntriesError", "Too many entries")
+
+        self.records[(interface, protocol, name, rtype)] = rdata
+
+
+    def Commit(self):
+        self.state = _ENTRY_GROUP_ESTABLISHED
+
+
+    def Reset(self):
+        self.records = {}
+        self.state = _ENTRY_GROUP_UNCOMMITED
+
+
+    def Free(self):
+        FakeAvahi.groups.pop(self.path, None)
+
+
+    def GetState(self):
+        return self.state
+
+
+    def IsEmpty(self):
+        return not self.records
+
+
+class _RecordBrowser(object):
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+
+
+    def Free(self):
+        FakeAvahi.browsers.pop(self.path, None)
+
+
+class _Server(object):
+    def GetHostNameFqdn(self):
+        return HOSTNAME
+
+
+    def GetVersionString(self):
+        return "avahi 0.8 (fake)"
+
+
+    def GetState(self):
+        return _SERVER_RUNNING
+
+
+    def EntryGroupNew(self):
+        path = "/Client1/EntryGroup%d" % next(FakeAvahi.ids)
+        FakeAvahi.groups[path] = _EntryGroup(path)
+
+        return path
+
+
+    def ResolveHostName(self, interface, protocol, name, aprotocol, flags):
+        name = name.decode("ascii") if isinstance(name, bytes) else name
+
+        if name in OWNERS:
+            return (interface, protocol, name, aprotocol, OWNERS[name], 0)
+
+        raise _error("org.freedesktop.Avahi.TimeoutError", "Timeout reached")
+
+
+    def RecordBrowserNew(self, interface, protocol, name, clazz, type, flags):
+        path = "/Client1/RecordBrowser%d" % next(FakeAvahi.ids)
+        FakeAvahi.browsers[path] = _RecordBrowser(path, name)
+
+        # What's already known arrives later, like the first answers from the network...
+        if name in OWNERS:
+            FakeAvahi.emit("ItemNew", path, interface, protocol, name, clazz, 1, ByteArray(b"\x0a\x00\x00\x01"), 0)
+
+        FakeAvahi.emit("AllForNow", path)
+        return path
+
+
+class FakeAvahi(object):
+    """The daemon's state, and ways to make it go away and come back."""
+
+    server = _Server()
+    groups = {}
+    browsers = {}
+    ids = itertools.count(1)
+    receivers = []
+
+    @classmethod
+    def records(cls):
+        """Return the number of records currently published."""
+
+        return sum(len(group.records) for group in list(cls.groups.values()) if group.state == _ENTRY_GROUP_ESTABLISHED)
+
+
+    @classmethod
+    def stop(cls):
+        global RUNNING
+
+        RUNNING = False
+        cls.groups.clear()
+        cls.browsers.clear()
+        cls._owner_changed(":1.1", "")
+
+
+    @classmethod
+    def start(cls):
+        global RUNNING
+
+        RUNNING = True
+        cls._owner_changed("", ":1.2")
+
+
+    @classmethod
+    def _owner_changed(cls, old, new):
+        for handler, kwargs in list(cls.receivers):
+            if kwargs.get("signal_name") == "NameOwnerChanged":
+                handler("org.freedesktop.Avahi", old, new)
+
+
+    @classmethod
+    def emit(cls, signal, path, *args):
+        """Deliver a signal from the object at "path" to its receivers, through the main loop."""
+
+        from gi.repository import GLib
+
+        for handler, kwargs in list(cls.receivers):
+            if kwargs.get("signal_name") == signal:
+                GLib.timeout_add(LATENCY * 1000, lambda handler=handler: handler(*args, path=path) and False)
+
+
+    @classmethod
+    def delay(cls, method, args):
+        """Return how long a call would take."""
+
+        if method == "ResolveHostName":
+            name = args[2].decode("ascii") if isinstance(args[2], bytes) else args[2]
+            return LATENCY if name in OWNERS else RESOLVE_LATENCY
+
+        return LATENCY
+
+
+    @classmethod
+    def invoke(cls, path, method, args):
+        """Run a call right away."""
+
+        if not RUNNING:
+            raise _error("org.freedesktop.DBus.Error.ServiceUnknown", "The name org.freedesktop.Avahi was not provided")
+
+        if path == "/":
+            target = cls.server
+        else:
+            target = cls.groups.get(path) or cls.browsers.get(path)
+
+            if target is None:
+                raise _error("org.freedesktop.DBus.Error.UnknownObject", "No such entry group")
+
+        return getattr(target, method)(*args)
+
+
+    @classmethod
+    def call(cls, path, method, args):
+        """Run a call, blocking for as long as it would take."""
+
+        delay = cls.delay(method, args)
+
+        if delay:
+            time.sleep(delay)
+
+        return cls.invoke(path, method, args)
+
+
+class _ProxyObject(object):
+    def __init__(self, path):
+        self.object_path = path
+
+
+class Interface(object):
+    def __init__(self, proxy, dbus_interface=None):
+        self.object_path = proxy.object_path
+        self.dbus_interface = dbus_interface
+
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            return FakeAvahi.call(self.object_path, method, args)
+
+        return call
+
+
+class _SignalMatch(object):
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+
+    def remove(self):
+        if self.receiver in FakeAvahi.receivers:
+            FakeAvahi.receivers.remove(self.receiver)
+
+
+class _Bus(object):
+    def get_object(self, name, path, **kwargs):
+        return _ProxyObject(path)
+
+
+    def name_has_owner(self, name):
+        return RUNNING
+
+
+    def add_signal_receiver(self, handler, **kwargs):
+        receiver = (handler, kwargs)
+        FakeAvahi.receivers.append(receiver)
+
+        return _SignalMatch(receiver)
+
+
+    def call_async(self, name, path, interface, method, signature, args, reply_handler, error_handler, timeout=-1.0):
+        from gi.repository import GLib
+
+        delay = FakeAvahi.delay(method, args)
+
+        try:
+            reply = FakeAvahi.invoke(path, method, args)
+        except exceptions.DBusException as e:
+            handler, args = error_handler, (e,)
+        else:
+            handler, args = reply_handler, (() if reply is None else reply if isinstance(reply, tuple) else (reply,))
+
+        # The reply arrives later, without holding up the main loop in the meantime...
+        GLib.timeout_add(delay * 1000, lambda: handler(*args) and False)
+
+
+def SystemBus(*args, **kwargs):
+    return _Bus()
+
+
+# vim: set expandtab ts=4 sw=4:
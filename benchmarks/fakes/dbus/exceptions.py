@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# dbus.exceptions - Stand-in for "dbus-python" (for benchmarks and tests only).
+#
+
+
+class DBusException(Exception):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args)
+        self._dbus_name = kwargs.get("name")
+
+
+    def get_dbus_name(self):
+        return self._dbus_name
+
+
+# vim: set expandtab ts=4 sw=4:
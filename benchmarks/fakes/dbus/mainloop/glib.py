@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# dbus.mainloop.glib - Stand-in for "dbus-python" (for benchmarks and tests only).
+#
+
+
+def DBusGMainLoop(set_as_default=False):
+    return None
+
+
+def threads_init():
+    pass
+
+
+# vim: set expandtab ts=4 sw=4:
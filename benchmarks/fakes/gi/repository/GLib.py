@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# GLib - Stand-in for PyGObject's GLib main loop (for benchmarks and tests only).
+#
+# A single queue of timed callbacks, run by whichever thread calls "MainLoop.run()". Only what the
+# publishers use is here: file descriptors and UNIX signals are accepted, but never watched.
+#
+
+
+import heapq
+import itertools
+import threading
+import time
+
+
+PRIORITY_HIGH = -100
+PRIORITY_DEFAULT = 0
+
+IO_IN = 1
+IO_ERR = 8
+IO_HUP = 16
+
+_ids = itertools.count(1)
+_queue = []  # ...(deadline, id, interval, function, args).
+_removed = set()
+_ready = threading.Condition()
+
+
+def timeout_add(interval, function, *args):
+    """Call "function" after "interval" milliseconds (and again, for as long as it returns True)."""
+
+    source = next(_ids)
+
+    with _ready:
+        heapq.heappush(_queue, (time.monotonic() + interval / 1000, source, interval, function, args))
+        _ready.notify()
+
+    return source
+
+
+def timeout_add_seconds(interval, function, *args):
+    return timeout_add(interval * 1000, function, *args)
+
+
+def idle_add(function, *args):
+    return timeout_add(0, function, *args)
+
+
+def source_remove(source):
+    with _ready:
+        _removed.add(source)
+
+
+def io_add_watch(fd, *args):
+    return next(_ids)
+
+
+def unix_signal_add(*args):
+    return next(_ids)
+
+
+class MainLoop(object):
+    def __init__(self):
+        self._running = False
+
+
+    def run(self):
+        self._running = True
+
+        while self._running:
+            with _ready:
+                while self._running and (not _queue or _queue[0][0] > time.monotonic()):
+                    _ready.wait(_queue[0][0] - time.monotonic() if _queue else None)
+
+                if not self._running:
+                    break
+
+                deadline, source, interval, function, args = heapq.heappop(_queue)
+
+                if source in _removed:
+                    _removed.discard(source)
+                    continue
+
+            if function(*args):
+                with _ready:
+                    heapq.heappush(_queue, (time.monotonic() + interval / 1000, source, interval, function, args))
+
+
+    def quit(self):
+        self._running = False
+
+        with _ready:
+            _ready.notify_all()
+
+
+# vim: set expandtab ts=4 sw=4:
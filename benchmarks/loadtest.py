@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# loadtest.py - Put "gatekeeper.py" under load over HTTP and WebSockets, on localhost.
+#
+# The server runs in a child process (started with "start_server()"), which keeps track of its own
+# event loop lag and memory use. Results go to standard output (or a file) as JSON, a summary to
+# stderr, and can be compared against the results of an earlier run (the baseline).
+#
+
+
+import sys
+import os, os.path
+import asyncio
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import statistics
+import tempfile
+import time
+
+from getopt import getopt, GetoptError
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import aiohttp
+
+
+SCENARIOS = ["http_keepalive", "http_churn", "ws_idle", "ws_chatty"]
+
+DEFAULT_PORT = 18080
+DEFAULT_DURATION = 5.0  # ...seconds, for each scenario.
+DEFAULT_HTTP_CLIENTS = 1000
+DEFAULT_CHURN_CLIENTS = 50
+DEFAULT_WS_CLIENTS = 2000
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_RUNS = 1
+
+# Connections being opened at the same time, at most (so the listen backlog doesn't overflow)...
+MAX_CONNECTING = 100
+
+LAG_INTERVAL = 0.01  # ...seconds between event loop lag samples, in the server.
+CHAT_INTERVAL = 0.1  # ...seconds between messages, for each chatty WebSocket client.
+BROADCAST_INTERVAL = 0.5  # ...seconds between broadcasts, while WebSocket clients sit idle.
+
+# What gets compared against the baseline, and whether higher is better...
+COMPARED = {"rps": True, "messages_per_second": True, "p50": False, "p99": False, "rss_per_connection": False,
+            "lag_p99": False}
+
+# Smallest change that counts as a regression, however large as a fraction (timings of a few milliseconds
+# are mostly noise, and the lag is only sampled every "LAG_INTERVAL")...
+FLOORS = {"p50": 0.001, "p99": 0.002, "lag_p99": 0.005, "rss_per_connection": 1024}
+
+
+def print_usage():
+    """Output the proper usage syntax for this program."""
+
+    print("USAGE: %s [-s <scenarios>] [-d <seconds>] [-c <clients>] [-n <clients>] [-w <clients>] [-p <port>] "
+          "[-r <runs>] [-b <baseline>] [-t <fraction>] [-o <filename>]" % os.path.basename(sys.argv[0]))
+    print("\n-s/--scenarios   Comma-separated scenarios to run. (Default: %s)" % ",".join(SCENARIOS))
+    print("-d/--duration    How long each scenario lasts, in seconds. (Default: %.1f)" % DEFAULT_DURATION)
+    print("-c/--clients     Keep-alive HTTP clients. (Default: %d)" % DEFAULT_HTTP_CLIENTS)
+    print("-n/--churn       HTTP clients opening a new connection for every request. (Default: %d)" % DEFAULT_CHURN_CLIENTS)
+    print("-w/--websockets  WebSocket clients. (Default: %d)" % DEFAULT_WS_CLIENTS)
+    print("-p/--port        Port for the server to listen on (on localhost). (Default: %d)" % DEFAULT_PORT)
+    print("-r/--runs        Run each scenario this many times, keeping the median of each measurement. (Default: %d)"
+          % DEFAULT_RUNS)
+    print("-b/--baseline    Compare against the results in this file, failing on regressions.")
+    print("-t/--tolerance   Change (as a fraction) that counts as a regression. (Default: %.2f)" % DEFAULT_TOLERANCE)
+    print("-o/--output      Write the JSON results into this file instead of standard output (may be the baseline).")
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else None
+
+
+def median_result(measurements):
+    """Combine repeated runs of a scenario, keeping the median of each measurement."""
+
+    combined = dict(measurements[0], runs=len(measurements))
+
+    for key, value in measurements[0].items():
+        values = [measurement.get(key) for measurement in measurements]
+
+        if isinstance(value, (int, float)) and all(isinstance(v, (int, float)) for v in values):
+            combined[key] = statistics.median(values)
+
+    return combined
+
+
+def raise_fd_limit():
+    """Allow as many open connections as the system lets us have."""
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss():
+    """Return the memory resident for this process, in bytes."""
+
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def serve(port, conn):
+    """Run the gatekeeper in this (child) process, answering commands from "conn" with its own measurements."""
+
+    os.chdir(tempfile.mkdtemp(prefix="gatekeeper-loadtest."))
+    raise_fd_limit()
+
+    # Only the measurements are interesting...
+    logging.basicConfig(level=logging.CRITICAL)
+
+    import gatekeeper
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    lags = []
+    stopping = asyncio.Event()
+
+    async def watch_lag():
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            lags.append(loop.time() - start - LAG_INTERVAL)
+
+    def command():
+        request = conn.recv()
+
+        if request == "reset":
+            del lags[:]
+            conn.send(None)
+        elif request == "stats":
+            conn.send({"rss": rss(), "lag_p99": percentile(lags, 0.99), "lag_max": max(lags) if lags else None,
+                       "messages": gatekeeper.WS_MESSAGES.labels("text").value,
+                       "websockets": gatekeeper.WS_CONNECTIONS.value})
+        elif request == "broadcast":
+            gatekeeper.broadcaster.publish("loadtest", {"sent": time.monotonic()})
+            conn.send(None)
+        elif request == "stop":
+            stopping.set()
+
+    async def main():
+        site = await gatekeeper.start_server("127.0.0.1", port)
+        lag_watcher = loop.create_task(watch_lag())
+        loop.add_reader(conn.fileno(), command)
+        conn.send("ready")
+
+        await stopping.wait()
+
+        loop.remove_reader(conn.fileno())
+        lag_watcher.cancel()
+        await gatekeeper.stop_server(site)
+        conn.send("stopped")
+
+    loop.run_until_complete(main())
+
+
+class Server(object):
+    """The gatekeeper, running in a child process."""
+
+    def __init__(self, port):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context("fork").Process(target=serve, args=(port, child), daemon=True)
+        self.process.start()
+
+        if self.conn.recv() != "ready":
+            raise RuntimeError("server failed to start")
+
+
+    async def call(self, request):
+        """Send a command to the server, returning its answer (without blocking the event loop)."""
+
+        def call():
+            self.conn.send(request)
+            return self.conn.recv()
+
+        return await asyncio.get_event_loop().run_in_executor(None, call)
+
+
+    def stop(self):
+        self.conn.send("stop")
+        self.conn.recv()
+        self.process.join()
+
+
+def result(scenario, connections, seconds, server_before, server_after, samples=None, **extra):
+    """Summarize a single scenario, with latencies if there are any (all in seconds)."""
+
+    summary = {"scenario": scenario, "connections": connections, "seconds": seconds,
+               "rss_per_connection": (server_after["rss"] - server_before["rss"]) / connections if connections else None,
+               "lag_p99": server_after["lag_p99"], "lag_max": server_after["lag_max"]}
+
+    if samples:
+        summary.update(p50=percentile(samples, 0.50), p99=percentile(samples, 0.99), p999=percentile(samples, 0.999),
+                       max=max(samples))
+
+    summary.update(extra)
+    return summary
+
+
+async def http_clients(server, url, scenario, clients, duration, churn=False):
+    """Have "clients" request "url" over and over, on their own connection (or a new one for each request)."""
+
+    latencies = []
+    errors = 0
+    connector = aiohttp.TCPConnector(limit=0, force_close=churn)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        before = await server.call("stats")
+        await server.call("reset")
+        deadline = time.monotonic() + duration
+
+        async def client():
+            nonlocal errors
+
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+
+                try:
+                    async with session.get(url) as response:
+                        await response.read()
+                except (aiohttp.ClientError, OSError):
+                    errors += 1
+                    continue
+
+                latencies.append(time.perf_counter() - start)
+
+        async def measure():  # ...while all connections are open.
+            await asyncio.sleep(duration / 2)
+            return await server.call("stats")
+
+        start = time.perf_counter()
+        *_, during = await asyncio.gather(*(client() for _ in range(clients)), measure())
+        seconds = time.perf_counter() - start
+        after = dict(await server.call("stats"), rss=during["rss"])
+
+    # New connections come and go, only the ones open at a time take memory...
+    return result(scenario, 0 if churn else clients, seconds, before, after, latencies, requests=len(latencies),
+                  rps=len(latencies) / seconds, errors=errors)
+
+
+async def ws_clients(server, url, scenario, clients, duration, chatty=False):
+    """Open "clients" WebSocket connections, and keep them open (and idle, or chatting) for a while.
+
+    Latencies are for broadcasts to reach idle clients, and for pings to come back to chatty ones
+    (answered by the server in turn with their other messages).
+    """
+
+    latencies = []
+    since = float("inf")  # ...new clients get the last broadcast too, only count those sent while measuring.
+    errors = 0
+    connecting = asyncio.Semaphore(MAX_CONNECTING)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        before = await server.call("stats")
+
+        async def connect():
+            nonlocal errors
+
+            async with connecting:
+                try:
+                    return await session.ws_connect(url, autoping=not chatty)
+                except (aiohttp.ClientError, OSError):
+                    errors += 1
+                    return None
+
+        async def receive(ws):
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT and '"loadtest"' in msg.data:
+                    sent = json.loads(msg.data)["sent"]
+
+                    if sent >= since:
+                        latencies.append(time.monotonic() - sent)
+                elif msg.type == aiohttp.WSMsgType.PONG:
+                    latencies.append(time.monotonic() - float(msg.data.decode("ascii")))
+                elif msg.type == aiohttp.WSMsgType.PING:
+                    await ws.pong(msg.data)
+
+        async def chat(ws, deadline):
+            while time.monotonic() < deadline and not ws.closed:
+                await ws.send_str("hello")
+                await ws.ping(repr(time.monotonic()).encode("ascii"))
+                await asyncio.sleep(CHAT_INTERVAL)
+
+        start = time.perf_counter()
+        sockets = [ws for ws in await asyncio.gather(*(connect() for _ in range(clients))) if ws is not None]
+        connected = time.perf_counter() - start
+        receivers = [asyncio.ensure_future(receive(ws)) for ws in sockets]
+
+        await server.call("reset")
+        opened = await server.call("stats")
+        start = time.perf_counter()
+
+        if chatty:
+            await asyncio.gather(*(chat(ws, time.monotonic() + duration) for ws in sockets))
+        else:
+            since = time.monotonic()
+
+            while time.perf_counter() - start < duration:
+                await server.call("broadcast")
+                await asyncio.sleep(BROADCAST_INTERVAL)
+
+        seconds = time.perf_counter() - start
+        after = dict(await server.call("stats"), rss=opened["rss"])
+
+        await asyncio.gather(*(ws.close() for ws in sockets))
+        await asyncio.gather(*receivers, return_exceptions=True)
+
+    extra = {"connect_seconds": connected, "errors": errors}
+
+    if chatty:
+        extra["messages_per_second"] = (after["messages"] - opened["messages"]) / seconds
+
+    return result(scenario, len(sockets), seconds, before, after, latencies, **extra)
+
+
+async def run_scenario(scenario, port, duration, http, churn, websockets):
+    base = "http://127.0.0.1:%d" % port
+    server = Server(port)  # ...a fresh one, so memory freed by earlier runs doesn't get reused.
+
+    try:
+        if scenario == "http_keepalive":
+            return await http_clients(server, base + "/", scenario, http, duration)
+        elif scenario == "http_churn":
+            return await http_clients(server, base + "/", scenario, churn, duration, churn=True)
+        elif scenario == "ws_idle":
+            return await ws_clients(server, base + "/ws", scenario, websockets, duration)
+        else:
+            return await ws_clients(server, base + "/ws", scenario, websockets, duration, chatty=True)
+    finally:
+        server.stop()
+
+
+async def run(scenarios, port, duration, http, churn, websockets, runs):
+    results = []
+
+    for scenario in scenarios:
+        measurements = []
+
+        for _ in range(runs):
+            measurements.append(await run_scenario(scenario, port, duration, http, churn, websockets))
+            print_result(measurements[-1])
+
+        results.append(median_result(measurements))
+
+        if runs > 1:
+            print_result(results[-1])
+
+    return results
+
+
+def print_result(measurement):
+    ms = lambda value: "-" if value is None else "%.3fms" % (value * 1000)
+    rate = measurement.get("rps", measurement.get("messages_per_second"))
+
+    print("%-15s %5g conns  %9s/s  p50=%s p99=%s p999=%s  %s/conn  lag p99=%s max=%s" % (
+          measurement["scenario"], measurement["connections"], "-" if rate is None else "%.0f" % rate,
+          ms(measurement.get("p50")), ms(measurement.get("p99")), ms(measurement.get("p999")),
+          "-" if measurement["rss_per_connection"] is None else "%.1fKiB" % (measurement["rss_per_connection"] / 1024),
+          ms(measurement["lag_p99"]), ms(measurement["lag_max"])), file=sys.stderr)
+
+
+def compare(results, baseline, tolerance):
+    """Print how each result changed since "baseline", returning the regressions beyond "tolerance"."""
+
+    previous = dict((measurement["scenario"], measurement) for measurement in baseline["results"])
+    regressions = []
+
+    for measurement in results:
+        old = previous.get(measurement["scenario"])
+
+        if old is None:
+            continue
+
+        for metric, higher_is_better in sorted(COMPARED.items()):
+            if measurement.get(metric) is None or not old.get(metric):
+                continue
+
+            change = (measurement[metric] - old[metric]) / abs(old[metric])
+            worse = change < -tolerance if higher_is_better else change > tolerance
+            worse = worse and abs(measurement[metric] - old[metric]) >= FLOORS.get(metric, 0)
+
+            print("%-15s %-20s %12.6g -> %12.6g  %+7.1f%%%s" % (measurement["scenario"], metric, old[metric],
+                  measurement[metric], change * 100, "  REGRESSION" if worse else ""), file=sys.stderr)
+
+            if worse:
+                regressions.append((measurement["scenario"], metric))
+
+    return regressions
+
+
+def parse_args():
+    """Parse and enforce command-line arguments."""
+
+    try:
+        options, args = getopt(sys.argv[1:], "s:d:c:n:w:p:r:b:t:o:h", ["scenarios=", "duration=", "clients=", "churn=",
+                                                                        "websockets=", "port=", "runs=", "baseline=",
+                                                                        "tolerance=", "output=", "help"])
+    except GetoptError as e:
+        print("error: %s." % e, file=sys.stderr)
+        print_usage()
+        sys.exit(1)
+
+    scenarios = SCENARIOS
+    duration = DEFAULT_DURATION
+    http = DEFAULT_HTTP_CLIENTS
+    churn = DEFAULT_CHURN_CLIENTS
+    websockets = DEFAULT_WS_CLIENTS
+    port = DEFAULT_PORT
+    runs = DEFAULT_RUNS
+    baseline = None
+    tolerance = DEFAULT_TOLERANCE
+    output = None
+
+    for option, value in options:
+        if option in ("-h", "--help"):
+            print_usage()
+            sys.exit(1)
+        elif option in ("-s", "--scenarios"):
+            scenarios = [scenario.strip() for scenario in value.split(",")]
+
+            for scenario in scenarios:
+                if scenario not in SCENARIOS:
+                    print("error: unknown scenario: %s" % scenario, file=sys.stderr)
+                    print_usage()
+                    sys.exit(1)
+        elif option in ("-d", "--duration"):
+            duration = float(value)
+        elif option in ("-c", "--clients"):
+            http = int(value)
+        elif option in ("-n", "--churn"):
+            churn = int(value)
+        elif option in ("-w", "--websockets"):
+            websockets = int(value)
+        elif option in ("-p", "--port"):
+            port = int(value)
+        elif option in ("-r", "--runs"):
+            runs = max(1, int(value))
+        elif option in ("-b", "--baseline"):
+            baseline = value.strip()
+        elif option in ("-t", "--tolerance"):
+            tolerance = float(value)
+        elif option in ("-o", "--output"):
+            output = value.strip()
+
+    return (scenarios, duration, http, churn, websockets, port, runs, baseline, tolerance, output)
+
+
+def main():
+    (scenarios, duration, http, churn, websockets, port, runs, baseline, tolerance, output) = parse_args()
+
+    # Read first, the results may be about to replace it ("-o" and "-b" naming the same file)...
+    previous = None
+
+    if baseline:
+        try:
+            with open(baseline) as f:
+                previous = json.load(f)
+        except FileNotFoundError:
+            print("No baseline at %s to compare against (these results can be copied there to make one)." % baseline,
+                  file=sys.stderr)
+
+    raise_fd_limit()
+    results = asyncio.get_event_loop().run_until_complete(run(scenarios, port, duration, http, churn, websockets,
+                                                              runs))
+
+    report = {
+        "python": platform.python_version(),
+        "aiohttp": aiohttp.__version__,
+        "config": {"scenarios": scenarios, "duration": duration, "http_clients": http, "churn_clients": churn,
+                   "websocket_clients": websockets, "runs": runs},
+        "results": results,
+    }
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if previous is not None:
+        regressions = compare(results, previous, tolerance)
+
+        if regressions:
+            print("%d regressions beyond %.0f%%." % (len(regressions), tolerance * 100), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# run.py - Measure the publishers and "publish-cname.py" against a fake, in-process Avahi daemon.
+#
+# The fake "dbus" (and "gi") modules in "fakes/" take the place of the real ones, so no D-Bus or
+# Avahi daemon is needed. Results go to standard output (or a file) as JSON, a summary to stderr.
+#
+
+
+import sys
+import os, os.path
+import asyncio
+import gc
+import importlib.util
+import json
+import logging
+import platform
+import threading
+import time
+
+from getopt import getopt, GetoptError
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, "fakes"), os.path.dirname(HERE)]
+
+import dbus
+
+from dbus import FakeAvahi
+from gi.repository import GLib
+
+from aiopublisher import AsyncAvahiPublisher
+from mpublisher import AvahiPublisher
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+DEFAULT_LATENCY = 0.1  # ...milliseconds, for each call to the daemon.
+DEFAULT_RESOLVE_LATENCY = 5.0  # ...milliseconds, for lookups of names nobody owns (ie. timeouts).
+DEFAULT_COLLISIONS = 0.0
+DEFAULT_OPERATIONS = 100  # ...for benchmarks timing individual calls.
+
+
+def print_usage():
+    """Output the proper usage syntax for this program."""
+
+    print("USAGE: %s [-s <sizes>] [-l <ms>] [-r <ms>] [-c <fraction>] [-p <count>] [-o <filename>]" % os.path.basename(sys.argv[0]))
+    print("\n-s/--sizes       Comma-separated numbers of names to publish. (Default: %s)" % ",".join(map(str, DEFAULT_SIZES)))
+    print("-l/--latency     Time taken by each call to the daemon, in ms. (Default: %.1f)" % DEFAULT_LATENCY)
+    print("-r/--resolve     Time taken by lookups for unknown names, in ms. (Default: %.1f)" % DEFAULT_RESOLVE_LATENCY)
+    print("-c/--collisions  Fraction of names already owned by another host. (Default: %.2f)" % DEFAULT_COLLISIONS)
+    print("-p/--operations  Calls to time individually for each size (at most). (Default: %d)" % DEFAULT_OPERATIONS)
+    print("-o/--output      Write the JSON results into this file instead of standard output.")
+
+
+def load_script(name):
+    """Import one of the scripts that can't be imported by name (ie. "publish-cname.py")."""
+
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(os.path.dirname(HERE), name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else None
+
+
+def result(benchmark, names, seconds, samples=None, **extra):
+    """Summarize a single measurement, with per-call latencies if there are any (all in seconds)."""
+
+    summary = {"benchmark": benchmark, "names": names, "seconds": seconds,
+               "throughput": names / seconds if seconds else None}
+
+    if samples:
+        summary.update(calls=len(samples), p50=percentile(samples, 0.50), p99=percentile(samples, 0.99),
+                       max=max(samples))
+
+    summary.update(extra)
+    return summary
+
+
+def timed(function, *args):
+    """Call "function", returning its result and how long it took."""
+
+    start = time.perf_counter()
+    value = function(*args)
+
+    return value, time.perf_counter() - start
+
+
+def reset_daemon(names, collisions):
+    """Forget everything published, and give a fraction of "names" to some other host."""
+
+    FakeAvahi.groups.clear()
+    del FakeAvahi.receivers[:]
+    dbus.RUNNING = True
+
+    dbus.OWNERS.clear()
+    if collisions:
+        step = max(1, int(round(1 / collisions)))
+        dbus.OWNERS.update((name, "elsewhere.local") for name in names[::step])
+
+    gc.collect()
+
+
+def make_names(count):
+    return ["bench%05d.local" % i for i in range(count)]
+
+
+def each_call(function, names):
+    """Call "function" once for each name, returning the latency of each call."""
+
+    samples = []
+
+    for name in names:
+        start = time.perf_counter()
+        function(name)
+        samples.append(time.perf_counter() - start)
+
+    return samples
+
+
+def bench_publisher(size, collisions, operations):
+    names = make_names(size)
+    sample = names[:operations]
+    results = []
+
+    reset_daemon(names, collisions)
+    publisher = AvahiPublisher()
+
+    published, seconds = timed(publisher.publish_many, [publisher.cname_record(name) for name in names])
+    results.append(result("publish_many", size, seconds, published=sum(published.values()),
+                          records=FakeAvahi.records()))
+
+    # Half the names go, the other half point somewhere else now...
+    changed = [publisher.address_record(name, "10.0.0.1") for name in names[::2]]
+    _, seconds = timed(publisher.reconcile, changed)
+    results.append(result("reconcile", size, seconds, records=FakeAvahi.records()))
+
+    _, seconds = timed(publisher.reset)
+    results.append(result("reset", size, seconds))
+
+    reset_daemon(names, collisions)
+    publisher = AvahiPublisher()
+
+    samples = each_call(publisher.resolve, sample)
+    results.append(result("resolve", len(sample), sum(samples), samples))
+
+    # The same names again, answered from the network view this time...
+    samples = each_call(publisher.resolve, sample)
+    results.append(result("resolve_cached", len(sample), sum(samples), samples))
+
+    samples = each_call(publisher.publish_cname, sample)
+    results.append(result("publish_cname", len(sample), sum(samples), samples))
+
+    samples = each_call(publisher.unpublish, [name for name in sample if name in publisher.published])
+    results.append(result("unpublish", len(samples), sum(samples), samples))
+
+    samples = each_call(lambda name: publisher.publish_address(name, "10.0.0.2"), sample)
+    results.append(result("publish_address", len(sample), sum(samples), samples))
+
+    publisher.reset()
+    return results
+
+
+def bench_async_publisher(size, collisions):
+    names = make_names(size)
+    reset_daemon(names, collisions)
+
+    async def publish():
+        publisher = await AsyncAvahiPublisher.create()
+        start = time.perf_counter()
+        published = await publisher.publish_many([publisher.cname_record(name) for name in names])
+        seconds = time.perf_counter() - start
+
+        await publisher.reset()
+        return published, seconds
+
+    published, seconds = asyncio.run(publish())
+    return [result("async_publish_many", size, seconds, published=sum(published.values()))]
+
+
+def bench_service(size, collisions):
+    """Time "publish-cname.py" itself: starting up, recovering from an Avahi restart and shutting down."""
+
+    script = load_script("publish-cname")
+    names = make_names(size)
+    results = []
+
+    reset_daemon(names, collisions)
+
+    def startup():
+        service = script.PublishService(names, script.DEFAULT_DNS_TTL, script.DEFAULT_RESOLVE_TIMEOUT, False)
+        service.start()
+        service.scheduler.flush()  # ...no waiting for changes to settle, just the work itself.
+        return service
+
+    service, seconds = timed(startup)
+    results.append(result("service_startup", size, seconds, records=FakeAvahi.records()))
+
+    # Avahi restarts, and "publish-cname.py" must republish everything on its own...
+    FakeAvahi.stop()
+    _, seconds = timed(lambda: (FakeAvahi.start(), service.scheduler.flush()))
+    results.append(result("service_reconnect", size, seconds, records=FakeAvahi.records()))
+
+    _, seconds = timed(service.withdraw)
+    results.append(result("service_shutdown", size, seconds, records=FakeAvahi.records()))
+
+    return results
+
+
+def parse_args():
+    """Parse and enforce command-line arguments."""
+
+    try:
+        options, args = getopt(sys.argv[1:], "s:l:r:c:p:o:h", ["sizes=", "latency=", "resolve=", "collisions=",
+                                                                "operations=", "output=", "help"])
+    except GetoptError as e:
+        print("error: %s." % e, file=sys.stderr)
+        print_usage()
+        sys.exit(1)
+
+    sizes = DEFAULT_SIZES
+    latency = DEFAULT_LATENCY
+    resolve_latency = DEFAULT_RESOLVE_LATENCY
+    collisions = DEFAULT_COLLISIONS
+    operations = DEFAULT_OPERATIONS
+    output = None
+
+    for option, value in options:
+        if option in ("-h", "--help"):
+            print_usage()
+            sys.exit(1)
+        elif option in ("-s", "--sizes"):
+            sizes = [int(size) for size in value.split(",")]
+        elif option in ("-l", "--latency"):
+            latency = float(value)
+        elif option in ("-r", "--resolve"):
+            resolve_latency = float(value)
+        elif option in ("-c", "--collisions"):
+            collisions = float(value)
+        elif option in ("-p", "--operations"):
+            operations = int(value)
+        elif option in ("-o", "--output"):
+            output = value.strip()
+
+    return (sizes, latency, resolve_latency, collisions, operations, output)
+
+
+def main():
+    (sizes, latency, resolve_latency, collisions, operations, output) = parse_args()
+
+    # Only the measurements are interesting...
+    logging.basicConfig(level=logging.CRITICAL)
+
+    dbus.LATENCY = latency / 1000
+    dbus.RESOLVE_LATENCY = resolve_latency / 1000
+
+    # The asynchronous publisher needs the (fake) GLib main loop running in the background...
+    threading.Thread(target=GLib.MainLoop().run, name="glib", daemon=True).start()
+
+    results = []
+
+    for size in sizes:
+        for benchmark in (lambda: bench_publisher(size, collisions, operations),
+                          lambda: bench_async_publisher(size, collisions),
+                          lambda: bench_service(size, collisions)):
+            for measurement in benchmark():
+                results.append(measurement)
+
+                print("%-20s %6d names  %9.3fs  %s" % (measurement["benchmark"], measurement["names"],
+                      measurement["seconds"], "" if "p50" not in measurement else "p50=%.3fms p99=%.3fms" %
+                      (measurement["p50"] * 1000, measurement["p99"] * 1000)), file=sys.stderr)
+
+    report = {
+        "python": platform.python_version(),
+        "config": {"sizes": sizes, "latency_ms": latency, "resolve_latency_ms": resolve_latency,
+                   "collisions": collisions, "operations": operations},
+        "results": results,
+    }
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
+
+
+# vim: set expandtab ts=4 sw=4:
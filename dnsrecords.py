@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# dnsrecords.py - mDNS records and the bookkeeping shared by all publishers (no I/O happens here).
+#
+
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import functools
+import logging
+import re
+import socket
+import threading
+import time
+
+from collections import namedtuple, OrderedDict
+
+
+# From "/usr/include/avahi-common/defs.h"
+AVAHI_DNS_CLASS_IN = 0x01
+AVAHI_DNS_TYPE_A = 0x01
+AVAHI_DNS_TYPE_CNAME = 0x05
+AVAHI_DNS_TYPE_TXT = 0x10
+AVAHI_DNS_TYPE_AAAA = 0x1C
+AVAHI_DNS_TYPE_ANY = 0xFF
+
+# Same as Avahi's "IF_UNSPEC" and "PROTO_UNSPEC" (any interface, any protocol)...
+IF_UNSPEC = -1
+PROTO_UNSPEC = -1
+
+# Avahi refuses to add more entries than this to a single entry group
+# (see "entries-per-entry-group-max" in "avahi-daemon.conf")...
+MAX_ENTRIES_PER_GROUP = 32
+
+# Default deadline for a single name lookup, in seconds...
+DEFAULT_RESOLVE_TIMEOUT = 5.0
+
+# How many encoded names and TXT payloads to keep around...
+RDATA_CACHE_SIZE = 4096
+
+# Highest suffix tried for alternative names (eg. "foo-9.local")...
+MAX_ALTERNATIVES = 9
+
+# How long lookup results are trusted, in seconds (names nobody answered for are asked again sooner)...
+DEFAULT_VIEW_TTL = 60.0
+DEFAULT_NEGATIVE_TTL = 5.0
+
+# How many names to remember the owners of...
+MAX_VIEW_SIZE = 16384
+
+
+@functools.lru_cache(maxsize=RDATA_CACHE_SIZE)
+def fqdn_to_rdata(fqdn):
+    """Convert an FQDN into the mDNS data record format (cached, names are published over and over)."""
+
+    labels = [label.encode("ascii") for label in fqdn.split(".") if label]
+    return b"".join(bytes((len(label),)) + label for label in labels) + b"\0"
+
+
+@functools.lru_cache(maxsize=RDATA_CACHE_SIZE)
+def _txt_to_rdata(strings):
+    strings = [string if isinstance(string, bytes) else string.encode("utf-8") for string in strings]
+
+    if any(len(string) > 255 for string in strings):
+        raise ValueError("TXT strings can't be longer than 255 bytes")
+
+    # An empty TXT record still needs a single (empty) string, see RFC 6763 (section 6.1)...
+    return b"".join(bytes((len(string),)) + string for string in strings) or b"\0"
+
+
+def txt_to_rdata(txt):
+    """Convert TXT data (a "key -> value" mapping, or a sequence of strings) into the mDNS data record format."""
+
+    # Formatted before looking up the cache, values comparing equal (like 1, True and 1.0) don't read the same...
+    strings = tuple("%s=%s" % item for item in txt.items()) if isinstance(txt, dict) else tuple(txt)
+
+    try:
+        return _txt_to_rdata(strings)
+    except TypeError:  # ...unhashable values can't be cached.
+        return _txt_to_rdata.__wrapped__(strings)
+
+
+def alternative_name(name, limit=MAX_ALTERNATIVES):
+    """Return the next name to try after "name" collided (eg. "foo.local" -> "foo-2.local"), or None after "limit" tries."""
+
+    label, dot, rest = name.partition(".")
+    match = re.match(r"^(.*)-(\d+)$", label)
+    base, number = (match.group(1), int(match.group(2)) + 1) if match else (label, 2)
+
+    if number > limit:
+        return None
+
+    return "%s-%d%s%s" % (base, number, dot, rest)
+
+
+class Record(namedtuple("Record", ["name", "type", "rdata", "ttl", "interface", "protocol"])):
+    """A single mDNS resource record, with "rdata" already in DNS wire format."""
+
+    __slots__ = ()
+
+    def __new__(cls, name, type, rdata, ttl=None, interface=IF_UNSPEC, protocol=PROTO_UNSPEC):
+        return super(Record, cls).__new__(cls, name, type, rdata, ttl, interface, protocol)
+
+
+class NetworkView(object):
+    """The owners of names on the network as last seen, for answering lookups from memory.
+
+    Entries expire after a while, unless they're "live" (ie. kept up to date by someone following the
+    network for changes, who must also take them back out). Names nobody answered for are remembered
+    too, for a shorter while. Safe to use from any thread.
+    """
+
+    def __init__(self, ttl=DEFAULT_VIEW_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, size=MAX_VIEW_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+
+        # Name -> (owner, expiry time), least recently updated first...
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def lookup(self, name):
+        """Return "(True, owner)" if the owner of "name" is known ("None" if nobody), "(False, None)" otherwise."""
+
+        entry = self._entries.get(name)
+
+        if entry is None or entry[1] < time.monotonic():
+            return False, None
+
+        return True, entry[0]
+
+
+    def update(self, name, owner, live=False):
+        """Remember the owner of "name" ("None" if nobody answered for it)."""
+
+        if live:
+            expires = float("inf")
+        else:
+            expires = time.monotonic() + (self.ttl if owner else self.negative_ttl)
+
+        with self._lock:
+            self._entries.pop(name, None)
+            self._entries[name] = (owner, expires)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+    def discard(self, names):
+        """Forget what's known about "names" (eg. to have them looked up again)."""
+
+        with self._lock:
+            for name in names:
+                self._entries.pop(name, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class GroupFill(object):
+    """Filling an entry group with a batch of names, over as many passes as it takes (no I/O happens here).
+
+    Each pass adds the records of all names in "batch" to the group. When some name fails part-way,
+    leaving records behind, the group must be reset and filled again without the names that failed.
+    Those that failed in any pass end up in "failed".
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.failed = []
+
+
+    def settle(self, failed, partial):
+        """Take the outcome of a pass over "batch", returning whether another one is needed (after a reset)."""
+
+        self.failed.extend(failed)
+
+        if not partial:
+            return False
+
+        failed = set(failed)
+        self.batch = [(name, records) for name, records in self.batch if name not in failed]
+
+        return True
+
+
+class BasePublisher(object):
+    """Record building and bookkeeping shared by all publishers (no I/O happens here)."""
+
+    # Exceptions signaling that publishing failed (eg. because the daemon went away)...
+    errors = ()
+
+    def __init__(self, record_ttl=60, group_size=MAX_ENTRIES_PER_GROUP):
+        """Initialize the publisher with fixed record TTL value (in seconds)."""
+
+        self.hostname = None
+        self.record_ttl = record_ttl
+        self.group_size = group_size
+        self.published = {}
+
+        # Names sharing an entry group (by object path), and the records published for each name...
+        self._members = {}
+        self._records = {}
+
+
+    def forget(self):
+        """Stop tracking all published records, without telling Avahi (eg. after it went away)."""
+
+        self.published = {}
+        self._members = {}
+        self._records = {}
+
+
+    def close(self):
+        """Release whatever the publisher holds besides published records (nothing, by default)."""
+
+        pass
+
+
+    def _fqdn_to_rdata(self, fqdn):
+        """Convert an FQDN into the mDNS data record format."""
+
+        return fqdn_to_rdata(fqdn)
+
+
+    def count(self):
+        """Return the number of records currently being published."""
+
+        return len(self.published)
+
+
+    def records(self):
+        """Return the records being published, by name."""
+
+        return dict((name, list(records)) for name, records in self._records.items())
+
+
+    def group_names(self, path):
+        """Return the names published in the entry group at "path" (empty if it isn't ours)."""
+
+        return set(self._members.get(path, ()))
+
+
+    def _unique_groups(self):
+        """Return each entry group in use exactly once (groups may be shared by many names)."""
+
+        return list(dict((group.object_path, group) for group in self.published.values()).values())
+
+
+    def _check(self, name, current_owner):
+        """Decide if "name" may be published, given its current owner on the network."""
+
+        if current_owner:
+            if current_owner != self.hostname:
+                logging.error("DNS entry '%s' is already owned by '%s'", name, current_owner)
+                return False
+
+            # We may have discovered ourselves, but this is not a fatal problem...
+            logging.warning("DNS entry '%s' is already being published by this machine", name)
+
+        return True
+
+
+    def check_many(self, names, timeout=None):
+        """Return those "names" which are free to be published by this host (checked concurrently)."""
+
+        owners = self.resolve_many(names, timeout)
+        return [name for name in owners if self._check(name, owners[name])]
+
+
+    def _entries(self, records):
+        """Group records by name, keeping their original order."""
+
+        entries = {}
+        for record in records:
+            entries.setdefault(record.name, []).append(record)
+
+        return entries
+
+
+    def _track(self, group, names, entries):
+        """Remember that "names" (with records from "entries") are now published in "group"."""
+
+        self._members[group.object_path] = set(names)
+
+        for name in names:
+            self.published[name] = group
+            self._records[name] = entries[name]
+
+
+    def _batches(self, entries):
+        """Pack (name, records) entries into batches that fit into a single entry group each."""
+
+        batch = []
+        size = 0
+
+        for name, records in entries:
+            if batch and size + len(records) > self.group_size:
+                yield batch
+                batch = []
+                size = 0
+
+            batch.append((name, records))
+            size += len(records)
+
+        if batch:
+            yield batch
+
+
+    def _normalized(self, record):
+        """Return "record" with its effective TTL filled in."""
+
+        return record if record.ttl is not None else record._replace(ttl=self.record_ttl)
+
+
+    def _in_place(self, old, new):
+        """Return the records from "new" that replace their counterparts in "old" in place, or None if that's not possible.
+
+        Each record is matched to the old one with the same type, interface and protocol (the key Avahi
+        uses for "PUBLISH_UPDATE"), so this only works if that key is unique on both sides and no record
+        was added or removed.
+        """
+
+        old_slots = dict(((r.type, r.interface, r.protocol), self._normalized(r)) for r in old)
+        new_slots = dict(((r.type, r.interface, r.protocol), self._normalized(r)) for r in new)
+
+        if len(old_slots) != len(old) or len(new_slots) != len(new) or set(old_slots) != set(new_slots):
+            return None
+
+        return [new_slots[slot] for slot in new_slots if new_slots[slot] != old_slots[slot]]
+
+
+    def _diff(self, desired):
+        """Compare the desired "name -> records" with what is published.
+
+        Returns the names to add and to remove, the names whose records can be updated in place (with
+        just the records that changed), and the names whose group must be rebuilt instead.
+        """
+
+        added = dict((name, records) for name, records in desired.items() if name not in self._records)
+        removed = [name for name in self._records if name not in desired]
+        updated = {}
+        rebuilt = {}
+
+        for name, records in desired.items():
+            current = self._records.get(name)
+
+            if current is None:
+                continue
+
+            if set(map(self._normalized, current)) == set(map(self._normalized, records)):
+                continue
+
+            changes = self._in_place(current, records)
+
+            if changes is None:
+                rebuilt[name] = records
+            else:
+                updated[name] = (records, changes)
+
+        return added, removed, updated, rebuilt
+
+
+    def cname_record(self, cname):
+        """Build a CNAME record pointing "cname" to this host."""
+
+        return Record(cname, AVAHI_DNS_TYPE_CNAME, self._fqdn_to_rdata(self.hostname))
+
+
+    def txt_record(self, name, txt):
+        """Build a TXT record for "name", from a "key -> value" mapping or a sequence of strings."""
+
+        return Record(name, AVAHI_DNS_TYPE_TXT, txt_to_rdata(txt))
+
+
+    def address_record(self, name, address, interface=IF_UNSPEC):
+        """Build an A/AAAA record pointing "name" to "address"."""
+
+        if ":" in address:
+            return Record(name, AVAHI_DNS_TYPE_AAAA, socket.inet_pton(socket.AF_INET6, address), interface=interface)
+
+        return Record(name, AVAHI_DNS_TYPE_A, socket.inet_pton(socket.AF_INET, address), interface=interface)
+
+
+# vim: set expandtab ts=4 sw=4:
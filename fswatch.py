@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# fswatch.py - Notice changes to individual files, using inotify.
+#
+
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os, os.path
+import errno
+import ctypes
+import ctypes.util
+import struct
+
+
+# From "/usr/include/linux/inotify.h"...
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+
+class FileWatcher(object):
+    """Notice when a file is rewritten, replaced (eg. by an editor renaming a temporary copy over it) or removed.
+
+    The directory holding the file is what's actually watched, so the file may not even exist yet
+    and its replacement is noticed too. Use "fileno()" to wait for changes in an event loop.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+        self._fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+
+        directory = os.path.dirname(self.path).encode("utf-8")
+        if _libc.inotify_add_watch(self._fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, "inotify_add_watch() failed for %s" % os.path.dirname(self.path))
+
+        self._name = os.path.basename(self.path).encode("utf-8")
+
+
+    def fileno(self):
+        return self._fd
+
+
+    def close(self):
+        os.close(self._fd)
+
+
+    def changed(self):
+        """Consume all pending events, returning whether any of them were about our file."""
+
+        changed = False
+
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return changed
+
+                raise
+
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+
+                # Events were lost, so better assume the worst...
+                if mask & IN_Q_OVERFLOW or name == self._name:
+                    changed = True
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -1,49 +1,366 @@
 #!/usr/bin/python3.7
 
+# First, so the startup timings include all the other imports
+import startup
+
 import aiohttp
 from aiohttp import web, WSCloseCode
 import asyncio
 import typing as t
 import logging
+import time
+import hashlib
+import zlib
+import re
+import socket
+import os
+import sys
+import signal
+import tempfile
+import json
+import ipaddress
+import importlib
+import select
+import weakref
+from collections import OrderedDict
+
+from getopt import getopt, GetoptError
 
-logging.basicConfig(level=logging.DEBUG)
+import logpipe
+import metrics
+from fswatch import FileWatcher
+from dnsrecords import AVAHI_DNS_TYPE_A, AVAHI_DNS_TYPE_AAAA, AVAHI_DNS_TYPE_CNAME, AVAHI_DNS_TYPE_TXT
 
 hostName = "0.0.0.0"
 serverPort = 8080
 
 CONFIG_PATH = "gatekeeper.conf"
 
+# Seconds to wait before restarting a worker that died right after starting
+WORKER_RESTART_DELAY = 1.0
+
+# Seconds to wait for all workers to be serving before reporting readiness anyway
+WORKER_READY_TIMEOUT = 10.0
+
+RECORD_NAME_RE = re.compile(r'^[a-z0-9-]{1,63}(?:\.[a-z0-9-]{1,63})*\.local$')
+
+HTTP_REQUESTS = metrics.counter("gatekeeper_http_requests_total", "HTTP requests handled.", ["route", "status"])
+HTTP_LATENCY = metrics.histogram("gatekeeper_http_request_seconds", "Time taken to answer HTTP requests.", ["route"])
+WS_CONNECTIONS = metrics.gauge("gatekeeper_websocket_connections", "Open WebSocket connections.")
+WS_MESSAGES = metrics.counter("gatekeeper_websocket_messages_total", "WebSocket messages received.", ["type"])
+WS_BROADCASTS = metrics.counter("gatekeeper_websocket_broadcasts_total", "Messages broadcast to WebSocket clients.")
+WS_COALESCED = metrics.counter("gatekeeper_websocket_coalesced_total", "Pending messages replaced by a newer one.")
+WS_DROPPED = metrics.counter("gatekeeper_websocket_dropped_total", "WebSocket clients dropped for being too slow.")
+WS_BACKLOG = metrics.gauge("gatekeeper_websocket_backlog", "Messages waiting to be sent, over all clients.")
+WS_BACKLOG_MAX = metrics.gauge("gatekeeper_websocket_backlog_max", "Messages waiting to be sent, for the most backlogged client.")
+ACCESS_DENIED = metrics.counter("gatekeeper_access_denied_total", "Requests refused by the allow/deny rules.")
+
+
+class AccessRules:
+    """Allow and deny rules for client networks, compiled into a binary prefix trie per address family.
+
+    The most specific rule matching an address decides, so looking one up takes (at most) one step
+    per address bit, however many rules there are. Addresses no rule matches are allowed, unless
+    there are allow rules (then only those networks are).
+    """
+
+    def __init__(self, rules: t.Iterable[t.Tuple[bool, str]] = ()):
+        # Trie nodes are "[zero, one, decision]" lists, for IPv4 and IPv6 (by version)
+        self.tries = {4: [None, None, None], 6: [None, None, None]}
+        self.count = 0
+        default = True
+
+        for allow, cidr in rules:
+            network = ipaddress.ip_network(cidr, strict=False)
+            value, bits = int(network.network_address), network.max_prefixlen
+            node = self.tries[network.version]
+
+            for i in range(bits - 1, bits - 1 - network.prefixlen, -1):
+                bit = (value >> i) & 1
+                if node[bit] is None:
+                    node[bit] = [None, None, None]
+                node = node[bit]
+
+            node[2] = allow
+            default = default and not allow
+            self.count += 1
+
+        for trie in self.tries.values():
+            if trie[2] is None:
+                trie[2] = default
+
+    @staticmethod
+    def parse(line: str) -> t.Optional[t.Tuple[bool, str]]:
+        """Return "(allow, cidr)" for a rule line (eg. "deny 10.0.13.0/24"), None for anything else.
+
+        Lines starting with "allow" or "deny" that aren't valid rules raise a ValueError.
+        """
+
+        fields = line.split()
+        if not fields or fields[0].lower() not in ('allow', 'deny'):
+            return None
+
+        if len(fields) != 2:
+            raise ValueError(f'expected a single network, got {len(fields) - 1}')
+
+        ipaddress.ip_network(fields[1], strict=False)
+        return fields[0].lower() == 'allow', fields[1]
+
+    def allowed(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address.split('%', 1)[0])  # ...without any IPv6 zone
+        except ValueError:
+            return self.tries[4][2] and self.tries[6][2]  # ...not an IP address (eg. a UNIX socket)
+
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+
+        value, bits = int(ip), ip.max_prefixlen
+        node = self.tries[ip.version]
+        decision = node[2]
+
+        for i in range(bits - 1, -1, -1):
+            node = node[(value >> i) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                decision = node[2]
+
+        return decision
+
+
+# Keeps everyone out, when the rules can't be trusted
+NO_ACCESS = AccessRules([(False, '0.0.0.0/0'), (False, '::/0')])
+
+
+class ConfigSnapshot(t.NamedTuple):
+    """The configuration as it was at some point, never changed afterwards."""
+
+    status: int
+    ip: t.Optional[str] = None
+    lines: t.Tuple[str, ...] = ()
+    content: t.Optional[bytes] = None
+    access: AccessRules = AccessRules()
+
+
+class ConfigStore:
+    """The configuration file, kept in memory and reloaded whenever it changes on disk.
+
+    Files are only ever touched from the default executor, so the event loop never blocks on I/O.
+    Changes are noticed with inotify (or by polling the modification time, where that's not
+    available), and every subscriber is called with the new snapshot.
+    """
 
-class ConfigReader:
     STATUS_READ_SUCCESSFULLY = 0
     STATUS_NOT_FOUND = 1
     STATUS_EMPTY = 2
     STATUS_CAN_NOT_CREATE = 3
 
-    def __init__(self):
-        try:
-            with open(CONFIG_PATH, 'r') as f:
-                self.__ip = f.readline()
-                if self.__ip is None or self.__ip == '':
-                    self.__ip = None
-                    self.__status = ConfigReader.STATUS_EMPTY
-                else:
-                    self.__status = ConfigReader.STATUS_READ_SUCCESSFULLY
-        except FileNotFoundError as e:
-            self.__ip = None
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, path=CONFIG_PATH):
+        self.path = os.path.abspath(path)
+        self.__snapshot = ConfigSnapshot(ConfigStore.STATUS_NOT_FOUND)
+        self.__subscribers = []
+        self.__watcher = None
+        self.__poller = None
+        self.__mtime = None
+        self.__reloading = None
+        self.__pending = False
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        return self.__snapshot
+
+    def status(self):
+        return self.__snapshot.status
+
+    def ip(self):
+        return self.__snapshot.ip
+
+    def subscribe(self, callback: t.Callable[[ConfigSnapshot], t.Any]):
+        """Call "callback" with each new snapshot (coroutine functions are run as tasks), returns an unsubscriber."""
+
+        self.__subscribers.append(callback)
+        return lambda: self.__subscribers.remove(callback)
+
+    async def start(self):
+        """Load the configuration (creating an empty file if there's none) and start watching it."""
+
+        await self.reload()
+
+        if self.__snapshot.status == ConfigStore.STATUS_NOT_FOUND:
             try:
-                with open(CONFIG_PATH, 'w') as f:
-                    f.write('')
-                self.__status = ConfigReader.STATUS_NOT_FOUND
+                await asyncio.get_event_loop().run_in_executor(None, self.__write, '')
+                self.__publish(ConfigSnapshot(ConfigStore.STATUS_NOT_FOUND, content=b''))
             except PermissionError:
-                self.__status = ConfigReader.STATUS_CAN_NOT_CREATE
+                self.__publish(ConfigSnapshot(ConfigStore.STATUS_CAN_NOT_CREATE))
 
-    def status(self):
-        return self.__status
+        loop = asyncio.get_event_loop()
+
+        try:
+            self.__watcher = FileWatcher(self.path)
+            loop.add_reader(self.__watcher.fileno(), self.__file_changed)
+        except (OSError, AttributeError) as e:  # No inotify here
+            logging.warning('Polling %s for changes (%s)', self.path, e)
+            self.__poller = loop.call_later(ConfigStore.POLL_INTERVAL, self.__poll)
+
+    async def stop(self):
+        if self.__watcher is not None:
+            asyncio.get_event_loop().remove_reader(self.__watcher.fileno())
+            self.__watcher.close()
+            self.__watcher = None
+
+        if self.__poller is not None:
+            self.__poller.cancel()
+            self.__poller = None
+
+    async def reload(self):
+        """Read the file again, notifying subscribers if anything changed."""
+
+        # Changes arriving during a reload make for one more reload afterwards, not one each
+        if self.__reloading is not None:
+            self.__pending = True
+            return await self.__reloading
+
+        self.__reloading = asyncio.get_event_loop().create_future()
+
+        try:
+            while True:
+                self.__pending = False
+                snapshot = await asyncio.get_event_loop().run_in_executor(None, self.__read)
+
+                if snapshot is not None and snapshot.content != self.__snapshot.content:
+                    self.__publish(snapshot)
+
+                if not self.__pending:
+                    break
+        finally:
+            self.__reloading.set_result(None)
+            self.__reloading = None
+
+    async def write(self, content: str):
+        """Replace the file atomically (readers see either the old or the new one), then reload it."""
+
+        await asyncio.get_event_loop().run_in_executor(None, self.__write, content)
+        await self.reload()
+
+    def __read(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.__mtime = os.fstat(f.fileno()).st_mtime_ns
+                content = f.read()
+        except FileNotFoundError:
+            self.__mtime = None
+
+            # Someone deleted it, which is as good as empty
+            return ConfigSnapshot(ConfigStore.STATUS_NOT_FOUND)
+        except OSError as e:
+            logging.error('Unable to read %s: %s', self.path, e.strerror)
+            return None
+
+        lines = tuple(line.strip() for line in content.decode('utf-8', 'replace').splitlines())
+        values = []
+        rules = []
+        malformed = False
+
+        # "allow <cidr>" and "deny <cidr>" lines are access rules, the first other line is the IP
+        for line in lines:
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                rule = AccessRules.parse(line)
+            except ValueError as e:
+                logging.error('Malformed rule in %s (%s): %s', self.path, e, line)
+                malformed = True
+                continue
+
+            if rule is None:
+                values.append(line)
+            else:
+                rules.append(rule)
+
+        # Compiled here, so the new rules replace the old ones all at once along with the snapshot.
+        # Skipping a bad rule could let in someone it was meant to keep out, so the rules in force stay
+        # (and with none read yet, everyone is kept out until the file is fixed).
+        if not malformed:
+            access = AccessRules(rules)
+        elif self.__snapshot.content is not None:
+            logging.error('Keeping the previous access rules')
+            access = self.__snapshot.access
+        else:
+            logging.error('Denying all access until the rules are fixed')
+            access = NO_ACCESS
+
+        if not values:
+            return ConfigSnapshot(ConfigStore.STATUS_EMPTY, None, lines, content, access)
+
+        return ConfigSnapshot(ConfigStore.STATUS_READ_SUCCESSFULLY, values[0], lines, content, access)
+
+    def __write(self, content: str):
+        directory = os.path.dirname(self.path)
+        fd, temporary = tempfile.mkstemp(prefix='.gatekeeper.', dir=directory)
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, self.path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def __publish(self, snapshot: ConfigSnapshot):
+        old, self.__snapshot = self.__snapshot, snapshot
+
+        if old.status != snapshot.status or old.ip != snapshot.ip:
+            logging.info('Configuration changed: status %d, IP %s', snapshot.status, snapshot.ip)
+
+        for callback in list(self.__subscribers):
+            try:
+                result = callback(snapshot)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception:
+                logging.exception('Configuration subscriber failed')
+
+    def __file_changed(self):
+        if self.__watcher.changed():
+            asyncio.ensure_future(self.reload())
+
+    def __poll(self):
+        async def check():
+            try:
+                mtime = await asyncio.get_event_loop().run_in_executor(None, lambda: os.stat(self.path).st_mtime_ns)
+            except OSError:
+                mtime = None
+
+            if mtime != self.__mtime:
+                await self.reload()
+
+            if self.__poller is not None:
+                self.__poller = asyncio.get_event_loop().call_later(ConfigStore.POLL_INTERVAL, self.__poll)
+
+        asyncio.ensure_future(check())
 
 
 # Globals
-configReader: ConfigReader
+configStore: ConfigStore
+pageCache: 'PageCache'
+broadcaster: 'Broadcaster'
+serverRunner: web.AppRunner
+recordBatcher: t.Optional['RecordBatcher'] = None
+recordBatcherConnecting: t.Optional[asyncio.Future] = None
+
+# Published records live in the process publishing them, several workers would each have their own
+recordsEnabled = True
+
+# Brotli (compression) and the D-Bus and Avahi bindings (managing records) are optional
+optionalModules: t.Dict[str, t.Any] = {}
 
 HTML_DOCTYPE = '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">'
 HTML_META = '<meta http-equiv="Content-Type" content="text/html;charset=utf-8">'
@@ -53,7 +370,7 @@ h1 { text-size: 200%; }
 '''
 
 
-def get_no_permission_page(request: aiohttp.web.Request):
+def get_no_permission_page():
     response = f'''{HTML_DOCTYPE}
     <html>
         <head>
@@ -71,10 +388,7 @@ def get_no_permission_page(request: aiohttp.web.Request):
     return response
 
 
-def get_welcome_page(request: aiohttp.web.Request):
-    # A bit of magic
-    server_ip = request.transport._sock.getsockname()[0]
-
+def get_welcome_page(server_ip: str):
     response = f'''{HTML_DOCTYPE}
     <html>
         <head>
@@ -92,69 +406,862 @@ def get_welcome_page(request: aiohttp.web.Request):
     return response
 
 
-async def http_handler(request: aiohttp.web.Request):
-    if configReader.status() == ConfigReader.STATUS_CAN_NOT_CREATE:
-        page = get_no_permission_page(request)
-    elif configReader.status() == ConfigReader.STATUS_NOT_FOUND or configReader.status() == ConfigReader.STATUS_EMPTY:
-        page = get_welcome_page(request)
+def render_page(status: int, server_ip: t.Optional[str]):
+    if status == ConfigStore.STATUS_CAN_NOT_CREATE:
+        return get_no_permission_page()
+    elif status in (ConfigStore.STATUS_NOT_FOUND, ConfigStore.STATUS_EMPTY):
+        return get_welcome_page(server_ip)
     else:
-        page = "Done"
+        return "Done"
+
+
+def optional_import(name: str):
+    """Import module "name" when first needed (keeping it off the startup path), or None if not installed."""
+
+    if name not in optionalModules:
+        try:
+            optionalModules[name] = importlib.import_module(name)
+        except ImportError:
+            optionalModules[name] = None
+
+    return optionalModules[name]
+
+
+def gzip_compress(data: bytes):
+    # Python 3.7 has no "mtime" for gzip.compress(), and a fixed one keeps the output (and ETag) stable
+    compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CachedPage:
+    """A page encoded once, in every content encoding we serve, each with its own ETag."""
+
+    def __init__(self, text: str):
+        body = text.encode('utf-8')
+        digest = hashlib.sha1(body).hexdigest()[:20]
+
+        self.variants = {'identity': (body, f'"{digest}"')}
+
+        # Only worth it when the result is actually smaller
+        encoded = {'gzip': gzip_compress(body)}
+        brotli = optional_import('brotli')
+        if brotli is not None:
+            encoded['br'] = brotli.compress(body, quality=11)
+
+        for encoding, data in encoded.items():
+            if len(data) < len(body):
+                self.variants[encoding] = (data, f'"{digest}-{encoding}"')
+
+    def select(self, accept_encoding: str):
+        """Return the (encoding, body, etag) of the smallest variant the client accepts."""
+
+        accepted = set()
+        for item in accept_encoding.split(','):
+            coding, _, params = item.strip().lower().partition(';')
+            if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                accepted.add(coding.strip())
+
+        best = 'identity'
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and (encoding in accepted or '*' in accepted):
+                best = encoding
+                break
+
+        body, etag = self.variants[best]
+        return best, body, etag
+
+
+class PageCache:
+    """Rendered pages by (config status, server IP), dropped all at once when the config status changes."""
+
+    def __init__(self):
+        self.__status = None
+        self.__pages = {}
+
+    def invalidate(self):
+        self.__status = None
+        self.__pages = {}
+
+    def get(self, status: int, server_ip: t.Optional[str]):
+        if status != self.__status:
+            self.invalidate()
+            self.__status = status
+
+        # Only the welcome page shows the server IP, the others are shared by all addresses
+        if status not in (ConfigStore.STATUS_NOT_FOUND, ConfigStore.STATUS_EMPTY):
+            server_ip = None
+
+        page = self.__pages.get(server_ip)
+        if page is None:
+            page = self.__pages[server_ip] = CachedPage(render_page(status, server_ip))
+
+        return page
+
+
+def etag_matches(if_none_match: str, etag: str):
+    if if_none_match.strip() == '*':
+        return True
+
+    # Weak comparison, as required for If-None-Match (RFC 7232, section 3.2)
+    tags = (tag.strip() for tag in if_none_match.split(','))
+    return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+
+async def http_handler(request: aiohttp.web.Request):
+    status = configStore.status()
+
+    # A bit of magic
+    server_ip = request.transport.get_extra_info('sockname')[0]
 
-    return  web.Response(
-        text=page,
+    page = pageCache.get(status, server_ip)
+    encoding, body, etag = page.select(request.headers.get('Accept-Encoding', ''))
+
+    headers = {
+        "Content-type": "text/html",
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        # The page changes with the configuration, so clients must always check back
+        "Cache-Control": "no-cache",
+    }
+
+    if etag_matches(request.headers.get('If-None-Match', ''), etag):
+        return web.Response(status=304, headers=headers)
+
+    if encoding != 'identity':
+        headers["Content-Encoding"] = encoding
+
+    return web.Response(
+        body=body,
+        status=200,
+        headers=headers
+    )
+
+
+async def metrics_handler(request: aiohttp.web.Request):
+    _, backlog, backlog_max = broadcaster.stats()
+    WS_BACKLOG.set(backlog)
+    WS_BACKLOG_MAX.set(backlog_max)
+
+    return web.Response(
+        body=metrics.render().encode('utf-8'),
         status=200,
-        headers={"Content-type": "text/html"}
+        headers={"Content-type": metrics.CONTENT_TYPE}
     )
 
 
+# The decision for each connection, along with the rules it was made with
+accessDecisions: 'weakref.WeakKeyDictionary[asyncio.BaseTransport, t.Tuple[AccessRules, bool]]' = weakref.WeakKeyDictionary()
+
+
+@web.middleware
+async def access_middleware(request: aiohttp.web.Request, handler):
+    access = configStore.snapshot.access
+    transport = request.transport
+
+    if transport is None:  # The client is gone already
+        raise web.HTTPForbidden()
+
+    # Keep-alive requests on the same connection reuse the decision, until the rules change
+    cached = accessDecisions.get(transport)
+    if cached is not None and cached[0] is access:
+        allowed = cached[1]
+    else:
+        peer = transport.get_extra_info('peername')
+        if not isinstance(peer, tuple):  # Only TCP is served, so the client is gone already
+            raise web.HTTPForbidden()
+
+        address = peer[0]
+        allowed = access.allowed(address)
+        accessDecisions[transport] = (access, allowed)
+
+        if not allowed:
+            logging.warning('Refusing requests from %s', address)
+
+    if not allowed:
+        ACCESS_DENIED.inc()
+        raise web.HTTPForbidden(text='Access denied\n')
+
+    return await handler(request)
+
+
+@web.middleware
+async def metrics_middleware(request: aiohttp.web.Request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    start = time.perf_counter()
+    status = 500
+
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_REQUESTS.labels(route, str(status)).inc()
+
+        # WebSocket "requests" last as long as the connection, which says nothing about latency
+        if status != 101:
+            HTTP_LATENCY.labels(route).observe(time.perf_counter() - start)
+
+
+class BroadcastClient:
+    """A single WebSocket connection, with the messages still waiting to be sent to it."""
+
+    def __init__(self, ws: web.WebSocketResponse):
+        self.ws = ws
+        # Only the latest message on each topic matters, older ones are replaced (in place)
+        self.pending: 'OrderedDict[str, str]' = OrderedDict()
+        self.ready = asyncio.Event()
+        self.task: t.Optional[asyncio.Task] = None
+
+
+class Broadcaster:
+    """Push state changes to every connected WebSocket client.
+
+    Each message is serialized once, whatever the number of clients. Clients get their own queue of
+    pending messages, where a newer message on some topic replaces the one still pending, so it never
+    holds more than one message per topic. Clients taking too long to accept a message are disconnected,
+    so nobody waits on them.
+    """
+
+    SEND_TIMEOUT = 10.0
+
+    def __init__(self):
+        self.__clients: t.Dict[web.WebSocketResponse, BroadcastClient] = {}
+        self.__last: 'OrderedDict[str, str]' = OrderedDict()
+
+    def __len__(self):
+        return len(self.__clients)
+
+    def add(self, ws: web.WebSocketResponse):
+        """Start sending to "ws", beginning with the latest message on each topic."""
+
+        client = self.__clients[ws] = BroadcastClient(ws)
+        client.pending.update(self.__last)
+        client.ready.set()
+        client.task = asyncio.ensure_future(self.__sender(client))
+
+    def remove(self, ws: web.WebSocketResponse):
+        client = self.__clients.pop(ws, None)
+
+        if client is not None and client.task is not asyncio.current_task():
+            client.task.cancel()
+
+    def publish(self, topic: str, payload: t.Dict[str, t.Any]):
+        """Send "payload" (as JSON, with its topic as "type") to all clients."""
+
+        message = json.dumps(dict(payload, type=topic))
+        self.__last[topic] = message
+        WS_BROADCASTS.inc()
+
+        for client in list(self.__clients.values()):
+            if topic in client.pending:
+                WS_COALESCED.inc()
+
+            client.pending[topic] = message
+            client.ready.set()
+
+    def stats(self):
+        """Return the number of clients, and how many messages are waiting for them (in total, and at most)."""
+
+        backlogs = [len(client.pending) for client in self.__clients.values()]
+        return len(backlogs), sum(backlogs), max(backlogs, default=0)
+
+    async def close(self):
+        for ws in list(self.__clients):
+            self.remove(ws)
+            await ws.close(code=WSCloseCode.GOING_AWAY, message=b'Server shutdown')
+
+    def __drop(self, client: BroadcastClient, reason: str):
+        logging.warning('Dropping WebSocket client: %s', reason)
+        WS_DROPPED.inc()
+
+        self.remove(client.ws)
+        asyncio.ensure_future(client.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b'Too slow'))
+
+    async def __sender(self, client: BroadcastClient):
+        try:
+            while True:
+                await client.ready.wait()
+                client.ready.clear()
+
+                while client.pending:
+                    _, message = client.pending.popitem(last=False)
+                    await asyncio.wait_for(client.ws.send_str(message), Broadcaster.SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.__drop(client, 'send timed out')
+        except ConnectionError:
+            self.remove(client.ws)
+
+
 async def websocket_handler(request):
-    ws = web.WebSocketResponse()
+    # Idle clients get pinged, and those not answering are disconnected
+    ws = web.WebSocketResponse(heartbeat=30.0)
     await ws.prepare(request)
+    WS_CONNECTIONS.inc()
+    broadcaster.add(ws)
 
-    async for msg in ws:
-        if msg.type == aiohttp.WSMsgType.TEXT:
-            if msg.data == 'close':
-                await ws.close()
-            else:
-                await ws.send_str('some websocket message payload')
-        elif msg.type == aiohttp.WSMsgType.ERROR:
-            print('ws connection closed with exception %s' % ws.exception())
+    try:
+        async for msg in ws:
+            WS_MESSAGES.labels(msg.type.name.lower()).inc()
+
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                if msg.data == 'close':
+                    await ws.close()
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                print('ws connection closed with exception %s' % ws.exception())
+    finally:
+        broadcaster.remove(ws)
+        WS_CONNECTIONS.dec()
 
     return ws
 
 
+def publish_config(snapshot: ConfigSnapshot):
+    broadcaster.publish('config', {'status': snapshot.status, 'ip': snapshot.ip})
+
+
+class RecordBatcher:
+    """Apply record changes from many concurrent requests to Avahi together, in as few D-Bus operations as possible.
+
+    Changes wait a few milliseconds for others to join them, then removals and names published again
+    are applied with a single "reconcile()" (which replaces records in place where it can), and new
+    names with a single "publish_many()" (for each "force" setting). Each name gets its own future,
+    so results can be reported as soon as they are known.
+    """
+
+    BATCH_DELAY = 0.005
+    MAX_BATCH = 4096
+
+    def __init__(self, publisher: 'AsyncAvahiPublisher'):
+        self.publisher = publisher
+        self.__additions: t.List[t.Tuple[t.List[t.Any], bool, asyncio.Future]] = []
+        self.__removals: t.List[t.Tuple[str, asyncio.Future]] = []
+        self.__flush: t.Optional[asyncio.Task] = None
+        self.__ready = asyncio.Event()
+        self.__lock = asyncio.Lock()
+
+    def publish(self, records, force=False) -> t.Dict[str, asyncio.Future]:
+        """Queue records for publishing, returning a future (for success) for each name."""
+
+        by_name: t.Dict[str, t.List[t.Any]] = {}
+        for record in records:
+            by_name.setdefault(record.name, []).append(record)
+
+        futures = {}
+        for name, name_records in by_name.items():
+            futures[name] = asyncio.get_event_loop().create_future()
+            self.__additions.append((name_records, force, futures[name]))
+
+        self.__schedule()
+        return futures
+
+    def unpublish(self, name: str) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        self.__removals.append((name, future))
+        self.__schedule()
+        return future
+
+    def __schedule(self):
+        if len(self.__additions) + len(self.__removals) >= RecordBatcher.MAX_BATCH:
+            self.__ready.set()
+
+        if self.__flush is None:
+            self.__flush = asyncio.ensure_future(self.__run())
+
+    async def __run(self):
+        try:
+            await asyncio.wait_for(self.__ready.wait(), RecordBatcher.BATCH_DELAY)
+        except asyncio.TimeoutError:
+            pass
+
+        # Whatever arrives from now on makes it into the next batch
+        self.__ready.clear()
+        self.__flush = None
+        additions, self.__additions = self.__additions, []
+        removals, self.__removals = self.__removals, []
+
+        # Batches are applied one at a time, as they all change the same publisher
+        async with self.__lock:
+            try:
+                await self.__apply(additions, removals)
+            except Exception as e:
+                logging.error('Unable to apply record changes: %s', e)
+                for future in [f for _, _, f in additions] + [f for _, f in removals]:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def __apply(self, additions, removals):
+        current = self.publisher.records()
+
+        # Names being published again get their records replaced in place, so they never stop resolving
+        desired = dict(current)
+        for name, _ in removals:
+            desired.pop(name, None)
+
+        replaced = {}
+        forced = {}
+        for records, force, _ in additions:
+            name = records[0].name
+            if name in desired:
+                desired[name] = replaced[name] = records
+                forced[name] = forced.get(name, True) and force
+
+        # Unless every request for a name asked for force, its new records must pass the checks too
+        results = {}
+        unchecked = [name for name in replaced if not forced[name]]
+        if unchecked:
+            free = set(await self.publisher.check_many(unchecked))
+            for name in unchecked:
+                if name not in free:
+                    desired[name] = current[name]
+                    del replaced[name]
+                    results[name] = False
+
+        if len(desired) != len(current) or replaced:
+            results.update(await self.publisher.reconcile([r for records in desired.values() for r in records], True))
+
+        # The previous records are better than none, when the new ones couldn't be published
+        lost = [name for name in replaced if not results.get(name, True)]
+        if lost:
+            logging.warning(f'Restoring the previous records for {len(lost)} names')
+            await self.publisher.publish_many([record for name in lost for record in current[name]], True)
+
+        for name, future in removals:
+            future.set_result(name in current and name not in desired)
+
+        for force in (True, False):
+            batch = [(records, future) for records, f, future in additions
+                     if f == force and records[0].name not in replaced and records[0].name not in results]
+            if not batch:
+                continue
+
+            results.update(await self.publisher.publish_many([record for records, _ in batch for record in records], force))
+
+        for records, _, future in additions:
+            future.set_result(results.get(records[0].name, records[0].name in replaced))
+
+        broadcaster.publish('records', {'names': sorted(self.publisher.published)})
+
+
+def record_from_json(item) -> t.Any:
+    """Build a record from its JSON form, eg. {"name": "foo.local", "type": "cname"}."""
+
+    if not isinstance(item, dict):
+        raise ValueError('records must be objects')
+
+    name = str(item.get('name', '')).strip().lower()
+    kind = str(item.get('type', 'cname')).lower()
+
+    if not RECORD_NAME_RE.match(name):
+        raise ValueError(f'malformed name: {name!r}')
+
+    if kind == 'cname':
+        return recordBatcher.publisher.cname_record(name)
+    elif kind in ('a', 'aaaa', 'address'):
+        try:
+            record = recordBatcher.publisher.address_record(name, str(item['address']))
+        except (KeyError, OSError):
+            raise ValueError(f'missing or malformed address for {name}')
+
+        # The family is picked from the address itself, it must be the one asked for
+        if kind != 'address' and record.type != (AVAHI_DNS_TYPE_A if kind == 'a' else AVAHI_DNS_TYPE_AAAA):
+            raise ValueError(f'not an {"IPv4" if kind == "a" else "IPv6"} address for {name}')
+
+        return record
+    elif kind == 'txt':
+        txt = item.get('txt', ())
+
+        # A single string would become one TXT string per character
+        if isinstance(txt, dict):
+            valid = all(isinstance(value, (str, int, float)) for value in txt.values())
+        else:
+            valid = isinstance(txt, (list, tuple)) and all(isinstance(value, str) for value in txt)
+
+        if not valid:
+            raise ValueError(f'TXT data for {name} must be a list of strings or an object')
+
+        return recordBatcher.publisher.txt_record(name, txt)
+
+    raise ValueError(f'unknown record type: {kind}')
+
+
+def record_to_json(record) -> t.Dict[str, t.Any]:
+    if record.type == AVAHI_DNS_TYPE_CNAME:
+        labels, offset = [], 0
+        while record.rdata[offset]:
+            labels.append(record.rdata[offset + 1:offset + 1 + record.rdata[offset]].decode('ascii'))
+            offset += 1 + record.rdata[offset]
+        return {'name': record.name, 'type': 'cname', 'target': '.'.join(labels)}
+    elif record.type == AVAHI_DNS_TYPE_A:
+        return {'name': record.name, 'type': 'a', 'address': socket.inet_ntop(socket.AF_INET, record.rdata)}
+    elif record.type == AVAHI_DNS_TYPE_AAAA:
+        return {'name': record.name, 'type': 'aaaa', 'address': socket.inet_ntop(socket.AF_INET6, record.rdata)}
+    elif record.type == AVAHI_DNS_TYPE_TXT:
+        strings, offset = [], 0
+        while offset < len(record.rdata):
+            strings.append(record.rdata[offset + 1:offset + 1 + record.rdata[offset]].decode('utf-8', 'replace'))
+            offset += 1 + record.rdata[offset]
+        return {'name': record.name, 'type': 'txt', 'txt': strings}
+
+    return {'name': record.name, 'type': record.type}
+
+
+async def get_record_batcher() -> 'RecordBatcher':
+    global recordBatcher, recordBatcherConnecting
+
+    if not recordsEnabled:
+        raise web.HTTPServiceUnavailable(text='Records can only be managed when running a single worker')
+
+    aiopublisher = optional_import('aiopublisher')
+    if aiopublisher is None:
+        raise web.HTTPServiceUnavailable(text='Avahi/D-Bus bindings are not installed')
+
+    dbus = optional_import('dbus')
+
+    # Concurrent first requests must all end up with the same publisher
+    if recordBatcher is None:
+        if recordBatcherConnecting is None:
+            recordBatcherConnecting = asyncio.ensure_future(aiopublisher.AsyncAvahiPublisher.create())
+
+        try:
+            publisher = await asyncio.shield(recordBatcherConnecting)
+        except dbus.exceptions.DBusException as e:
+            recordBatcherConnecting = None
+            raise web.HTTPServiceUnavailable(text=f'Avahi is not available: {e.get_dbus_name()}')
+
+        if recordBatcher is None:
+            recordBatcher = RecordBatcher(publisher)
+
+    return recordBatcher
+
+
+async def records_get_handler(request: aiohttp.web.Request):
+    batcher = await get_record_batcher()
+    records = batcher.publisher.records()
+
+    return web.json_response({
+        'hostname': batcher.publisher.hostname,
+        'records': [record_to_json(record) for name in sorted(records) for record in records[name]],
+    })
+
+
+async def records_post_handler(request: aiohttp.web.Request):
+    """Publish a batch of records, streaming back one JSON line per name as soon as it is settled."""
+
+    batcher = await get_record_batcher()
+
+    try:
+        body = await request.json()
+        items = body.get('records', []) if isinstance(body, dict) else body
+        force = bool(body.get('force', False)) if isinstance(body, dict) else False
+        records = [record_from_json(item) for item in items]
+    except (ValueError, AttributeError, TypeError) as e:
+        raise web.HTTPBadRequest(text=f'Invalid request: {e}')
+
+    futures = batcher.publish(records, force)
+
+    response = web.StreamResponse(headers={'Content-type': 'application/x-ndjson'})
+    await response.prepare(request)
+
+    async def settle(name, future):
+        try:
+            return {'name': name, 'published': await future}
+        except Exception as e:
+            return {'name': name, 'published': False, 'error': str(e)}
+
+    for result in asyncio.as_completed([settle(name, future) for name, future in futures.items()]):
+        await response.write((json.dumps(await result) + '\n').encode('utf-8'))
+
+    await response.write_eof()
+    return response
+
+
+async def records_delete_handler(request: aiohttp.web.Request):
+    batcher = await get_record_batcher()
+    dbus = optional_import('dbus')
+    name = request.match_info['name'].lower()
+
+    if name not in batcher.publisher.published:
+        raise web.HTTPNotFound(text=f'Not published: {name}')
+
+    try:
+        await batcher.unpublish(name)
+    except dbus.exceptions.DBusException as e:
+        raise web.HTTPBadGateway(text=f'Unable to unpublish {name}: {e.get_dbus_name()}')
+
+    return web.json_response({'name': name, 'published': False})
+
+
 def create_runner():
-    app = web.Application()
+    app = web.Application(middlewares=[metrics_middleware, access_middleware])
     app.add_routes([
-        web.get('/',   http_handler),
-        web.get('/ws', websocket_handler),
+        web.get('/',        http_handler),
+        web.get('/ws',      websocket_handler),
+        web.get('/metrics', metrics_handler),
+
+        web.get('/records',           records_get_handler),
+        web.post('/records',          records_post_handler),
+        web.delete('/records/{name}', records_delete_handler),
     ])
     return web.AppRunner(app)
 
 
-async def start_server(host=hostName, port=serverPort):
-    global configReader
-    configReader = ConfigReader()
+async def start_server(host=hostName, port=serverPort, reuse_port=False, sock: t.Optional[socket.socket] = None):
+    """Start serving on "host" and "port", or on "sock" when given one already listening (eg. by systemd)."""
+
+    global configStore, pageCache, broadcaster, serverRunner
+    configStore = ConfigStore()
+    pageCache = PageCache()
+    broadcaster = Broadcaster()
+
+    configStore.subscribe(lambda snapshot: pageCache.invalidate())
+    configStore.subscribe(publish_config)
+    await configStore.start()
+    startup.mark('config')
+
+    serverRunner = create_runner()
+    await serverRunner.setup()
+
+    if sock is not None:
+        site = web.SockSite(serverRunner, sock)
+    else:
+        site = web.TCPSite(serverRunner, host, port, reuse_port=reuse_port)
 
-    runner = create_runner()
-    await runner.setup()
-    site = web.TCPSite(runner, host, port)
     await site.start()
-    logging.info('Serving on http://%s:%s' % site._server.sockets[0].getsockname())
+    startup.mark('listening')
+    logging.info('Serving on http://%s:%s' % site._server.sockets[0].getsockname()[:2])
     return site
 
 
 async def stop_server(site: web.TCPSite):
-    await site.stop()
+    await configStore.stop()
+    await broadcaster.close()
+
+    if recordBatcher is not None:
+        await recordBatcher.publisher.reset()
+
+    # Stops listening, then waits for the requests already being handled
+    await serverRunner.cleanup()
     logging.log(logging.INFO, "Server stopped")
 
-if __name__ == "__main__":
+
+async def serve(host=hostName, port=serverPort, reuse_port=False, stop_signals=(signal.SIGTERM, signal.SIGINT),
+                sock: t.Optional[socket.socket] = None, ready: t.Optional[t.Callable[[], t.Any]] = None):
     loop = asyncio.get_event_loop()
-    site = loop.run_until_complete(start_server())
+    stopping = asyncio.Event()
+
+    for signum in stop_signals:
+        loop.add_signal_handler(signum, stopping.set)
+
+    site = await start_server(host, port, reuse_port, sock)
+
+    if ready is not None:
+        ready()
+
+    await stopping.wait()
+    await stop_server(site)
+
+
+def run_worker(host, port, sock: t.Optional[socket.socket] = None, ready: t.Optional[int] = None):
+    """Serve until told to stop, on a port shared with the other workers (or "sock", when inherited).
+
+    Once serving, a byte is written into "ready" (a pipe to the master) if there is one.
+    """
+
+    # Ctrl-C reaches the whole process group, but only the master decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def serving():
+        os.write(ready, b'.')
+        os.close(ready)
+
+    status = 0
 
     try:
-        loop.run_forever()
-    except KeyboardInterrupt:
-        pass
+        asyncio.new_event_loop().run_until_complete(serve(host, port, sock is None, (signal.SIGTERM,), sock,
+                                                          serving if ready is not None else None))
+    except BaseException:
+        logging.exception('Worker %d failed', os.getpid())
+        status = 1
+
+    # Nothing runs at exit after a fork, so queued log lines must be written now
+    logpipe.stop()
+    os._exit(status)
+
+
+def wait_for_workers(ready: int, count: int):
+    """Wait (up to "WORKER_READY_TIMEOUT") for "count" workers to write into the "ready" pipe, returning how many did."""
+
+    deadline = time.monotonic() + WORKER_READY_TIMEOUT
+    serving = 0
+
+    while serving < count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([ready], [], [], remaining)[0]:
+            break
+
+        data = os.read(ready, count)
+        if not data:  # All of them are gone already
+            break
+
+        serving += len(data)
+
+    os.close(ready)
+    return serving
+
+
+def run_workers(count: int, host=hostName, port=serverPort, sock: t.Optional[socket.socket] = None):
+    """Fork "count" workers sharing the listening port, restarting them if they die until told to stop.
+
+    The configuration file is what workers share: each one watches it on its own, and changes
+    written by any of them reach all the others that way. Given "sock" (eg. by systemd), workers
+    accept connections on it instead, so none are lost when a worker dies with some still queued.
+    """
+
+    workers: t.Dict[int, float] = {}
+    stopping = False
 
-    loop.run_until_complete(stop_server(site))
+    # Only the first workers report being ready, restarted ones are just replacements
+    ready_read, ready_write = os.pipe()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            if ready_write is not None:
+                os.close(ready_read)
+            run_worker(host, port, sock, ready_write)
+
+        workers[pid] = time.monotonic()
+        logging.info('Started worker %d', pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(count):
+        spawn()
+
+    os.close(ready_write)
+    ready_write = None
+
+    serving = wait_for_workers(ready_read, count)
+    if serving < count:
+        logging.warning('Only %d of %d workers serving', serving, count)
+
+    startup.mark('workers')
+    startup.report()
+    startup.notify('READY=1', f'STATUS=Serving with {serving} workers')
+
+    while workers:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except ChildProcessError:
+            break
+
+        started = workers.pop(pid, None)
+        if started is None:
+            continue
+
+        if stopping:
+            logging.info('Worker %d stopped', pid)
+            continue
+
+        if os.WIFSIGNALED(status):
+            logging.error('Worker %d killed by signal %d, restarting it', pid, os.WTERMSIG(status))
+        else:
+            logging.error('Worker %d exited with status %d, restarting it', pid, os.WEXITSTATUS(status))
+
+        # Don't fork in a tight loop when workers die as soon as they start
+        if time.monotonic() - started < WORKER_RESTART_DELAY:
+            time.sleep(WORKER_RESTART_DELAY)
+
+        if not stopping:
+            spawn()
+
+    logging.info('All workers stopped')
+
+
+def setup_logging(verbose=False, sample=1.0):
+    """Log through a background thread, so a slow terminal or disk never holds up requests."""
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logpipe.setup(handler, logging.DEBUG if verbose else logging.INFO)
+
+    # One line per request adds up, keep only a sample of them if asked to
+    logging.getLogger('aiohttp.access').addFilter(logpipe.SamplingFilter(sample))
+
+
+def main():
+    global recordsEnabled
+    usage = 'USAGE: %s [-w <workers>] [-s <fraction>] [-v]' % os.path.basename(sys.argv[0])
+
+    try:
+        options, args = getopt(sys.argv[1:], 'w:s:vh', ['workers=', 'sample=', 'verbose', 'help'])
+    except GetoptError as e:
+        print('error: %s.' % e, file=sys.stderr)
+        print(usage, file=sys.stderr)
+        sys.exit(1)
+
+    workers = 0
+    sample = 1.0
+    verbose = False
+
+    for option, value in options:
+        if option in ('-h', '--help'):
+            print(usage)
+            sys.exit(1)
+        elif option in ('-w', '--workers'):
+            workers = int(value)
+        elif option in ('-s', '--sample'):
+            sample = float(value)
+        elif option in ('-v', '--verbose'):
+            verbose = True
+
+    setup_logging(verbose, sample)
+    startup.mark('imports')
+
+    # Already listening when passed by systemd, connections wait in the kernel while (re)starting.
+    # Clients and the server itself are told apart by IP address, so only TCP sockets will do.
+    sockets = startup.listen_fds()
+    usable = [s for s in sockets if s.family in (socket.AF_INET, socket.AF_INET6) and s.type == socket.SOCK_STREAM]
+
+    if sockets and not usable:
+        logging.error('None of the sockets passed by the service manager is a TCP socket')
+        sys.exit(1)
+
+    sock = usable[0] if usable else None
+
+    if sock is not None:
+        logging.info('Using the socket passed by the service manager (%s)', sock.getsockname())
+        if len(sockets) > 1:
+            logging.warning('Ignoring the other %d sockets passed', len(sockets) - 1)
+
+    if workers > 1:
+        recordsEnabled = False
+        logging.info('Managing records is disabled with %d workers', workers)
+
+    if workers > 0:
+        run_workers(workers, sock=sock)
+    else:
+        def ready():
+            startup.report()
+            startup.notify('READY=1', 'STATUS=Serving')
+
+        asyncio.get_event_loop().run_until_complete(serve(sock=sock, ready=ready))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# journal.py - Remember the names this host owned (and when that was last confirmed) across restarts.
+#
+
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os, os.path
+import binascii
+import hashlib
+import logging
+import time
+
+
+# How long ownership is trusted without checking again, in seconds...
+DEFAULT_MAX_AGE = 600
+
+
+def digest(records):
+    """Return a short digest of the data in "records" (in any order), telling whether it changed."""
+
+    h = hashlib.sha1()
+
+    for rtype, rdata in sorted((record.type, bytes(record.rdata)) for record in records):
+        h.update(b"%d %d " % (rtype, len(rdata)) + rdata)
+
+    return binascii.hexlify(h.digest()[:8]).decode("ascii")
+
+
+class OwnershipJournal(object):
+    """The names this host published without colliding with anyone, kept in a file.
+
+    Each line holds a name, the host name it was published for, when it was last confirmed as
+    ours (in seconds since the epoch) and a digest of its records. Names confirmed less than
+    "max_age" seconds ago, for the same host name and the same records (eg. the same addresses),
+    may be published again without checking the network for them first.
+    """
+
+    def __init__(self, path, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+
+        # Name -> (host name, confirmation time, records digest)...
+        self.entries = {}
+
+        self._load()
+
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+        except (IOError, OSError) as e:
+            if not os.path.exists(self.path):  # ...nothing owned yet.
+                return
+
+            logging.warning("Unable to read journal from %s: %s", self.path, e.strerror)
+            return
+
+        for line in lines:
+            fields = line.split()
+
+            # Entries written before digests were kept can't be trusted, and are checked again...
+            if len(fields) != 4 or line.startswith("#"):
+                continue
+
+            try:
+                self.entries[fields[0]] = (fields[1], float(fields[2]), fields[3])
+            except ValueError:
+                logging.warning("Ignoring malformed journal entry: %s", line)
+
+
+    def fresh(self, names, target, records):
+        """Return those "names" recently confirmed as owned by "target" (ie. our host name), with the same "records"."""
+
+        oldest = time.time() - self.max_age
+        found = set()
+
+        for name in names:
+            entry = self.entries.get(name)
+
+            if entry is None or entry[0] != target or entry[1] < oldest:
+                continue
+
+            # Records changed since (eg. addresses while we weren't running) are looked up again...
+            if entry[2] == digest(records.get(name, ())):
+                found.add(name)
+
+        return found
+
+
+    def confirm(self, names, target, records):
+        """Record "names" as owned by "target" as of now, published with "records" (by name)."""
+
+        now = time.time()
+
+        for name in names:
+            self.entries[name] = (target, now, digest(records.get(name, ())))
+
+
+    def discard(self, names):
+        """Forget "names" (eg. because someone else owns them now)."""
+
+        for name in names:
+            self.entries.pop(name, None)
+
+
+    def flush(self):
+        """Write the journal into its file (replacing it atomically)."""
+
+        temporary = "%s.%d.tmp" % (self.path, os.getpid())
+
+        try:
+            with open(temporary, "w") as f:
+                f.write("# name target confirmed records\n")
+                f.writelines("%s %s %d %s\n" % (name, target, confirmed, records)
+                             for name, (target, confirmed, records) in sorted(self.entries.items()))
+
+            os.rename(temporary, self.path)
+        except (IOError, OSError) as e:
+            logging.error("Unable to write journal to %s: %s", self.path, e.strerror)
+
+
+# vim: set expandtab ts=4 sw=4:
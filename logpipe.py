@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# logpipe.py - Log from anywhere without waiting for disks or terminals, and without flooding them.
+#
+# Records are handed over to a background thread through a bounded queue, which does the actual
+# writing. Repeated warnings and errors are rate-limited, and the busiest loggers can be sampled.
+#
+
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+
+import metrics
+
+
+# Records waiting to be written, at most (any more are dropped, and counted)...
+DEFAULT_QUEUE_SIZE = 10000
+
+# Messages logged from the same place, at most, before the rest are suppressed for a while (seconds)...
+DEFAULT_BURST = 20
+DEFAULT_INTERVAL = 10.0
+
+# How often to check whether the log file was rotated away, in seconds...
+REOPEN_INTERVAL = 1.0
+
+LOG_DROPPED = metrics.counter("log_messages_dropped_total", "Log messages dropped for lack of room in the queue.")
+LOG_SUPPRESSED = metrics.counter("log_messages_suppressed_total", "Repeated log messages suppressed.")
+
+
+class RateLimitFilter(logging.Filter):
+    """Let at most "burst" messages through every "interval" seconds, for each message template and level.
+
+    Messages coming from the same call (eg. "Failed to publish '%s'") count as repeats, whatever
+    their arguments. The first message let through after others were suppressed says how many.
+    Messages below "level" are never suppressed.
+    """
+
+    def __init__(self, burst=DEFAULT_BURST, interval=DEFAULT_INTERVAL, level=logging.WARNING):
+        super(RateLimitFilter, self).__init__()
+
+        self.burst = burst
+        self.interval = interval
+        self.level = level
+
+        # (logger, level, template) -> [window start, messages in window, suppressed]...
+        self._windows = {}
+        self._lock = threading.Lock()
+
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+
+        with self._lock:
+            window = self._windows.get(key)
+
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                window = self._windows[key] = [now, 0, 0]
+
+                if suppressed:
+                    record.msg = "%s (%d similar messages suppressed)" % (record.msg, suppressed)
+
+            window[1] += 1
+
+            if window[1] <= self.burst:
+                return True
+
+            window[2] += 1
+
+        LOG_SUPPRESSED.inc()
+        return False
+
+
+class SamplingFilter(logging.Filter):
+    """Let only a random "rate" fraction of the messages through (eg. for access logs)."""
+
+    def __init__(self, rate):
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+
+
+    def filter(self, record):
+        return self.rate >= 1 or random.random() < self.rate
+
+
+class WatchedFileHandler(logging.handlers.WatchedFileHandler):
+    """Reopen the log file when rotated away, checking for that at most every "REOPEN_INTERVAL" seconds."""
+
+    def __init__(self, *args, **kwargs):
+        logging.handlers.WatchedFileHandler.__init__(self, *args, **kwargs)
+        self._checked = time.monotonic()
+
+
+    def emit(self, record):
+        now = time.monotonic()
+
+        if now - self._checked >= REOPEN_INTERVAL:
+            self._checked = now
+            self.reopenIfNeeded()
+
+        logging.FileHandler.emit(self, record)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Hand records over to the writer thread, dropping them if it can't keep up."""
+
+    def __init__(self, size):
+        logging.handlers.QueueHandler.__init__(self, queue.Queue(size))
+        self.dropped = 0
+
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:  # ...say so as soon as there's room again.
+                self.queue.put_nowait(logging.makeLogRecord({"name": "logpipe", "levelno": logging.WARNING,
+                                                             "levelname": "WARNING",
+                                                             "msg": "%d log messages dropped" % self.dropped}))
+                self.dropped = 0
+
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            LOG_DROPPED.inc()
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """Write out queued records in a background thread."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # ...once there's room, everything before it gets written.
+
+
+_handler = None
+_listener = None
+_restart = False
+
+
+def _start(renew=False):
+    global _listener
+
+    if renew:
+        _handler.queue = queue.Queue(_handler.queue.maxsize)
+
+    _listener = _QueueListener(_handler.queue, *_handler.targets, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    """Write out all queued records and stop the writer thread (eg. before "os._exit()")."""
+
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def setup(handler, level=logging.INFO, burst=DEFAULT_BURST, interval=DEFAULT_INTERVAL, size=DEFAULT_QUEUE_SIZE):
+    """Send all logging through "handler" (and whatever other handlers are given), from a background thread."""
+
+    global _handler
+
+    handlers = handler if isinstance(handler, (list, tuple)) else [handler]
+
+    stop()
+
+    _handler = _QueueHandler(size)
+    _handler.targets = handlers
+    _handler.addFilter(RateLimitFilter(burst, interval))
+
+    logger = logging.getLogger()
+
+    for existing in list(logger.handlers):
+        logger.removeHandler(existing)
+
+    logger.addHandler(_handler)
+    logger.setLevel(level)
+
+    _start()
+
+
+def _before_fork():
+    global _restart
+
+    # Whatever is queued gets written once, by the parent...
+    _restart = _listener is not None
+    stop()
+
+
+def _after_fork_in_parent():
+    if _restart:
+        _start()
+
+
+def _after_fork_in_child():
+    # The writer thread doesn't survive a fork, and the queue's locks may be in any state...
+    if _restart:
+        _start(renew=True)
+
+
+atexit.register(stop)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_before_fork, after_in_parent=_after_fork_in_parent,
+                        after_in_child=_after_fork_in_child)
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,605 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# mdns.py - Minimal mDNS responder, answering for our own names without Avahi or D-Bus.
+#
+
+
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import socket
+import struct
+import threading
+
+from collections import OrderedDict
+
+from dnsrecords import (BasePublisher, Record, fqdn_to_rdata, AVAHI_DNS_CLASS_IN, AVAHI_DNS_TYPE_A, AVAHI_DNS_TYPE_AAAA,
+                        IF_UNSPEC, MAX_ENTRIES_PER_GROUP, DEFAULT_RESOLVE_TIMEOUT)
+from netwatch import AddressWatcher
+
+
+MDNS_ADDRESS = "224.0.0.251"
+MDNS_PORT = 5353
+
+# From RFC 6762...
+FLAGS_RESPONSE = 0x8400  # ...QR and AA bits.
+FLAG_QR = 0x8000
+MASK_OPCODE = 0x7800
+CLASS_CACHE_FLUSH = 0x8000
+CLASS_UNICAST_RESPONSE = 0x8000
+DNS_TYPE_CNAME = 0x05
+DNS_TYPE_ANY = 0xFF
+LEGACY_UNICAST_TTL = 10
+HOST_TTL = 120  # ...for the host's own address records (RFC 6762, section 10).
+ANNOUNCE_INTERVAL = 1.0
+
+# Responses are kept within a single Ethernet frame...
+MAX_PACKET_SIZE = 1460
+
+# From "/usr/include/linux/in.h" (not always exposed by the "socket" module)...
+IP_PKTINFO = 8
+
+HEADER = struct.Struct("!HHHHHH")
+QUESTION = struct.Struct("!HH")
+RR_FIXED = struct.Struct("!HHIH")
+IN_PKTINFO = struct.Struct("=i4s4s")
+IP_MREQN = struct.Struct("=4s4si")
+
+
+def read_name(data, offset):
+    """Read a (possibly compressed) name at "offset", returning it in lowercase and the offset past it."""
+
+    labels = []
+    end = None
+
+    for _ in range(128):  # ...guard against compression loops.
+        length = data[offset]
+
+        if length == 0:
+            offset += 1
+            break
+
+        if length & 0xC0 == 0xC0:
+            end = offset + 2 if end is None else end
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+
+        labels.append(data[offset + 1:offset + 1 + length])
+        offset += 1 + length
+    else:
+        raise ValueError("name compression loop")
+
+    return b".".join(labels).decode("ascii", "replace").lower(), offset if end is None else end
+
+
+def parse_packet(data):
+    """Split a DNS packet into its id, flags, questions and answers."""
+
+    ident, flags, qdcount, ancount, _, _ = HEADER.unpack_from(data)
+    offset = HEADER.size
+
+    questions = []
+    for _ in range(qdcount):
+        name, offset = read_name(data, offset)
+        qtype, qclass = QUESTION.unpack_from(data, offset)
+        offset += QUESTION.size
+        questions.append((name, qtype, qclass))
+
+    answers = []
+    for _ in range(ancount):
+        name, offset = read_name(data, offset)
+        rtype, _, ttl, length = RR_FIXED.unpack_from(data, offset)
+        offset += RR_FIXED.size
+        answers.append((name, rtype, data[offset:offset + length], ttl))
+        offset += length
+
+    return ident, flags, questions, answers
+
+
+def encode_rr(record, ttl, cache_flush=True):
+    """Encode a record into its wire format, as found in the answer section."""
+
+    rclass = AVAHI_DNS_CLASS_IN | (CLASS_CACHE_FLUSH if cache_flush else 0)
+    return fqdn_to_rdata(record.name) + RR_FIXED.pack(record.type, rclass, ttl, len(record.rdata)) + record.rdata
+
+
+def build_packets(answers, ident=0, flags=FLAGS_RESPONSE, questions=()):
+    """Pack encoded answers into as few packets as possible."""
+
+    question = b"".join(questions)
+    packets = []
+    current = []
+    size = HEADER.size + len(question)
+
+    for answer in answers:
+        if current and size + len(answer) > MAX_PACKET_SIZE:
+            packets.append(HEADER.pack(ident, flags, len(questions), len(current), 0, 0) + question + b"".join(current))
+            current = []
+            size = HEADER.size + len(question)
+
+        current.append(answer)
+        size += len(answer)
+
+    if current:
+        packets.append(HEADER.pack(ident, flags, len(questions), len(current), 0, 0) + question + b"".join(current))
+
+    return packets
+
+
+class MDNSResponder(object):
+    """Answer mDNS queries for our own records, straight from an asyncio event loop (IPv4 only).
+
+    Answers are encoded once, when records are added, so queries are answered by looking them up and
+    copying bytes. Answers the querier already knows (with at least half their TTL left) are left out,
+    and all answers due to the same destination are sent together, once every pending query is read.
+    CNAMEs come with the records of their target, if it's one of ours (like the host's own addresses,
+    see "set_host()"), so they can be followed without asking again.
+    """
+
+    def __init__(self, loop=None, port=MDNS_PORT, interfaces=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.port = port
+        self.interfaces = interfaces  # ...indexes of the interfaces to serve (all, if None).
+
+        self._answers = {}  # ...name -> {record: encoded answer}.
+        self._lookups = {}  # ...name -> futures waiting for someone else's answer.
+        self._pending = OrderedDict()  # ...destination -> encoded answers.
+        self._joined = []
+        self._sock = None
+
+
+    def open(self):
+        """Start listening for queries on all interfaces."""
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # Other responders (like Avahi) may be sharing the port...
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        sock.bind(("", self.port))
+        sock.setblocking(False)
+
+        indexes = self.interfaces if self.interfaces is not None else [i for i, _ in socket.if_nameindex()]
+
+        for index in indexes:
+            try:
+                membership = IP_MREQN.pack(socket.inet_aton(MDNS_ADDRESS), socket.inet_aton("0.0.0.0"), index)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                self._joined.append(index)
+            except OSError as e:  # ...no multicast, or no IPv4 there.
+                logging.debug("Not serving mDNS on interface #%d: %s", index, e.strerror)
+
+        self._sock = sock
+        self.loop.add_reader(sock.fileno(), self._read)
+
+
+    def close(self):
+        if self._sock:
+            self.loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+
+
+    def owns(self, name):
+        """Check if we are answering for "name"."""
+
+        return name.lower() in self._answers
+
+
+    def add(self, records):
+        """Start answering for "records" (with their TTLs filled in), and announce them."""
+
+        for record in records:
+            self._answers.setdefault(record.name.lower(), {})[record] = encode_rr(record, record.ttl)
+
+        self._announce(records)
+        self.loop.call_later(ANNOUNCE_INTERVAL, self._announce, records)
+
+
+    def remove(self, records):
+        """Stop answering for "records", and tell everyone to forget them."""
+
+        for record in records:
+            answers = self._answers.get(record.name.lower(), {})
+            answers.pop(record, None)
+
+            if not answers:
+                self._answers.pop(record.name.lower(), None)
+
+        self._announce(records, goodbye=True)
+
+
+    def set_host(self, hostname, addresses):
+        """Answer for "hostname" with "addresses" (by "(interface index, family)"), announcing what changed."""
+
+        wanted = set()
+
+        for (index, family), values in addresses.items():
+            rtype = AVAHI_DNS_TYPE_AAAA if family == socket.AF_INET6 else AVAHI_DNS_TYPE_A
+            wanted.update(Record(hostname, rtype, socket.inet_pton(family, address), HOST_TTL, index) for address in values)
+
+        current = set(self._answers.get(hostname.lower(), ()))
+
+        if current - wanted:
+            self.remove(list(current - wanted))
+
+        if wanted - current:
+            self.add(list(wanted - current))
+
+
+    async def resolve(self, name, timeout=DEFAULT_RESOLVE_TIMEOUT):
+        """Ask the network about "name", returning it if anyone answers (or None after "timeout")."""
+
+        name = name.lower()
+        future = self.loop.create_future()
+        self._lookups.setdefault(name, []).append(future)
+
+        query = HEADER.pack(0, 0, 1, 0, 0, 0) + fqdn_to_rdata(name) + QUESTION.pack(DNS_TYPE_ANY, AVAHI_DNS_CLASS_IN)
+
+        for index in self._joined:
+            self._send(query, index)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._lookups[name].remove(future)
+
+            if not self._lookups[name]:
+                del self._lookups[name]
+
+
+    def _matching(self, name, qtype, index):
+        """Return the (record, answer) pairs answering a question received on interface "index"."""
+
+        for record, answer in self._answers.get(name, {}).items():
+            if record.interface not in (IF_UNSPEC, index):
+                continue
+
+            if qtype in (record.type, DNS_TYPE_ANY) or record.type == DNS_TYPE_CNAME:
+                yield record, answer
+
+            # ...along with whatever it leads to, when that's ours too (only one step, so loops can't happen).
+            if record.type == DNS_TYPE_CNAME and qtype != DNS_TYPE_CNAME:
+                target, _ = read_name(record.rdata, 0)
+
+                for pair in self._matching(target, qtype, index) if target != name else ():
+                    if pair[0].type != DNS_TYPE_CNAME:
+                        yield pair
+
+
+    def _announce(self, records, goodbye=False):
+        """Multicast "records" on every interface they belong to (with zero TTL, for goodbyes)."""
+
+        for index in self._joined:
+            for record in records:
+                if record.interface not in (IF_UNSPEC, index):
+                    continue
+
+                if goodbye:
+                    self._queue(index, encode_rr(record, 0))
+                elif record in self._answers.get(record.name.lower(), {}):  # ...still ours.
+                    self._queue(index, self._answers[record.name.lower()][record])
+
+        self._flush()
+
+
+    def _queue(self, destination, answer):
+        self._pending.setdefault(destination, OrderedDict())[answer] = None
+
+
+    def _flush(self):
+        """Send all queued answers, aggregated by destination."""
+
+        for destination, answers in self._pending.items():
+            for packet in build_packets(list(answers)):
+                self._send(packet, destination)
+
+        self._pending.clear()
+
+
+    def _send(self, packet, destination):
+        """Send "packet" as multicast on an interface (by index), or as unicast to an (address, port)."""
+
+        try:
+            if isinstance(destination, tuple):
+                self._sock.sendto(packet, destination)
+            else:
+                pktinfo = IN_PKTINFO.pack(destination, b"\0" * 4, b"\0" * 4)
+                self._sock.sendmsg([packet], [(socket.IPPROTO_IP, IP_PKTINFO, pktinfo)], 0, (MDNS_ADDRESS, self.port))
+        except OSError as e:
+            logging.debug("Unable to send mDNS packet to %s: %s", destination, e.strerror)
+
+
+    def _read(self):
+        """Handle every packet waiting to be read, then send all answers at once."""
+
+        while True:
+            try:
+                data, ancdata, _, source = self._sock.recvmsg(9000, socket.CMSG_SPACE(IN_PKTINFO.size))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logging.warning("Unable to receive mDNS packet: %s", e.strerror)
+                break
+
+            index = 0
+            for level, kind, value in ancdata:
+                if level == socket.IPPROTO_IP and kind == IP_PKTINFO:
+                    index = IN_PKTINFO.unpack_from(value)[0]
+
+            try:
+                self._handle(data, source, index)
+            except (IndexError, ValueError, struct.error):
+                logging.debug("Ignoring malformed mDNS packet from %s", source[0])
+
+        self._flush()
+
+
+    def _handle(self, data, source, index):
+        ident, flags, questions, answers = parse_packet(data)
+
+        if flags & FLAG_QR:  # ...someone's answer, maybe to one of our lookups.
+            for name, _, _, ttl in answers:
+                for future in self._lookups.get(name, ()):
+                    if ttl and not future.done():
+                        future.set_result(name)
+
+            return
+
+        if flags & MASK_OPCODE:
+            return
+
+        known = dict(((name, rtype, rdata), ttl) for name, rtype, rdata, ttl in answers)
+        legacy = source[1] != self.port
+        legacy_answers = []
+
+        for name, qtype, qclass in questions:
+            for record, answer in self._matching(name, qtype, index):
+                # Known-answer suppression (RFC 6762, section 7.1)...
+                if known.get((record.name.lower(), record.type, record.rdata), 0) >= record.ttl / 2:
+                    continue
+
+                if legacy:
+                    legacy_answers.append(encode_rr(record, min(record.ttl, LEGACY_UNICAST_TTL), cache_flush=False))
+                elif qclass & CLASS_UNICAST_RESPONSE:
+                    self._queue(source, answer)
+                else:
+                    self._queue(index, answer)
+
+        # Legacy resolvers need a conventional DNS response (RFC 6762, section 6.7)...
+        if legacy_answers:
+            echo = [fqdn_to_rdata(name) + QUESTION.pack(qtype, qclass & ~CLASS_UNICAST_RESPONSE)
+                    for name, qtype, qclass in questions]
+
+            for packet in build_packets(legacy_answers, ident, FLAGS_RESPONSE, echo):
+                self._send(packet, source)
+
+
+class _ResponderThread(object):
+    """A shared "MDNSResponder", running on its own event loop in a background thread."""
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+
+            return cls._instance
+
+
+    def __init__(self):
+        self.hostname = "%s.local" % socket.gethostname().split(".")[0]
+        self.loop = asyncio.new_event_loop()
+        self.responder = MDNSResponder(self.loop)
+        self.responder.open()
+
+        # Nobody else answers for the host name here, and our CNAMEs point to it...
+        try:
+            self.watcher = AddressWatcher()
+            self.responder.set_host(self.hostname, self.watcher.addresses)
+            self.loop.add_reader(self.watcher.fileno(), self._addresses_changed)
+        except OSError as e:
+            logging.warning("Unable to follow the host's addresses, '%s' won't resolve: %s", self.hostname, e.strerror)
+
+        self._thread = threading.Thread(target=self.loop.run_forever, name="mdns", daemon=True)
+        self._thread.start()
+
+
+    def _addresses_changed(self):
+        if self.watcher.process():
+            self.responder.set_host(self.hostname, self.watcher.addresses)
+
+
+    def call(self, function, *args):
+        """Run "function" in the responder's loop, waiting for its result."""
+
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+
+    def wait(self, coroutine):
+        """Run "coroutine" in the responder's loop, waiting for its result."""
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+class _Batch(object):
+    """Stands for an entry group: names published together, and announced together."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        self.object_path = "/mdns/%d" % next(self._ids)
+
+
+class MDNSPublisher(BasePublisher):
+    """Publish mDNS records by answering queries directly, as a drop-in for "AvahiPublisher".
+
+    All instances share a single responder, running in a background thread. Records are announced
+    when published and withdrawn with goodbye packets, but not probed for (like Avahi's "--force").
+    The responder also answers for the host name itself, with the addresses of each interface.
+    """
+
+    def __init__(self, record_ttl=60, group_size=MAX_ENTRIES_PER_GROUP, resolve_timeout=DEFAULT_RESOLVE_TIMEOUT):
+        """Initialize the publisher with fixed record TTL value and lookup deadline (in seconds)."""
+
+        super(MDNSPublisher, self).__init__(record_ttl, group_size)
+
+        self.resolve_timeout = resolve_timeout
+        self._thread = _ResponderThread.get()
+        self.hostname = self._thread.hostname
+
+        logging.debug("Built-in mDNS publisher for: %s", self.hostname)
+
+
+    def reset(self, timeout=None):
+        """Remove all published records from mDNS (goodbyes are sent before returning, "timeout" is unused)."""
+
+        records = [self._normalized(record) for records in self._records.values() for record in records]
+        self._thread.call(self._thread.responder.remove, records)
+        self.forget()
+
+        return True
+
+
+    def resolve(self, name, timeout=None):
+        """Lookup the current owner for "name", using mDNS."""
+
+        if self._thread.call(self._thread.responder.owns, name):
+            return self.hostname
+
+        timeout = self.resolve_timeout if timeout is None else timeout
+        return self._thread.wait(self._thread.responder.resolve(name, timeout))
+
+
+    def resolve_many(self, names, timeout=None):
+        """Lookup the current owners for all "names" concurrently, returning a "name -> owner" mapping."""
+
+        names = list(names)
+
+        async def lookup_all():
+            return await asyncio.gather(*(self._resolve(name, timeout) for name in names))
+
+        return dict(zip(names, self._thread.wait(lookup_all())))
+
+
+    async def _resolve(self, name, timeout):
+        if self._thread.responder.owns(name):
+            return self.hostname
+
+        return await self._thread.responder.resolve(name, self.resolve_timeout if timeout is None else timeout)
+
+
+    def publish_many(self, records, force=False):
+        """Publish many records at once, returning a "name -> success" mapping."""
+
+        entries = self._entries(records)
+        results = dict((name, False) for name in entries)
+
+        if not force:
+            entries = dict((name, entries[name]) for name in self.check_many(entries))
+
+        for batch in self._batches((name, entries[name]) for name in results if name in entries):
+            records = [self._normalized(record) for _, records in batch for record in records]
+            self._thread.call(self._thread.responder.add, records)
+
+            self._track(_Batch(), [name for name, _ in batch], entries)
+            results.update((name, True) for name, _ in batch)
+
+        return results
+
+
+    def publish_cname(self, cname, force=False):
+        """Publish a CNAME record."""
+
+        return self.publish_many([self.cname_record(cname)], force)[cname]
+
+
+    def publish_address(self, cname, address, force=False):
+        """Publish an address (A/AAAA) record."""
+
+        return self.publish_many([self.address_record(cname, address)], force)[cname]
+
+
+    def unpublish(self, name):
+        """Remove a published record from mDNS."""
+
+        self.unpublish_many([name])
+
+
+    def unpublish_many(self, names):
+        """Remove the records for many names from mDNS."""
+
+        records = []
+
+        for name in names:
+            group = self.published.pop(name)
+            records.extend(self._normalized(record) for record in self._records.pop(name))
+
+            members = self._members[group.object_path]
+            members.discard(name)
+
+            if not members:
+                del self._members[group.object_path]
+
+        self._thread.call(self._thread.responder.remove, records)
+
+
+    def reconcile(self, records, force=False):
+        """Make the published records match "records", changing only what differs.
+
+        There are no groups to rebuild here, so every changed name is updated in place.
+        """
+
+        added, removed, updated, rebuilt = self._diff(self._entries(records))
+        changed = dict(rebuilt)
+        changed.update((name, records) for name, (records, _) in updated.items())
+
+        self.unpublish_many(removed)
+
+        for name, records in changed.items():
+            current = set(map(self._normalized, self._records[name]))
+            wanted = set(map(self._normalized, records))
+
+            self._thread.call(self._thread.responder.remove, list(current - wanted))
+            self._thread.call(self._thread.responder.add, list(wanted - current))
+            self._records[name] = records
+
+        results = dict((name, True) for name in changed)
+
+        if added:
+            results.update(self.publish_many([record for name in added for record in added[name]], force))
+
+        logging.info("Reconciled records: %d added, %d removed, %d changed",
+                     len(added), len(removed), len(changed))
+
+        return results
+
+
+    def available(self):
+        """The responder is part of this process, so it's always available."""
+
+        return True
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# metrics.py - In-memory counters, gauges and latency histograms, rendered in the Prometheus text format.
+#
+
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import bisect
+import threading
+import time
+
+
+# Latency buckets, in seconds (from 100us up to the default lookup timeout and beyond)...
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def _format(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Timer(object):
+    """Observe how long a "with" block takes."""
+
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class _Value(object):
+    """A single counter or gauge value (for one set of label values)."""
+
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+    def set(self, value):
+        self.value = value
+
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class _Histogram(object):
+    """A single histogram (for one set of label values)."""
+
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+    def time(self):
+        return _Timer(self)
+
+
+    def samples(self, name, labels):
+        total = 0
+
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield name + "_bucket", labels + (("le", _format(bound)),), total
+
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, total
+
+
+class Metric(object):
+    """A named metric, with one value (or histogram) for each combination of label values."""
+
+    def __init__(self, kind, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._factory = (lambda: _Histogram(tuple(buckets))) if kind == "histogram" else _Value
+        self._children = {}
+        self._lock = threading.Lock()
+
+        # Unlabeled metrics are used directly (eg. "counter.inc()")...
+        if not self.labelnames:
+            self._default = self.labels()
+
+
+    def labels(self, *values):
+        """Return the value (or histogram) for the given label values, creating it on first use."""
+
+        child = self._children.get(values)
+
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("%s expects labels: %s" % (self.name, ", ".join(self.labelnames)))
+
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+
+        return child
+
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return getattr(self._default, name)
+
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+
+        for values, child in sorted(self._children.items()):
+            for name, labels, value in child.samples(self.name, tuple(zip(self.labelnames, values))):
+                if labels:
+                    name += "{%s}" % ",".join("%s=\"%s\"" % (label, _escape(v)) for label, v in labels)
+
+                lines.append("%s %s" % (name, _format(value)))
+
+        return "\n".join(lines)
+
+
+class Registry(object):
+    """All the metrics of a process, by name."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+
+    def _register(self, kind, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+
+            # Modules may be loaded more than once (eg. scripts), so the same metric may be asked again...
+            if metric is None:
+                metric = self._metrics[name] = Metric(kind, name, documentation, labelnames, **kwargs)
+            elif metric.kind != kind or metric.labelnames != tuple(labelnames):
+                raise ValueError("metric %s already registered differently" % name)
+
+            return metric
+
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register("counter", name, documentation, labelnames)
+
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register("gauge", name, documentation, labelnames)
+
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register("histogram", name, documentation, labelnames, buckets=buckets)
+
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+
+        return "".join(metric.render() + "\n" for _, metric in metrics)
+
+
+class InstrumentedInterface(object):
+    """Wrap a D-Bus interface, counting and timing every method call made through it."""
+
+    def __init__(self, interface, calls, errors, latency):
+        self._interface = interface
+        self._calls = calls
+        self._errors = errors
+        self._latency = latency
+
+
+    def __getattr__(self, name):
+        attribute = getattr(self._interface, name)
+
+        if not callable(attribute):
+            return attribute
+
+        calls = self._calls.labels(name)
+        errors = self._errors.labels(name)
+        latency = self._latency.labels(name)
+
+        def call(*args, **kwargs):
+            calls.inc()
+            start = time.perf_counter()
+
+            try:
+                return attribute(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - start)
+
+        # Later calls skip all of the above...
+        self.__dict__[name] = call
+        return call
+
+
+# The registry used by default, shared by everything in the process...
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+render = REGISTRY.render
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -13,10 +13,20 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 import logging
+import functools
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 
 import dbus
 #import exceptions
 
+import metrics
+
+from dnsrecords import (Record, BasePublisher, GroupFill, NetworkView, AVAHI_DNS_CLASS_IN, AVAHI_DNS_TYPE_A,
+                        AVAHI_DNS_TYPE_CNAME, AVAHI_DNS_TYPE_AAAA, AVAHI_DNS_TYPE_ANY, MAX_ENTRIES_PER_GROUP,
+                        DEFAULT_RESOLVE_TIMEOUT)
+
 
 # If the system-provided library isn't available, use a bundled copy instead.
 # Necessary for CentOS 6/7 where there's no available "avahi-python" package.
@@ -26,25 +36,82 @@ except ImportError:
     import _avahi as avahi
 
 
-# From "/usr/include/avahi-common/defs.h"
-AVAHI_DNS_CLASS_IN = 0x01
-AVAHI_DNS_TYPE_CNAME = 0x05
+# Upper bound for lookups running at the same time (Avahi also limits objects per client)...
+MAX_CONCURRENT_LOOKUPS = 256
+
+# Upper bound for names followed with record browsers (these count against the same limit as entry groups)...
+MAX_BROWSERS = 256
+
+# Errors meaning nobody answered for a name (as opposed to not being able to ask)...
+NO_ANSWER_ERRORS = ("org.freedesktop.Avahi.TimeoutError", "org.freedesktop.DBus.Error.NoReply")
+
+DBUS_CALLS = metrics.counter("avahi_dbus_calls_total", "D-Bus calls made to Avahi.", ["method"])
+DBUS_ERRORS = metrics.counter("avahi_dbus_errors_total", "D-Bus calls to Avahi that failed.", ["method"])
+DBUS_LATENCY = metrics.histogram("avahi_dbus_call_seconds", "Time taken by D-Bus calls to Avahi.", ["method"])
+
+
+def _run(function, *args):
+    """Call "function" right away, returning its outcome as an already completed future."""
+
+    future = Future()
+
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+
+    return future
+
+
+def _interface(proxy, interface):
+    """Return a D-Bus interface whose calls are counted and timed."""
+
+    return metrics.InstrumentedInterface(dbus.Interface(proxy, interface), DBUS_CALLS, DBUS_ERRORS, DBUS_LATENCY)
+
+
+class AvahiPublisher(BasePublisher):
+    """Publish mDNS records to Avahi, using D-BUS.
+
+    With "probe" set, records are published as unique, so Avahi probes the network for them before
+    announcing them. Publishing them with "force" then costs no lookups, and collisions are signaled
+    later for the entry group (see "resolve_collision()").
 
+    Lookup results are kept in a "NetworkView", so names are only asked about on the network once in
+    a while. With "browse" set (which needs a main loop), every name looked up is also followed with
+    an Avahi record browser, keeping what's known about it current until "close()" is called.
+    """
 
-class AvahiPublisher(object):
-    """Publish mDNS records to Avahi, using D-BUS."""
+    errors = (dbus.exceptions.DBusException,)
 
-    def __init__(self, record_ttl=60):
-        """Initialize the publisher with fixed record TTL value (in seconds)."""
+    def __init__(self, record_ttl=60, group_size=MAX_ENTRIES_PER_GROUP,
+                 resolve_timeout=DEFAULT_RESOLVE_TIMEOUT, max_lookups=MAX_CONCURRENT_LOOKUPS, probe=False,
+                 browse=False):
+        """Initialize the publisher with fixed record TTL value and lookup deadline (in seconds)."""
+
+        super(AvahiPublisher, self).__init__(record_ttl, group_size)
 
         self.bus = dbus.SystemBus()
 
         path_server_proxy = self.bus.get_object(avahi.DBUS_NAME, avahi.DBUS_PATH_SERVER)
-        self.server = dbus.Interface(path_server_proxy, avahi.DBUS_INTERFACE_SERVER)
+        self.server = _interface(path_server_proxy, avahi.DBUS_INTERFACE_SERVER)
 
         self.hostname = self.server.GetHostNameFqdn()
-        self.record_ttl = record_ttl
-        self.published = {}
+        self.resolve_timeout = resolve_timeout
+        self.max_lookups = max_lookups
+        self.probe = probe
+        self.view = NetworkView()
+
+        # Names followed by record browsers (by object path), and what each one currently sees...
+        self._browsers = {}
+        self._browsing = threading.Lock()
+        self._matches = []
+
+        if browse:
+            for signal, handler in (("ItemNew", self._item_new), ("ItemRemove", self._item_remove),
+                                    ("AllForNow", self._all_for_now), ("Failure", self._browser_failed)):
+                self._matches.append(self.bus.add_signal_receiver(handler, signal_name=signal,
+                                                                  dbus_interface=avahi.DBUS_INTERFACE_RECORD_BROWSER,
+                                                                  bus_name=avahi.DBUS_NAME, path_keyword="path"))
 
         logging.debug("Avahi mDNS publisher for: %s", self.hostname)
 
@@ -52,116 +119,420 @@ class AvahiPublisher(object):
     def __del__(self):
         """Remove all published records from mDNS."""
 
+        self.reset()
+
+
+    def reset(self, timeout=None):
+        """Remove all published records from mDNS.
+
+        All groups are reset at once (up to "max_lookups" at a time), and Avahi's confirmations are
+        waited on for at most "timeout" seconds (by default, until all arrive). Returns whether every
+        group was confirmed as withdrawn in time.
+        """
+
+        groups = self._unique_groups()
+        self.forget()
+
+        if not groups:
+            return True
+
+        executor = ThreadPoolExecutor(max_workers=min(len(groups), self.max_lookups))
+        futures = []
+
         try:
-            for group in self.published.values():
-                group.Reset()
-        except dbus.exceptions.DBusException as e:  # ...don't spam on broken connection.
-            if e.get_dbus_name() != "org.freedesktop.DBus.Error.ServiceUnknown":
-                raise
+            for group in groups:
+                futures.append(executor.submit(group.Reset))
+        except RuntimeError:  # ...no new threads at interpreter exit (eg. from "__del__()"), one at a time then.
+            futures.extend(_run(group.Reset) for group in groups[len(futures):])
 
+        try:
+            done, pending = wait(futures, timeout)
+        finally:
+            executor.shutdown(wait=False)  # ...stragglers finish in the background.
 
-    def _fqdn_to_rdata(self, fqdn):
-        """Convert an FQDN into the mDNS data record format."""
+        for future in done:
+            e = future.exception()
 
-        data = []
-        splitted = fqdn.split(".")
-        splenc = [ x.encode("ascii") for x in splitted ]
-        for part in splenc:
-            if part:
-                data.append(chr(len(part)))
-                data.append(part.decode("ascii"))
+            # Don't spam on broken connection...
+            if e is not None and not (isinstance(e, dbus.exceptions.DBusException) and
+                                      e.get_dbus_name() == "org.freedesktop.DBus.Error.ServiceUnknown"):
+                raise e
 
-        return ("".join(data) + "\0").encode("ascii")
+        if pending:
+            logging.warning("Avahi didn't confirm withdrawing %d out of %d entry groups", len(pending), len(groups))
 
+        return not pending
 
-    def count(self):
-        """Return the number of records currently being published."""
 
-        return len(self.published)
+    def close(self):
+        """Stop following names on the network, forgetting what was seen of them."""
 
+        for match in self._matches:
+            match.remove()
 
-    def resolve(self, name):
-        """Lookup the current owner for "name", using mDNS."""
+        with self._browsing:
+            browsers, self._browsers = self._browsers, {}
 
         try:
-            # TODO: Find out if it's possible to manipulate (shorten) the timeout...
+            for path in browsers:  # ...without waiting for replies, there's nothing to learn from them.
+                browser = _interface(self.bus.get_object(avahi.DBUS_NAME, path), avahi.DBUS_INTERFACE_RECORD_BROWSER)
+                browser.Free(ignore_reply=True)
+        except dbus.exceptions.DBusException:  # ...Avahi may be gone already, and the browsers with it.
+            pass
+
+        self._matches = []
+        self.view.clear()
+
+
+    def resolve(self, name, timeout=None):
+        """Lookup the current owner for "name", from the network view if it's known, using mDNS otherwise."""
+
+        known, owner = self.view.lookup(name)
+
+        if known:
+            return owner
+
+        timeout = self.resolve_timeout if timeout is None else timeout
+
+        try:
+            # Avahi gives up on its own after a few seconds, but we may not want to wait that long...
             response = self.server.ResolveHostName(avahi.IF_UNSPEC, avahi.PROTO_UNSPEC,
                                                    name.encode("ascii"), avahi.PROTO_UNSPEC,
-                                                   dbus.UInt32(0))
-            return response[2]  #.decode("ascii")
-        except (NameError, dbus.exceptions.DBusException):
+                                                   dbus.UInt32(0), timeout=timeout)
+
+            # Records published locally (eg. for other interfaces) are ours, whatever they point to...
+            if response[5] & avahi.LOOKUP_RESULT_OUR_OWN:
+                owner = self.hostname
+            else:
+                owner = response[2]  #.decode("ascii")
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() not in NO_ANSWER_ERRORS:
+                return None
+
+            owner = None
+        except NameError:
             return None
 
+        self.view.update(name, owner)
 
-    def publish_cname(self, cname, force=False):
-        """Publish a CNAME record."""
+        if self._matches:
+            self._browse(name)
 
-        if not force:
-            # Unfortunately, this takes a few seconds in the expected case...
-            logging.info("Checking for '%s' availability...", cname)
-            current_owner = self.resolve(cname)
+        return owner
+
+
+    def _browse(self, name):
+        """Follow "name" with a record browser, unless it's followed already (or there are too many)."""
+
+        with self._browsing:
+            if len(self._browsers) >= MAX_BROWSERS or any(n == name for n, _ in self._browsers.values()):
+                return
+
+        try:
+            path = self.server.RecordBrowserNew(avahi.IF_UNSPEC, avahi.PROTO_UNSPEC, name,
+                                                dbus.UInt16(AVAHI_DNS_CLASS_IN), dbus.UInt16(AVAHI_DNS_TYPE_ANY),
+                                                dbus.UInt32(0))
+        except dbus.exceptions.DBusException as e:
+            logging.debug("Unable to follow '%s': %s", name, e.get_dbus_name())
+            return
+
+        # Anything the browser signaled before this point is lost, and the lookup result stands until then...
+        with self._browsing:
+            self._browsers[path] = (name, {})
+
+
+    def _seen(self, path):
+        """Update the view with what the browser at "path" sees now."""
+
+        name, items = self._browsers[path]
+        owners = set(items.values())
+
+        # Records of other hosts win over our own, they mean someone else wants the name too...
+        owner = next((o for o in owners if o != self.hostname), self.hostname) if owners else None
+        self.view.update(name, owner, live=True)
+
+
+    def _item_new(self, interface, protocol, name, clazz, type, rdata, flags, path=None):
+        if path in self._browsers:
+            owner = self.hostname if flags & avahi.LOOKUP_RESULT_OUR_OWN else str(name)
+            self._browsers[path][1][(interface, protocol, type, bytes(rdata))] = owner
+            self._seen(path)
+
+
+    def _item_remove(self, interface, protocol, name, clazz, type, rdata, flags, path=None):
+        if path in self._browsers:
+            self._browsers[path][1].pop((interface, protocol, type, bytes(rdata)), None)
+            self._seen(path)
+
+
+    def _all_for_now(self, path=None):
+        if path in self._browsers:
+            self._seen(path)
+
+
+    def _browser_failed(self, error, path=None):
+        with self._browsing:
+            name, _ = self._browsers.pop(path, (None, None))
+
+        if name is not None:
+            logging.debug("Stopped following '%s': %s", name, error)
+            self.view.discard([name])
+
+
+    def resolve_many(self, names, timeout=None):
+        """Lookup the current owners for all "names" concurrently, returning a "name -> owner" mapping.
 
-            if current_owner:
-                if current_owner != self.hostname:
-                    logging.error("DNS entry '%s' is already owned by '%s'", cname, current_owner)
-                    return False
+        Lookups run in parallel (up to "max_lookups" at a time), so checking many names takes about as
+        long as checking a single one.
+        """
 
-                # We may have discovered ourselves, but this is not a fatal problem...
-                logging.warning("DNS entry '%s' is already being published by this machine", cname)
+        names = list(names)
+
+        if not names:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=min(len(names), self.max_lookups)) as executor:
+            owners = executor.map(functools.partial(self.resolve, timeout=timeout), names)
+            return dict(zip(names, owners))
+
+
+    def _new_group(self):
+        """Create a new (empty) entry group."""
 
         entry_group_proxy = self.bus.get_object(avahi.DBUS_NAME, self.server.EntryGroupNew())
-        group = dbus.Interface(entry_group_proxy, avahi.DBUS_INTERFACE_ENTRY_GROUP)
+        return _interface(entry_group_proxy, avahi.DBUS_INTERFACE_ENTRY_GROUP)
 
-        logging.info("Adding record")
-        group.AddRecord(avahi.IF_UNSPEC, avahi.PROTO_UNSPEC, dbus.UInt32(0), cname.encode("ascii"),
-                        AVAHI_DNS_CLASS_IN, AVAHI_DNS_TYPE_CNAME, self.record_ttl,
-                        self._fqdn_to_rdata(self.hostname))
 
-        group.Commit()
-        self.published[cname] = group
+    def _add_record(self, group, record, flags=0):
+        """Add a single record to an entry group."""
 
-        return True
+        ttl = self.record_ttl if record.ttl is None else record.ttl
+        flags |= avahi.PUBLISH_UNIQUE if self.probe else 0
 
+        group.AddRecord(record.interface, record.protocol, dbus.UInt32(flags), record.name.encode("ascii"),
+                        AVAHI_DNS_CLASS_IN, record.type, dbus.UInt32(ttl), record.rdata)
 
-    def publish_address(self, cname, address, force):
-        """Publish a CNAME record."""
+
+    def _fill_group(self, group, batch):
+        """Add the records for all (name, records) in "batch" to an entry group, returning the names that failed."""
+
+        fill = GroupFill(batch)
+
+        while True:
+            failed = []
+            partial = False
+
+            for name, records in fill.batch:
+                for i, record in enumerate(records):
+                    try:
+                        self._add_record(group, record)
+                    except dbus.exceptions.DBusException as e:
+                        logging.error("Unable to add record for '%s': %s", name, e.get_dbus_name())
+                        failed.append(name)
+                        partial = partial or i > 0
+                        break
+
+            if not fill.settle(failed, partial):
+                return fill.failed
+
+            # Some name left part of its records behind, and groups can't drop single entries...
+            group.Reset()
+
+
+    def publish_many(self, records, force=False):
+        """Publish many records at once, returning a "name -> success" mapping.
+
+        All records for the same name go into the same entry group, and names are packed into as few
+        groups as possible, so Avahi probes and announces them together instead of one at a time.
+        """
+
+        entries = self._entries(records)
+        results = dict((name, False) for name in entries)
 
         if not force:
             # Unfortunately, this takes a few seconds in the expected case...
-            logging.info("Checking for '%s' availability...", cname)
-            current_owner = self.resolve(cname)
+            logging.info("Checking for availability of %d names...", len(entries))
 
-            if current_owner:
-                if current_owner != self.hostname:
-                    logging.error("DNS entry '%s' is already owned by '%s'", cname, current_owner)
-                    return False
+            entries = dict((name, entries[name]) for name in self.check_many(entries))
 
-                # We may have discovered ourselves, but this is not a fatal problem...
-                logging.warning("DNS entry '%s' is already being published by this machine", cname)
+        batches = list(self._batches((name, entries[name]) for name in results if name in entries))
+        logging.info("Adding records for %d names in %d groups", len(entries), len(batches))
 
-        entry_group_proxy = self.bus.get_object(avahi.DBUS_NAME, self.server.EntryGroupNew())
-        group = dbus.Interface(entry_group_proxy, avahi.DBUS_INTERFACE_ENTRY_GROUP)
+        for batch in batches:
+            group = self._new_group()
+            failed = self._fill_group(group, batch)
+            names = set(name for name, _ in batch if name not in failed)
 
-        # avahi_entry_group_add_address(entry_group, AVAHI_IF_UNSPEC, AVAHI_PROTO_UNSPEC, config->no_reverse ? AVAHI_PUBLISH_NO_REVERSE : 0, config->name, &config->address
+            if not names:
+                group.Free()
+                continue
 
-        no_reverse = True
-        flags = avahi.PUBLISH_NO_REVERSE if no_reverse else 0
-        #address = "192.168.1.104"
+            try:
+                group.Commit()
+            except dbus.exceptions.DBusException as e:
+                logging.error("Unable to commit records for %d names: %s", len(names), e.get_dbus_name())
+                group.Free()
+                continue
+
+            self._track(group, names, entries)
+            results.update((name, True) for name in names)
+
+        return results
+
+
+    def publish_cname(self, cname, force=False):
+        """Publish a CNAME record."""
+
+        return self.publish_many([self.cname_record(cname)], force)[cname]
+
+
+    def publish_address(self, cname, address, force=False):
+        """Publish an address (A/AAAA) record."""
 
         logging.info("Adding name %s to address %s", cname, address)
-        group.AddAddress(avahi.IF_UNSPEC, avahi.PROTO_UNSPEC, dbus.UInt32(flags), cname.encode("ascii"), address.encode("ascii"))
 
-        group.Commit()
-        self.published[cname] = group
+        # Same as "AddAddress()" with "PUBLISH_NO_REVERSE", but with our own TTL...
+        return self.publish_many([self.address_record(cname, address)], force)[cname]
 
-        return True
+
+    def _rebuild(self, group):
+        """Replace "group" with a new one, holding the current records of all names in it.
+
+        Groups can't drop or add single entries once committed, and resetting one withdraws all its
+        names (Avahi says goodbye for them) until they are announced again. So the new group is
+        committed before the old one is freed, and the names left alone never stop resolving. Only
+        groups of unique records (with "probe" set) are still reset, as Avahi won't have the same
+        unique record in two groups.
+        """
+
+        members = self._members.pop(group.object_path)
+
+        if not members:
+            group.Free()
+            return
+
+        if self.probe:
+            replacement = group
+            group.Reset()
+        else:
+            replacement = self._new_group()
+
+        failed = self._fill_group(replacement, [(member, self._records[member]) for member in members])
+
+        for member in failed:
+            members.discard(member)
+            del self.published[member]
+            del self._records[member]
+
+        if members:
+            replacement.Commit()
+            self._track(replacement, members, self._records)
+        else:
+            replacement.Free()
+
+        if replacement is not group:
+            group.Free()
 
 
     def unpublish(self, name):
         """Remove a published record from mDNS."""
 
-        self.published[name].Reset()
-        del self.published[name]
+        self.unpublish_many([name])
+
+
+    def unpublish_many(self, names):
+        """Remove the records for many names from mDNS, rebuilding each affected group only once."""
+
+        groups = {}
+
+        for name in names:
+            group = self.published.pop(name)
+            del self._records[name]
+
+            self._members[group.object_path].discard(name)
+            groups[group.object_path] = group
+
+        for group in groups.values():
+            self._rebuild(group)
+
+
+    def resolve_collision(self, path):
+        """Handle a collision signaled for the entry group at "path", returning the names withdrawn because of it.
+
+        Avahi doesn't tell which names collided, so all names in the group are looked up again (ours
+        aren't being announced anymore). The names found elsewhere are withdrawn, and the rest of the
+        group is published again (and probed again).
+        """
+
+        names = self.group_names(path)
+
+        if not names:
+            return []
+
+        group = self.published[next(iter(names))]
+
+        # Whatever was known about these names before is stale now...
+        self.view.discard(names)
+        owners = self.resolve_many(names)
+        taken = [name for name in names if owners[name] and owners[name] != self.hostname]
+
+        if taken:
+            self.unpublish_many(taken)
+        else:  # ...whoever it was is gone already.
+            self._rebuild(group)
+
+        return taken
+
+
+    def reconcile(self, records, force=False):
+        """Make the published records match "records", changing only what differs.
+
+        Names no longer wanted are removed, new names are published (checked first, unless "force"
+        is set), and names whose records changed only in their data or TTL are updated in place with
+        "PUBLISH_UPDATE", so they never stop resolving. Any other change rebuilds the name's group.
+        Returns a "name -> success" mapping for the names that were added or changed.
+        """
+
+        added, removed, updated, rebuilt = self._diff(self._entries(records))
+        results = {}
+        groups = {}
+
+        for name in removed:
+            group = self.published.pop(name)
+            del self._records[name]
+
+            self._members[group.object_path].discard(name)
+            groups[group.object_path] = group
+
+        for name, records in rebuilt.items():
+            self._records[name] = records
+            groups[self.published[name].object_path] = self.published[name]
+
+        for name, (records, changes) in updated.items():
+            group = self.published[name]
+            self._records[name] = records
+
+            if group.object_path in groups:  # ...it's being rebuilt anyway.
+                continue
+
+            try:
+                for record in changes:
+                    self._add_record(group, record, avahi.PUBLISH_UPDATE)
+            except dbus.exceptions.DBusException as e:
+                logging.warning("Unable to update records for '%s' in place: %s", name, e.get_dbus_name())
+                groups[group.object_path] = group
+
+        for group in groups.values():
+            self._rebuild(group)
+
+        results.update((name, name in self.published) for name in list(rebuilt) + list(updated))
+        if added:
+            results.update(self.publish_many([record for name in added for record in added[name]], force))
+
+        logging.info("Reconciled records: %d added, %d removed, %d updated in place, %d rebuilt",
+                     len(added), len(removed), len(updated), len(rebuilt))
+
+        return results
 
 
     def available(self):
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# netwatch.py - Follow the addresses of network interfaces as they change, using rtnetlink.
+#
+
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import errno
+import logging
+import socket
+import struct
+
+
+# From "/usr/include/linux/netlink.h" and "/usr/include/linux/rtnetlink.h"...
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+# From "/usr/include/linux/if_addr.h"...
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+IFA_F_DADFAILED = 0x08
+IFA_F_TENTATIVE = 0x40
+RT_SCOPE_HOST = 254
+
+NLMSG_HEADER = struct.Struct("=LHHLL")
+IFADDRMSG = struct.Struct("=BBBBL")
+RTATTR = struct.Struct("=HH")
+U32 = struct.Struct("=L")
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _messages(data):
+    """Split a netlink datagram into (type, payload) messages."""
+
+    offset = 0
+
+    while offset + NLMSG_HEADER.size <= len(data):
+        length, kind, _, _, _ = NLMSG_HEADER.unpack_from(data, offset)
+
+        if length < NLMSG_HEADER.size:
+            break
+
+        yield kind, data[offset + NLMSG_HEADER.size:offset + length]
+        offset += _align(length)
+
+
+def _attributes(data, offset):
+    """Split the routing attributes at "offset" into a "type -> value" mapping."""
+
+    attributes = {}
+
+    while offset + RTATTR.size <= len(data):
+        length, kind = RTATTR.unpack_from(data, offset)
+
+        if length < RTATTR.size:
+            break
+
+        attributes[kind] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+
+    return attributes
+
+
+def interface_name(index):
+    """Return the name of the network interface with the given index."""
+
+    try:
+        return socket.if_indextoname(index)
+    except (OSError, ValueError):  # ...it's gone already.
+        return "#%d" % index
+
+
+class AddressWatcher(object):
+    """Keep the current addresses of all network interfaces, following rtnetlink notifications.
+
+    The address table is read in full only once, and after that each notification is applied to it
+    as it arrives. Loopback (host scope) and tentative addresses are left out.
+    """
+
+    def __init__(self):
+        self.addresses = {}  # ...(interface index, family) -> set of addresses.
+
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self._sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        self._seq = 0
+
+        self.dump()
+
+
+    def fileno(self):
+        return self._sock.fileno()
+
+
+    def close(self):
+        self._sock.close()
+
+
+    def _apply(self, table, kind, payload):
+        """Apply a single RTM_NEWADDR/RTM_DELADDR message to "table", returning the key if it changed."""
+
+        if kind not in (RTM_NEWADDR, RTM_DELADDR) or len(payload) < IFADDRMSG.size:
+            return None
+
+        family, _, flags, scope, index = IFADDRMSG.unpack_from(payload)
+
+        if family not in (socket.AF_INET, socket.AF_INET6) or scope == RT_SCOPE_HOST:
+            return None
+
+        attributes = _attributes(payload, IFADDRMSG.size)
+
+        # On point-to-point links "IFA_ADDRESS" is the peer, "IFA_LOCAL" is always ours...
+        raw = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+
+        if raw is None:
+            return None
+
+        if IFA_FLAGS in attributes:
+            flags = U32.unpack(attributes[IFA_FLAGS])[0]
+
+        key = (index, family)
+        address = socket.inet_ntop(family, raw)
+        addresses = table.get(key, set())
+        usable = kind == RTM_NEWADDR and not flags & (IFA_F_TENTATIVE | IFA_F_DADFAILED)
+
+        if usable == (address in addresses):  # ...nothing new.
+            return None
+
+        if usable:
+            addresses.add(address)
+            table[key] = addresses
+        else:
+            addresses.discard(address)
+
+            if not addresses:
+                del table[key]
+
+        return key
+
+
+    def dump(self):
+        """Read the full address table from the kernel, returning the keys that changed."""
+
+        self._seq += 1
+        request = NLMSG_HEADER.pack(NLMSG_HEADER.size + IFADDRMSG.size, RTM_GETADDR,
+                                    NLM_F_REQUEST | NLM_F_DUMP, self._seq, 0)
+        request += IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+
+        table = {}
+        self._sock.setblocking(True)
+
+        try:
+            self._sock.send(request)
+
+            done = False
+            while not done:
+                for kind, payload in _messages(self._sock.recv(65536)):
+                    if kind == NLMSG_DONE:
+                        done = True
+                    elif kind == NLMSG_ERROR:
+                        raise OSError(errno.EIO, "netlink address dump failed")
+                    else:
+                        self._apply(table, kind, payload)
+        finally:
+            self._sock.setblocking(False)
+
+        changed = set(key for key in set(table) | set(self.addresses)
+                      if table.get(key) != self.addresses.get(key))
+        self.addresses = table
+
+        return changed
+
+
+    def process(self):
+        """Apply all pending notifications, returning the (interface index, family) keys that changed."""
+
+        changed = set()
+
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+
+                if e.errno != errno.ENOBUFS:
+                    raise
+
+                # Notifications were lost, so we can only start over...
+                logging.warning("Lost address change notifications, reading all addresses again")
+                return changed | self.dump()
+
+            for kind, payload in _messages(data):
+                key = self._apply(self.addresses, kind, payload)
+
+                if key is not None:
+                    changed.add(key)
+
+        return changed
+
+
+# vim: set expandtab ts=4 sw=4:
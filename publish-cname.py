@@ -15,38 +15,105 @@ from __future__ import absolute_import
 import sys
 import os, os.path
 import logging
-import logging.handlers
 import re
 import signal
-import functools
-import netifaces as ni
+import socket
+
+# First, so the startup timings include all the other imports...
+import startup
+
+from collections import OrderedDict
+
+from gi.repository import GLib
 
 from getopt import getopt, GetoptError
-from textwrap import TextWrapper
-from time import sleep
+from time import monotonic
+
+import logpipe
+import metrics
 
 from daemonize import daemonize
-from mpublisher import AvahiPublisher
+from scheduler import PublishScheduler, PRIORITY_NEW, PRIORITY_REFRESH
+from dnsrecords import alternative_name, DEFAULT_RESOLVE_TIMEOUT
+from netwatch import AddressWatcher, interface_name
+
+
+# Only imported for the Avahi backend (see "load_avahi()"), the built-in responder needs neither...
+dbus = None
+avahi = None
 
 
 # Default Time-to-Live for mDNS records, in seconds...
 DEFAULT_DNS_TTL = 60
 
+# Upper bound for Avahi to confirm withdrawing all names on exit, in seconds...
+SHUTDOWN_TIMEOUT = 1.0
+
+DBUS_INTERFACE_DBUS = "org.freedesktop.DBus"
+
+# Minimal checking that the CNAMEs are properly formatted...
+CNAME_PATTERN = r"[a-z0-9-]{1,63}(?:\.[a-z0-9-]{1,63})*\.local"
+CNAME_RE = re.compile(r"^%s$" % CNAME_PATTERN)
+CNAME_LIST_RE = re.compile(r"(?:%s\n)*" % CNAME_PATTERN)
+
+PUBLISHED_NAMES = metrics.gauge("publish_cname_names", "Names that passed the collision checks.")
+PUBLISH_LATENCY = metrics.histogram("publish_cname_publish_seconds", "Time taken to (re)publish a single scope.")
+COLLISIONS = metrics.counter("publish_cname_collisions_total", "Entry groups that collided with another host.")
+FAILURES = metrics.counter("publish_cname_failures_total", "Names that failed to be published.")
+AVAHI_LOST = metrics.counter("publish_cname_avahi_lost_total", "Times Avahi went away.")
+AVAHI_RECONNECTS = metrics.counter("publish_cname_avahi_reconnects_total", "Times Avahi became available.")
+
 
 def print_usage():
     """Output the proper usage syntax for this program."""
 
-    print("USAGE: %s [-t <ttl>] [-f] [-v] <hostname.local> [...]" % os.path.basename(sys.argv[0]))
+    print("USAGE: %s [-t <ttl>] [-T <timeout>] [-f | -o [-r]] [-a] [-b <backend>] [-n <file>] [-j <file>] [-m <file>] [-v] <hostname.local> [...]" % os.path.basename(sys.argv[0]))
+
+    from textwrap import TextWrapper
 
     wrapper = TextWrapper(width=79, initial_indent="\t", subsequent_indent="\t")
 
     print("\n-t/--ttl <seconds>")
     print(wrapper.fill("Set the TTL for all published records. (Default: %ds)" % DEFAULT_DNS_TTL))
 
+    print("\n-T/--timeout <seconds>")
+    print(wrapper.fill("Give up on checking if a CNAME is already being published elsewhere after this "
+                       "long. All CNAMEs are checked at the same time. (Default: %.1fs)" % DEFAULT_RESOLVE_TIMEOUT))
+
     print("\n-f/--force")
     print(wrapper.fill("Publish all CNAMEs without checking if they are already being published "
                        "elsewhere on the network. This is much faster, but generally unsafe."))
 
+    print("\n-o/--optimistic")
+    print(wrapper.fill("Publish all CNAMEs right away, as unique records Avahi probes for. Names found "
+                       "to collide with another host afterwards are withdrawn. Almost as fast as "
+                       "\"--force\", but safe."))
+
+    print("\n-r/--rename")
+    print(wrapper.fill("With \"--optimistic\", retry names that collided under an alternative name "
+                       "(eg. \"name-2.local\")."))
+
+    print("\n-a/--addresses")
+    print(wrapper.fill("Publish the names as address (A/AAAA) records for the addresses of each network "
+                       "interface instead of CNAMEs, following address changes as they happen."))
+
+    print("\n-b/--backend avahi|mdns")
+    print(wrapper.fill("Publish through the Avahi daemon (over D-Bus), or answer mDNS queries directly "
+                       "from this process (IPv4 only, no Avahi needed). (Default: avahi)"))
+
+    print("\n-n/--names <filename>")
+    print(wrapper.fill("Read additional CNAMEs from a file, one per line. The file is watched for "
+                       "changes and only the names added or removed are (un)published. Use \"-\" "
+                       "to read them once from standard input instead."))
+
+    print("\n-j/--journal <filename>")
+    print(wrapper.fill("Remember the names owned by this host in a file. On restart, names owned "
+                       "recently are published again right away, and only the others are checked first."))
+
+    print("\n-m/--metrics <filename>")
+    print(wrapper.fill("Write the current metrics into this file (in the Prometheus text format) when "
+                       "receiving SIGUSR1. Without this option, they are logged instead."))
+
     print("\n-v/--verbose")
     print(wrapper.fill("Produce extra output for debugging purposes."))
 
@@ -57,34 +124,90 @@ def print_usage():
     print(wrapper.fill("Send log messages into the specified file."))
 
 
+def read_names(path):
+    """Read names from a file (or standard input, for "-"), one per line, ignoring comments."""
+
+    f = sys.stdin if path == "-" else open(path, "r")
+
+    try:
+        return [line.split("#", 1)[0] for line in f]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def validate_names(names):
+    """Split names into the well-formed ones (in order, without duplicates) and the malformed ones."""
+
+    names = list(OrderedDict.fromkeys(name.strip().lower() for name in names if name.strip()))
+
+    # The whole list is checked in a single pass, and only name by name if something's wrong...
+    if CNAME_LIST_RE.fullmatch("".join(name + "\n" for name in names)):
+        return (names, [])
+
+    return ([name for name in names if CNAME_RE.match(name)],
+            [name for name in names if not CNAME_RE.match(name)])
+
+
+def load_names(static, path):
+    """Combine "static" names with those read from "path", or return None if it can't be read."""
+
+    try:
+        names, malformed = validate_names(static + read_names(path))
+    except IOError as e:
+        logging.error("Unable to read names from %s: %s", path, e.strerror)
+        return None
+
+    for name in malformed:
+        logging.error("Ignoring malformed hostname: %s", name)
+
+    return names
+
+
 def parse_args():
     """Parse and enforce command-line arguments."""
 
     try:
-        options, args = getopt(sys.argv[1:], "t:fvdl:h", ["ttl=", "force", "verbose",
-                                                          "daemon", "log=", "help"])
+        options, args = getopt(sys.argv[1:], "t:T:forab:n:j:m:vdl:h", ["ttl=", "timeout=", "force", "optimistic", "rename",
+                                                                       "addresses", "backend=", "names=", "journal=",
+                                                                       "metrics=", "verbose", "daemon", "log=", "help"])
     except GetoptError as e:
         print("error: %s." % e, file=sys.stderr)
         print_usage()
         sys.exit(1)
 
-    if len(args) < 1:
+    names_file = next((value.strip() for option, value in options if option in ("-n", "--names")), None)
+
+    if len(args) < 1 and not names_file:
         print("error: parameter(s) missing.", file=sys.stderr)
         print_usage()
         sys.exit(1)
 
-    # Minimal checking that the CNAMEs are properly formatted...
-    cname_re = re.compile(r"^[a-z0-9-]{1,63}(?:\.[a-z0-9-]{1,63})*\.local$")
-    cnames = [arg.strip().lower() for arg in args]
+    # Standard input can only be read once, so those names are as good as given on the command line...
+    if names_file == "-":
+        args += read_names(names_file)
+        names_file = None
+    elif names_file:
+        names_file = os.path.abspath(names_file)
+
+    cnames, malformed = validate_names(args)
 
-    for cname in cnames:
-        if not cname_re.match(cname):
+    if malformed:
+        for cname in malformed:
             print("error: malformed hostname: %s" % cname, file=sys.stderr)
-            print_usage()
-            sys.exit(1)
+
+        print_usage()
+        sys.exit(1)
 
     ttl = DEFAULT_DNS_TTL
+    timeout = DEFAULT_RESOLVE_TIMEOUT
     force = False
+    optimistic = False
+    rename = False
+    addresses = False
+    backend = "avahi"
+    journal_file = None
+    metrics_file = None
     verbose = False
     daemon = False
     logname = None
@@ -95,8 +218,27 @@ def parse_args():
             sys.exit(1)
         elif option in ("-t", "--ttl"):
             ttl = int(value)
+        elif option in ("-T", "--timeout"):
+            timeout = float(value)
         elif option in ("-f", "--force"):
             force = True
+        elif option in ("-o", "--optimistic"):
+            optimistic = True
+        elif option in ("-r", "--rename"):
+            rename = True
+        elif option in ("-a", "--addresses"):
+            addresses = True
+        elif option in ("-b", "--backend"):
+            backend = value.strip().lower()
+
+            if backend not in ("avahi", "mdns"):
+                print("error: unknown backend: %s" % backend, file=sys.stderr)
+                print_usage()
+                sys.exit(1)
+        elif option in ("-j", "--journal"):
+            journal_file = os.path.abspath(value.strip())
+        elif option in ("-m", "--metrics"):
+            metrics_file = os.path.abspath(value.strip())
         elif option in ("-v", "--verbose"):
             verbose = True
         elif option in ("-d", "--daemon"):
@@ -104,82 +246,591 @@ def parse_args():
         elif option in ("-l", "--log"):
             logname = value.strip()
 
-    return (ttl, force, verbose, daemon, logname, cnames)
+    # Avahi refuses unique records for a name with more than one address on the same interface, and
+    # the built-in responder doesn't probe at all...
+    if optimistic and (force or addresses or backend != "avahi"):
+        print("error: --optimistic can't be combined with --force, --addresses or other backends.", file=sys.stderr)
+        print_usage()
+        sys.exit(1)
+
+    return (ttl, timeout, force, optimistic, rename, addresses, backend, journal_file, metrics_file, verbose, daemon,
+            logname, cnames, names_file)
+
+
+def load_avahi():
+    """Import what publishing through Avahi takes (D-Bus, mostly), returning its publisher class."""
+
+    global dbus, avahi
+
+    import dbus
+
+    from dbus.mainloop.glib import DBusGMainLoop
+    from mpublisher import AvahiPublisher, avahi
+
+    # Everything happens in response to D-Bus signals, nothing is polled...
+    DBusGMainLoop(set_as_default=True)
+
+    return AvahiPublisher
+
+
+class PublishService(object):
+    """Keep names published, reacting to Avahi and network address changes as they are signaled.
+
+    Names are published through Avahi, unless some other publisher class is given as "backend".
+    """
+
+    def __init__(self, cnames, ttl, timeout, force, addresses=False, backend=None, optimistic=False,
+                 rename=False):
+        self.cnames = cnames
+        self.ttl = ttl
+        self.timeout = timeout
+        self.force = force
+        self.optimistic = optimistic
+        self.rename = rename
+
+        # The built-in responder doesn't go through Avahi, so there's nothing to follow on D-Bus...
+        if backend is None:
+            backend = load_avahi()
+            self.bus = dbus.SystemBus()
+        else:
+            self.bus = None
+
+        self.backend = backend
+        self.watcher = AddressWatcher() if addresses else None
+
+        # Publishers by scope: "None" for CNAMEs, "(interface index, family)" for addresses...
+        self.publishers = {}
+
+        # Names that passed the collision checks ("None" while Avahi isn't available)...
+        self.names = None
+
+        # Names owned recently, which don't need checking again (see "OwnershipJournal")...
+        self.journal = None
+
+        # Names known to be ours, by the collision checks or Avahi's probing (only these go in the journal)...
+        self.verified = set()
+
+        # Changes reach Avahi through here, so flapping names and addresses don't flood the network...
+        self.scheduler = PublishScheduler()
+
+        # What the service manager was last told we're doing...
+        self.status = "Starting"
+
+
+    def start(self):
+        """Subscribe to Avahi signals and publish right away, if Avahi is already running."""
+
+        if self.watcher:
+            GLib.io_add_watch(self.watcher.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._addresses_changed)
+
+        # Names stay ours for as long as they're published, but the journal must know it's still so...
+        if self.journal:
+            GLib.timeout_add_seconds(max(1, int(self.journal.max_age // 2)), self._refresh_journal)
+
+        if self.bus is None:
+            self.publish()
+            return
+
+        self.bus.add_signal_receiver(self._owner_changed, signal_name="NameOwnerChanged",
+                                     dbus_interface=DBUS_INTERFACE_DBUS, arg0=avahi.DBUS_NAME)
+        self.bus.add_signal_receiver(self._server_state_changed, signal_name="StateChanged",
+                                     dbus_interface=avahi.DBUS_INTERFACE_SERVER,
+                                     bus_name=avahi.DBUS_NAME, path=avahi.DBUS_PATH_SERVER)
+        self.bus.add_signal_receiver(self._group_state_changed, signal_name="StateChanged",
+                                     dbus_interface=avahi.DBUS_INTERFACE_ENTRY_GROUP,
+                                     bus_name=avahi.DBUS_NAME, path_keyword="path")
+
+        if self.bus.name_has_owner(avahi.DBUS_NAME):
+            self._avahi_appeared()
+        else:
+            logging.warning("Avahi is not running, waiting for it to start...")
+            self._report("Waiting for Avahi")
+
+
+    def scopes(self):
+        """Return the scopes with something to publish."""
+
+        return list(self.watcher.addresses) if self.watcher else [None]
+
+
+    def publish(self):
+        """Check all names and publish them from scratch."""
+
+        try:
+            checker = self._publisher(None)
+            self.verified = set()
+
+            # Optimistic publishing leaves all checks to Avahi's own probing...
+            if self.force or self.optimistic:
+                self.names = list(self.cnames)
+            else:
+                self.names = self._check(checker, self.cnames)
+
+            PUBLISHED_NAMES.set(len(self.names))
+
+            for scope in self.scopes():
+                self._schedule(scope, PRIORITY_NEW)
+
+            self._report("Publishing %d names" % len(self.names))
+        except self.backend.errors as e:
+            logging.warning("Unable to publish through Avahi: %s", e.get_dbus_name())
+            self._report("Unable to publish: %s" % e.get_dbus_name())
+
+
+    def withdraw(self, timeout=None):
+        """Remove all names from mDNS, waiting at most "timeout" seconds for Avahi to confirm it."""
+
+        # What's published was ours until now, which makes a quick restart safe (what's pending never was)...
+        self.scheduler.clear()
+        self._confirm(self.publishers.values())
+
+        deadline = None if timeout is None else monotonic() + timeout
+
+        for publisher in self.publishers.values():
+            publisher.reset(None if deadline is None else max(0, deadline - monotonic()))
+            publisher.close()
+
+        self.publishers = {}
+        self.names = None
+        PUBLISHED_NAMES.set(0)
+
+
+    def set_names(self, cnames):
+        """Switch to a new list of names, (un)publishing only the differences."""
+
+        current = set(self.cnames)
+        added = [name for name in cnames if name not in current]
+        removed = current - set(cnames)
+
+        self.cnames = list(cnames)
+
+        if not added and not removed:
+            return
+
+        logging.info("Names changed: %d added, %d removed", len(added), len(removed))
+
+        if self.names is None:  # ...everything gets published when Avahi comes back.
+            return
+
+        try:
+            if not (self.force or self.optimistic):
+                added = self._check(self._publisher(None), added)
+
+            self.names = [name for name in self.names if name not in removed] + added
+            PUBLISHED_NAMES.set(len(self.names))
+
+            for scope in self.scopes():
+                self._schedule(scope, PRIORITY_NEW if added else PRIORITY_REFRESH)
+
+            if self.journal:
+                self.journal.discard(removed)
+        except self.backend.errors as e:
+            logging.warning("Unable to publish through Avahi: %s", e.get_dbus_name())
+
+
+    def _check(self, checker, names):
+        """Return those "names" free to be published, publishing the ones recently owned first, unchecked."""
+
+        if not self.journal:
+            return checker.check_many(names)
+
+        # Recently owned names were checked back then, and nobody else could have taken them since...
+        known = self.journal.fresh(names, checker.hostname, self._desired(checker, names))
+
+        # These go out at once, without waiting for the others to be looked up...
+        if known:
+            logging.info("Publishing %d recently owned names without checking them", len(known))
+            self.names = [name for name in self.names or () if name not in known] + [n for n in names if n in known]
+
+            for scope in self.scopes():
+                self._schedule(scope, PRIORITY_NEW)
+
+            self.scheduler.flush()
+
+        free = set(checker.check_many([name for name in names if name not in known]))
+        self.journal.discard([name for name in names if name not in known and name not in free])
+        self.verified.update(known, free)
+
+        return [name for name in names if name in known or name in free]
+
+
+    def _confirm(self, publishers):
+        """Record the names published by "publishers" (those known to be ours) in the journal, unless forced."""
+
+        if not self.journal:
+            return
 
+        # Names have records in every scope, these all go into the journal together...
+        records = {}
+        for publisher in self.publishers.values():
+            for name, name_records in publisher.records().items():
+                records.setdefault(name, []).extend(name_records)
 
-def handle_signals(publisher, signum, frame):
+        for publisher in publishers if not self.force else ():
+            names = [name for name in publisher.published if name in self.verified]
+            self.journal.confirm(names, publisher.hostname, records)
+
+        self.journal.flush()
+
+
+    def _report(self, status):
+        """Tell the service manager what we're doing, if that changed."""
+
+        if status != self.status:
+            self.status = status
+            startup.notify("STATUS=%s" % status)
+
+
+    def _refresh_journal(self):
+        self._confirm(self.publishers.values())
+        return True  # ...keep refreshing.
+
+
+    def _publisher(self, scope):
+        publisher = self.publishers.get(scope)
+
+        if publisher is None:
+            # Avahi publishers follow the names they look up, so checking them again costs nothing...
+            options = {"browse": True, "probe": self.optimistic} if self.bus is not None else {}
+            publisher = self.publishers[scope] = self.backend(self.ttl, resolve_timeout=self.timeout, **options)
+
+        return publisher
+
+
+    def _describe(self, scope):
+        if scope is None:
+            return "CNAMEs"
+
+        index, family = scope
+        return "%s addresses on %s" % ("IPv6" if family == socket.AF_INET6 else "IPv4", interface_name(index))
+
+
+    def _records(self, publisher, scope, names=None):
+        """Build the records to publish for all names (or just "names"), in a single scope."""
+
+        names = self.names if names is None else names
+
+        if scope is None:
+            return [publisher.cname_record(name) for name in names]
+
+        index, _ = scope
+        addresses = sorted(self.watcher.addresses.get(scope, ()))
+
+        return [publisher.address_record(name, address, index) for name in names for address in addresses]
+
+
+    def _desired(self, publisher, names):
+        """Build the records "names" would be published with, in all scopes (by name)."""
+
+        records = {}
+        for scope in self.scopes():
+            for record in self._records(publisher, scope, names):
+                records.setdefault(record.name, []).append(record)
+
+        return records
+
+
+    def _schedule(self, scope, priority):
+        """(Re)publish a single scope soon, along with any other changes to it arriving in the meantime."""
+
+        self.scheduler.schedule(scope, self._run_scope, scope, priority=priority)
+
+
+    def _run_scope(self, scope):
+        """Bring a single scope up to date, from the scheduler (things may have changed since it was asked)."""
+
+        if self.names is None:  # ...everything gets published when Avahi comes back.
+            return
+
+        try:
+            if scope in self.scopes():
+                self._publish_scope(scope)
+
+                # Only now that Avahi has them, they count as ours...
+                self._confirm([self.publishers[scope]])
+            elif scope in self.publishers:
+                publisher = self.publishers.pop(scope)
+                publisher.reset()
+                publisher.close()
+
+            if not len(self.scheduler):
+                self._report("Published %d of %d names" % (len(self.names), len(self.cnames)))
+        except self.backend.errors as e:
+            logging.warning("Unable to publish through Avahi: %s", e.get_dbus_name())
+            self._report("Unable to publish: %s" % e.get_dbus_name())
+
+
+    def _publish_scope(self, scope):
+        """(Re)publish the records for a single scope, leaving all other scopes alone."""
+
+        publisher = self._publisher(scope)
+
+        # Only the differences are applied, changed addresses are updated without withdrawing names...
+        records = self._records(publisher, scope)
+
+        with PUBLISH_LATENCY.time():
+            results = publisher.reconcile(records, force=True)
+
+        for name, status in results.items():
+            if not status:
+                logging.error("Failed to publish '%s'", name)
+                FAILURES.inc()
+
+        # Names rejected by the collision checks were never meant to be published...
+        if publisher.count() == len(self.names):
+            logging.info("All %s published", self._describe(scope))
+        else:
+            logging.warning("%d out of %d %s published", publisher.count(), len(self.names), self._describe(scope))
+
+
+    def _addresses_changed(self, fd, condition):
+        for scope in self.watcher.process():
+            logging.info("Changed: %s", self._describe(scope))
+
+            if self.names is None:  # ...everything gets published when Avahi comes back.
+                continue
+
+            self._schedule(scope, PRIORITY_REFRESH)
+
+        return True  # ...keep watching.
+
+
+    def _avahi_appeared(self):
+        """Publish if Avahi is ready, otherwise wait for it to signal that it is."""
+
+        server = dbus.Interface(self.bus.get_object(avahi.DBUS_NAME, avahi.DBUS_PATH_SERVER),
+                                avahi.DBUS_INTERFACE_SERVER)
+
+        if server.GetState() == avahi.SERVER_RUNNING:
+            self.publish()
+        else:
+            self._report("Waiting for Avahi")
+
+
+    def _owner_changed(self, name, old_owner, new_owner):
+        if old_owner and self.names is not None:
+            # Avahi took our records with it, there's nothing left to clean up...
+            logging.warning("Avahi went away, waiting for it to come back...")
+            self._report("Waiting for Avahi")
+            AVAHI_LOST.inc()
+
+            for publisher in self.publishers.values():
+                publisher.forget()
+                publisher.close()
+
+            self.scheduler.clear()
+
+            self.publishers = {}
+            self.names = None
+            PUBLISHED_NAMES.set(0)
+
+        if new_owner:
+            logging.info("Avahi is available, publishing...")
+            AVAHI_RECONNECTS.inc()
+            self._avahi_appeared()
+
+
+    def _server_state_changed(self, state, error):
+        if state == avahi.SERVER_RUNNING:
+            if self.names is None:
+                self.publish()
+        elif state in (avahi.SERVER_REGISTERING, avahi.SERVER_COLLISION):
+            # The host name is changing, so records pointing to the old one must go...
+            logging.warning("Avahi host name changing, withdrawing names...")
+            self.withdraw()
+            self._report("Waiting for Avahi")
+
+
+    def _group_state_changed(self, state, error, path=None):
+        publisher = next((p for p in self.publishers.values() if p.group_names(path)), None)
+
+        if publisher is None:  # ...not one of ours.
+            return
+
+        names = publisher.group_names(path)
+
+        if state in (avahi.ENTRY_GROUP_COLLISION, avahi.ENTRY_GROUP_FAILURE):
+            # Whatever was known about these names, they can't be taken as ours anymore...
+            self.verified -= names
+
+            if self.journal:
+                self.journal.discard(names)
+                self.journal.flush()
+
+        if state == avahi.ENTRY_GROUP_COLLISION:
+            logging.error("DNS entries collided with another host: %s", ", ".join(sorted(names)))
+            COLLISIONS.inc()
+
+            if self.optimistic:
+                self._collided(publisher, path)
+        elif state == avahi.ENTRY_GROUP_FAILURE:
+            logging.error("Failed to publish %s: %s", ", ".join(sorted(names)), error)
+            FAILURES.inc(len(names))
+        elif state == avahi.ENTRY_GROUP_ESTABLISHED:
+            logging.debug("Established: %s", ", ".join(sorted(names)))
+
+            # Avahi probed for them first, nobody else answered...
+            if self.optimistic:
+                self.verified |= names
+
+
+    def _collided(self, publisher, path):
+        """Withdraw the names that collided (renaming them, if asked to) and put the others back."""
+
+        try:
+            taken = publisher.resolve_collision(path)
+
+            if not taken:
+                logging.warning("No other owner found for the collided names, probing again...")
+                return
+
+            logging.error("Withdrawn: %s", ", ".join(sorted(taken)))
+
+            renamed = []
+
+            for name in taken if self.rename else ():
+                alternative = alternative_name(name)
+
+                while alternative in self.names:
+                    alternative = alternative_name(alternative)
+
+                if alternative is None:
+                    logging.error("Giving up on '%s', no alternative names left", name)
+                else:
+                    logging.info("Retrying '%s' as '%s'", name, alternative)
+                    renamed.append(alternative)
+
+            self.names = [name for name in self.names if name not in taken] + renamed
+            PUBLISHED_NAMES.set(len(self.names))
+
+            if self.journal:
+                self.journal.discard(taken)
+                self.journal.flush()
+
+            if renamed:
+                self._schedule(None, PRIORITY_NEW)
+        except self.backend.errors as e:
+            logging.warning("Unable to publish through Avahi: %s", e.get_dbus_name())
+
+
+def reload_names(fd, condition, watcher, service, static):
+    """Apply changes to the names file to the running service."""
+
+    if watcher.changed():
+        cnames = load_names(static, watcher.path)
+
+        if cnames is not None:
+            service.set_names(cnames)
+
+    return True  # ...keep watching.
+
+
+def dump_metrics(path):
+    """Write all metrics into "path" (replacing it atomically), or log them if there's no path."""
+
+    if not path:
+        logging.info("Metrics:\n%s", metrics.render())
+        return True  # ...keep handling the signal.
+
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+
+    try:
+        with open(temporary, "w") as f:
+            f.write(metrics.render())
+
+        os.rename(temporary, path)
+    except (IOError, OSError) as e:
+        logging.error("Unable to write metrics to %s: %s", path, e.strerror)
+
+    return True  # ...keep handling the signal.
+
+
+def handle_signals(service, signum):
     """Unpublish all mDNS records and exit cleanly."""
 
+    # Withdrawing takes a while, the service manager must know we're on it already...
+    startup.notify("STOPPING=1", "STATUS=Withdrawing names")
+
     signame = next(v for v, k in signal.__dict__.items() if k == signum)
     logging.debug("Cleaning up on %s...", signame)
-    publisher.__del__()
-
-    # Avahi needs time to forget us...
-    sleep(1)
+    start = monotonic()
+    service.withdraw(SHUTDOWN_TIMEOUT)
+    logging.debug("Withdrawn in %.3fs", monotonic() - start)
 
+    logpipe.stop()
     os._exit(0)
 
 
+def ready(service):
+    """Tell the service manager we're up (not that names are published already), with how long that took."""
+
+    startup.report()
+    startup.notify("READY=1", "STATUS=%s" % service.status)
+
+    return False  # ...just once.
+
+
 def main():
-    (ttl, force, verbose, daemon, log, cnames) = parse_args()
+    (ttl, timeout, force, optimistic, rename, addresses, backend, journal_file, metrics_file, verbose, daemon, log,
+     static, names_file) = parse_args()
 
     # Since an eventual log file must support external log rotation, we must do this the hard way...
     format = logging.Formatter("%(asctime)s: %(levelname)s [%(process)d]: %(message)s")
-    handler = logging.handlers.WatchedFileHandler(log) if log else logging.StreamHandler(sys.stderr)
+    handler = logpipe.WatchedFileHandler(log) if log else logging.StreamHandler(sys.stderr)
     handler.setFormatter(format)
-    logger = logging.getLogger()
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+    # Writing happens in the background, publishing never waits for it (and floods are held back)...
+    logpipe.setup(handler, logging.DEBUG if verbose else logging.INFO)
+
+    cnames = (load_names(static, names_file) if names_file else None) or static
+
+    startup.mark("imports")
 
     # This must be done after initializing the logger, so that an eventual log file gets created in
     # the right place (the user will assume that relative paths start from the current directory)...
-    if daemon:
+    if daemon and startup.supervised():
+        logging.info("Running under a service manager, not daemonizing")
+    elif daemon:
         daemonize()
 
     logging.info("Avahi/mDNS publisher starting...")
 
     if force:
         logging.info("Forcing CNAME publishing without collision checks")
+    elif optimistic:
+        logging.info("Publishing CNAMEs right away, leaving collision checks to Avahi")
 
-    # The publisher needs to be initialized in the loop, to handle disconnects...
-    publisher = None
-
-    while True:
-        if not publisher or not publisher.available():
-            publisher = AvahiPublisher(ttl)
-
-            # To make sure records disappear immediately on exit, clean up properly...
-            signal.signal(signal.SIGTERM, functools.partial(handle_signals, publisher))
-            signal.signal(signal.SIGINT, functools.partial(handle_signals, publisher))
-            signal.signal(signal.SIGQUIT, functools.partial(handle_signals, publisher))
-
-            # for iface in ni.interfaces():
-            #     if iface == 'lo':
-            #         logging.debug("Skipping loopback adapter")
-            #         continue
-            #     for address_descs in ni.ifaddresses(iface).values():
-            #        for address_desc in address_descs:
-            #            address = address_desc['addr']
-
-            for cname in cnames:
-                import dbus
-                try:
-                    status = publisher.publish_address(cname, address, force=True)
-                    #status = publisher.publish_cname(cname, force=True)
-                    if not status:
-                        logging.error("Failed to publish '%s'", cname)
-                        continue
-                except dbus.exceptions.DBusException:
-                    logging.warning("Invalid address. Skipping")
-
-            if publisher.count() == len(cnames):
-                logging.info("All CNAMEs published")
-            else:
-                logging.warning("%d out of %d CNAMEs published", publisher.count(), len(cnames))
+    if backend == "mdns":
+        from mdns import MDNSPublisher
+
+        logging.info("Answering mDNS queries directly, without Avahi")
+        service = PublishService(cnames, ttl, timeout, force, addresses, MDNSPublisher)
+    else:
+        service = PublishService(cnames, ttl, timeout, force, addresses, optimistic=optimistic, rename=rename)
+
+    if journal_file:
+        from journal import OwnershipJournal
+
+        service.journal = OwnershipJournal(journal_file)
+
+    # To make sure records disappear immediately on exit, clean up properly...
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signum, handle_signals, service, signum)
+
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, dump_metrics, metrics_file)
+
+    if names_file:
+        from fswatch import FileWatcher
+
+        watcher = FileWatcher(names_file)
+        GLib.io_add_watch(watcher.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, reload_names, watcher, service, static)
+
+    service.start()
+    startup.mark("publishing")
 
-        # CNAMEs will exist while this service is kept alive,
-        # but we don't actually need to do anything useful...
-        sleep(1)
+    # Ready once the main loop is running (and answering D-Bus signals)...
+    GLib.idle_add(ready, service)
+    GLib.MainLoop().run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# scheduler.py - Hold back (re)publishing for a moment, so bursts of changes reach Avahi as a trickle.
+#
+
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from gi.repository import GLib
+
+import metrics
+
+
+# Priorities, most urgent first...
+PRIORITY_NEW = 0
+PRIORITY_REFRESH = 1
+
+# Quiet time after the last request for a job before it runs, and longest it can be held back (seconds)...
+DEFAULT_DELAY = 0.25
+DEFAULT_MAX_DELAY = 2.0
+
+# Jobs started per second, at most (whole jobs, not the D-Bus calls each one makes)...
+DEFAULT_RATE = 20.0
+
+SCHEDULER_PENDING = metrics.gauge("publish_scheduler_pending", "Jobs waiting to run.")
+SCHEDULER_COALESCED = metrics.counter("publish_scheduler_coalesced_total", "Requests merged into a job already waiting.")
+SCHEDULER_WAIT = metrics.histogram("publish_scheduler_wait_seconds", "Time jobs waited, from the first request to running.",
+                                   ["priority"])
+
+_PRIORITY_NAMES = {PRIORITY_NEW: "new", PRIORITY_REFRESH: "refresh"}
+
+
+class _Job(object):
+    __slots__ = ("priority", "first", "last", "function", "args")
+
+    def __init__(self, priority, now, function, args):
+        self.priority = priority
+        self.first = now
+        self.last = now
+        self.function = function
+        self.args = args
+
+
+    def due(self, delay, max_delay):
+        return min(self.last + delay, self.first + max_delay)
+
+
+class PublishScheduler(object):
+    """Run jobs from the GLib main loop, merging repeated requests and spacing them out.
+
+    Requesting a job (by key) that's already waiting just postpones it, until "delay" seconds pass
+    without new requests (or "max_delay" seconds since the first one, so flapping can't hold it back
+    forever). Jobs that are due run in priority order, then oldest first, at most "rate" per second.
+
+    Only whole jobs are paced. A job runs to completion once started, so all the D-Bus calls it makes
+    (eg. one "AddRecord" per record in a scope, plus a "Reset" and "Commit" per entry group) still go
+    out in a single burst. Individual calls aren't spaced out, the burst is only as large as the job:
+    lowering "rate" spreads jobs further apart, and the publisher's "group_size" bounds each group.
+    """
+
+    def __init__(self, delay=DEFAULT_DELAY, max_delay=DEFAULT_MAX_DELAY, rate=DEFAULT_RATE):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.interval = 1.0 / rate if rate else 0.0
+
+        self._jobs = {}
+        self._next_start = 0.0
+        self._timer = None
+        self._lock = threading.RLock()
+
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+    def schedule(self, key, function, *args, **kwargs):
+        """Run "function(*args)" soon, replacing whatever was waiting under "key" (keeping the most urgent priority)."""
+
+        priority = kwargs.get("priority", PRIORITY_REFRESH)
+        now = time.monotonic()
+
+        with self._lock:
+            job = self._jobs.get(key)
+
+            if job is None:
+                self._jobs[key] = _Job(priority, now, function, args)
+            else:
+                job.priority = min(job.priority, priority)
+                job.last = now
+                job.function = function
+                job.args = args
+                SCHEDULER_COALESCED.inc()
+
+            SCHEDULER_PENDING.set(len(self._jobs))
+            self._arm()
+
+
+    def cancel(self, key):
+        with self._lock:
+            self._jobs.pop(key, None)
+            SCHEDULER_PENDING.set(len(self._jobs))
+
+
+    def clear(self):
+        """Forget all waiting jobs (eg. when there's nothing to publish to anymore)."""
+
+        with self._lock:
+            self._jobs = {}
+            SCHEDULER_PENDING.set(0)
+
+
+    def flush(self):
+        """Run all waiting jobs right away, most urgent first."""
+
+        with self._lock:
+            while self._jobs:
+                self._run(min(self._jobs, key=self._order))
+
+
+    def _order(self, key):
+        job = self._jobs[key]
+        return (job.priority, job.first)
+
+
+    def _arm(self):
+        """Make sure the timer fires when the next job is due (or the rate limit allows it)."""
+
+        if not self._jobs:
+            return
+
+        due = min(job.due(self.delay, self.max_delay) for job in self._jobs.values())
+        wait = max(0.0, due - time.monotonic(), self._next_start - time.monotonic())
+
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+
+        self._timer = GLib.timeout_add(int(wait * 1000), self._fire)
+
+
+    def _fire(self):
+        with self._lock:
+            self._timer = None
+            now = time.monotonic()
+
+            if now >= self._next_start:
+                ready = [key for key, job in self._jobs.items() if job.due(self.delay, self.max_delay) <= now]
+
+                if ready:
+                    self._run(min(ready, key=self._order))
+                    self._next_start = time.monotonic() + self.interval
+
+            self._arm()
+
+        return False  # ...rearmed above, if there's anything left.
+
+
+    def _run(self, key):
+        job = self._jobs.pop(key)
+        SCHEDULER_PENDING.set(len(self._jobs))
+        SCHEDULER_WAIT.labels(_PRIORITY_NAMES.get(job.priority, str(job.priority))).observe(time.monotonic() - job.first)
+
+        try:
+            job.function(*job.args)
+        except Exception:
+            logging.exception("Scheduled job failed: %s", key)
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# startup.py - Start quickly, and cooperate with the service manager while doing it.
+#
+# Listening sockets can be passed in already bound (systemd-style socket activation), so connections
+# wait in the kernel while a service (re)starts instead of being refused. Readiness is reported back
+# (as with "sd_notify()"), and the time taken by each phase of starting up can be logged.
+#
+
+
+from __future__ import print_function
+from __future__ import division
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os
+import logging
+import socket
+import time
+
+
+# Imported first thing, this is (almost) when the program started...
+_started = time.monotonic()
+_phases = []
+
+# The first file descriptor passed by the service manager (see "sd_listen_fds(3)")...
+SD_LISTEN_FDS_START = 3
+
+
+def listen_fds(unset_environment=True):
+    """Return the sockets passed by the service manager (through "LISTEN_FDS"), if any were meant for us."""
+
+    try:
+        pid = int(os.environ.get("LISTEN_PID", ""))
+        count = int(os.environ.get("LISTEN_FDS", ""))
+    except ValueError:
+        return []
+    finally:
+        if unset_environment:  # ...so child processes don't take them as theirs.
+            for variable in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+                os.environ.pop(variable, None)
+
+    if pid != os.getpid():
+        return []
+
+    sockets = []
+
+    for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count):
+        sock = socket.socket(fileno=fd)  # ...family and type come from the socket itself.
+        sock.set_inheritable(False)
+        sockets.append(sock)
+
+    return sockets
+
+
+def supervised():
+    """Check whether the service manager expects to be notified (and no need to daemonize)."""
+
+    return bool(os.environ.get("NOTIFY_SOCKET"))
+
+
+def notify(*states):
+    """Send state changes (eg. "READY=1") to the service manager, returning whether there was one to send them to."""
+
+    path = os.environ.get("NOTIFY_SOCKET")
+
+    if not path:
+        return False
+
+    if path.startswith("@"):  # ...an abstract socket.
+        path = "\0" + path[1:]
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    try:
+        sock.connect(path)
+        sock.sendall("\n".join(states).encode("utf-8"))
+    except (IOError, OSError) as e:
+        logging.warning("Unable to notify the service manager: %s", e.strerror)
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+
+def mark(phase):
+    """Note that "phase" of starting up just finished (see "report()")."""
+
+    _phases.append((phase, time.monotonic()))
+
+
+def report():
+    """Log how long starting up took, phase by phase, returning the total (in seconds)."""
+
+    previous = _started
+    timings = []
+
+    for phase, finished in _phases:
+        timings.append("%s %.1fms" % (phase, (finished - previous) * 1000))
+        previous = finished
+
+    total = previous - _started
+    logging.info("Started in %.1fms (%s)", total * 1000, ", ".join(timings))
+
+    return total
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+#
+# conftest.py - Run the tests against the fake D-Bus and GLib modules used by the benchmarks.
+#
+
+
+import sys
+import os, os.path
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "benchmarks", "fakes"), ROOT]
+
+
+@pytest.fixture
+def avahi():
+    """The fake Avahi daemon, running and empty (and left that way afterwards)."""
+
+    import dbus
+
+    def reset():
+        dbus.FakeAvahi.groups.clear()
+        dbus.FakeAvahi.browsers.clear()
+        del dbus.FakeAvahi.receivers[:]
+        dbus.OWNERS.clear()
+        dbus.RUNNING = True
+
+    reset()
+    yield dbus.FakeAvahi
+    reset()
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# test_access.py - Allow/deny rules for the gatekeeper's clients, and reloading them.
+#
+
+
+import asyncio
+
+import pytest
+
+from gatekeeper import AccessRules, ConfigStore, NO_ACCESS
+
+
+def test_most_specific_rule_decides():
+    rules = AccessRules([(False, "10.0.0.0/8"), (True, "10.1.0.0/16"), (False, "10.1.2.0/24")])
+
+    assert not rules.allowed("10.2.0.1")
+    assert rules.allowed("10.1.3.4")
+    assert not rules.allowed("10.1.2.3")
+    assert not rules.allowed("192.168.0.1")  # ...outside the only allowed network.
+
+
+def test_allow_rules_deny_everything_else():
+    rules = AccessRules([(True, "192.168.0.0/16")])
+
+    assert rules.allowed("192.168.1.1")
+    assert not rules.allowed("8.8.8.8")
+    assert not rules.allowed("fd00::1")
+
+
+def test_ipv4_mapped_addresses_follow_ipv4_rules():
+    rules = AccessRules([(True, "::/0"), (False, "10.0.0.0/8")])
+
+    assert not rules.allowed("::ffff:10.0.0.1")
+    assert not rules.allowed("::ffff:192.168.0.1")  # ...only IPv6 networks are allowed.
+    assert rules.allowed("fd00::1%eth0")
+
+
+def test_rules_for_whole_address_families():
+    rules = AccessRules([(False, "0.0.0.0/0"), (True, "10.0.0.0/8")])
+
+    assert not rules.allowed("8.8.8.8")
+    assert rules.allowed("10.1.1.1")
+    assert not rules.allowed("fd00::1")
+
+    assert AccessRules([(False, "0.0.0.0/0")]).allowed("fd00::1")
+    assert not NO_ACCESS.allowed("8.8.8.8") and not NO_ACCESS.allowed("::1")
+
+
+@pytest.mark.parametrize("line", ["allow 10.0.0.0/33", "deny example.com", "allow 10.0.0.0/8 10.1.0.0/16", "deny"])
+def test_malformed_rules_are_refused(line):
+    with pytest.raises(ValueError):
+        AccessRules.parse(line)
+
+
+def test_malformed_rules_keep_the_previous_ones(tmp_path):
+    path = tmp_path / "gatekeeper.conf"
+
+    async def load(*contents):
+        store = ConfigStore(str(path))
+
+        for content in contents:
+            path.write_text(content)
+            await store.reload()
+
+        return store.snapshot
+
+    snapshot = asyncio.run(load("10.0.0.1\nallow 10.0.0.0/8\n", "10.0.0.2\nallow 10.0.0.0/8\ndeny 10.0.0.0/33\n"))
+
+    assert snapshot.ip == "10.0.0.2"
+    assert snapshot.access.allowed("10.1.1.1") and not snapshot.access.allowed("192.168.0.1")
+
+    # ...and without previous ones, nobody gets in.
+    snapshot = asyncio.run(load("10.0.0.1\nallow 10.0.0.0/8 192.168.0.0/16\n"))
+
+    assert snapshot.access is NO_ACCESS
+
+
+# vim: set expandtab ts=4 sw=4:
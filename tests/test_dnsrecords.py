@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+#
+# test_dnsrecords.py - Building records in DNS wire format.
+#
+
+
+from dnsrecords import txt_to_rdata
+
+
+def test_txt_values_comparing_equal_are_not_mixed_up():
+    assert txt_to_rdata({"v": 1}) == b"\x03v=1"
+    assert txt_to_rdata({"v": True}) == b"\x06v=True"
+    assert txt_to_rdata({"v": 1.0}) == b"\x05v=1.0"
+
+
+def test_txt_from_strings_or_nothing():
+    assert txt_to_rdata(["a=b", b"c"]) == b"\x03a=b\x01c"
+    assert txt_to_rdata({"k": ["unhashable"]}) == b"\x10k=['unhashable']"
+    assert txt_to_rdata([]) == b"\0"
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+# test_mdns.py - The built-in mDNS responder, answering queries over loopback (no Avahi or D-Bus needed).
+#
+
+
+import sys
+import os, os.path
+import asyncio
+import socket
+import subprocess
+
+import pytest
+
+from dnsrecords import (Record, fqdn_to_rdata, AVAHI_DNS_CLASS_IN, AVAHI_DNS_TYPE_A, AVAHI_DNS_TYPE_AAAA,
+                        AVAHI_DNS_TYPE_CNAME)
+from mdns import MDNSResponder, HEADER, QUESTION, encode_rr, parse_packet
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def query(*questions, known=()):
+    """Build a query packet for (name, type) "questions", listing "known" answers (already encoded)."""
+
+    return (HEADER.pack(1234, 0, len(questions), len(known), 0, 0) +
+            b"".join(fqdn_to_rdata(name) + QUESTION.pack(qtype, AVAHI_DNS_CLASS_IN) for name, qtype in questions) +
+            b"".join(known))
+
+
+@pytest.fixture
+def responder():
+    """A responder serving "name01.local" (and "name02.local") on loopback, from a fresh event loop."""
+
+    loop = asyncio.new_event_loop()
+    responder = MDNSResponder(loop, port=free_port(), interfaces=[socket.if_nametoindex("lo")])
+    responder.open()
+
+    records = [Record(name, AVAHI_DNS_TYPE_CNAME, fqdn_to_rdata("host.local"), 120)
+               for name in ("name01.local", "name02.local")]
+    responder.add(records)
+
+    yield loop, responder, records
+
+    responder.close()
+    loop.close()
+
+
+def ask(loop, responder, packet, timeout=1.0):
+    """Send "packet" to the responder from another socket (a legacy querier), returning the parsed reply."""
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(("127.0.0.1", 0))
+    client.setblocking(False)
+
+    async def exchange():
+        client.sendto(packet, ("127.0.0.1", responder.port))
+
+        try:
+            return await asyncio.wait_for(loop.sock_recv(client, 9000), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    try:
+        reply = loop.run_until_complete(exchange())
+    finally:
+        client.close()
+
+    return reply and parse_packet(reply)
+
+
+def test_answers_over_loopback(responder):
+    loop, responder, records = responder
+
+    ident, flags, questions, answers = ask(loop, responder, query(("name01.local", AVAHI_DNS_TYPE_A)))
+
+    assert ident == 1234
+    assert questions == [("name01.local", AVAHI_DNS_TYPE_A, AVAHI_DNS_CLASS_IN)]
+    assert [(name, rtype, rdata) for name, rtype, rdata, _ in answers] == [("name01.local", AVAHI_DNS_TYPE_CNAME,
+                                                                           fqdn_to_rdata("host.local"))]
+
+
+def test_aggregates_answers(responder):
+    loop, responder, records = responder
+
+    _, _, _, answers = ask(loop, responder, query(("name01.local", AVAHI_DNS_TYPE_A), ("name02.local", AVAHI_DNS_TYPE_A),
+                                                  ("unknown.local", AVAHI_DNS_TYPE_A)))
+
+    assert sorted(name for name, _, _, _ in answers) == ["name01.local", "name02.local"]
+
+
+def test_suppresses_known_answers(responder):
+    loop, responder, records = responder
+
+    known = encode_rr(records[0], 120, cache_flush=False)
+    reply = ask(loop, responder, query(("name01.local", AVAHI_DNS_TYPE_A), known=[known]), timeout=0.2)
+
+    assert reply is None
+
+
+def test_cnames_resolve_to_the_host_addresses(responder):
+    """With no Avahi around, the responder must answer for the host name the CNAMEs point to."""
+
+    loop, responder, records = responder
+    responder.set_host("host.local", {(socket.if_nametoindex("lo"), socket.AF_INET): {"127.0.0.1"}})
+
+    _, _, _, answers = ask(loop, responder, query(("name01.local", AVAHI_DNS_TYPE_A)))
+    chain = dict((name, (rtype, rdata)) for name, rtype, rdata, _ in answers)
+
+    assert chain["name01.local"] == (AVAHI_DNS_TYPE_CNAME, fqdn_to_rdata("host.local"))
+    assert chain["host.local"] == (AVAHI_DNS_TYPE_A, socket.inet_aton("127.0.0.1"))
+
+    # ...no IPv6 address to go with it, but the CNAME still comes back.
+    _, _, _, answers = ask(loop, responder, query(("name01.local", AVAHI_DNS_TYPE_AAAA)))
+    assert [name for name, _, _, _ in answers] == ["name01.local"]
+
+    # The host name is answered for on its own too, and goes away with its addresses.
+    _, _, _, answers = ask(loop, responder, query(("host.local", AVAHI_DNS_TYPE_A)))
+    assert [(name, rtype) for name, rtype, _, _ in answers] == [("host.local", AVAHI_DNS_TYPE_A)]
+
+    responder.set_host("host.local", {})
+    assert not responder.owns("host.local")
+
+
+def test_publish_cname_runs_without_dbus(tmp_path):
+    """The built-in responder is what's left when dbus-python isn't installed."""
+
+    (tmp_path / "gi").symlink_to(os.path.join(ROOT, "benchmarks", "fakes", "gi"))
+
+    code = ("import importlib.util, sys\n"
+            "spec = importlib.util.spec_from_file_location('publish_cname', %r)\n"
+            "module = importlib.util.module_from_spec(spec)\n"
+            "spec.loader.exec_module(module)\n"
+            "from mdns import MDNSPublisher\n"
+            "module.PublishService(['name01.local'], 60, 1.0, True, backend=MDNSPublisher)\n"
+            "assert 'dbus' not in sys.modules\n") % os.path.join(ROOT, "publish-cname.py")
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(tmp_path), ROOT]))
+    subprocess.run([sys.executable, "-c", code], env=env, check=True, timeout=30)
+
+
+# vim: set expandtab ts=4 sw=4:
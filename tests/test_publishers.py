@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# test_publishers.py - Publishing batches of names through Avahi, when some of their records fail.
+#
+
+
+import asyncio
+
+import dbus
+import pytest
+
+from dnsrecords import AVAHI_DNS_TYPE_AAAA
+from mpublisher import AvahiPublisher
+from aiopublisher import AsyncAvahiPublisher
+
+
+@pytest.fixture
+def failing_aaaa(monkeypatch):
+    """Have Avahi refuse AAAA records for "b.local" (its A record, added first, goes through)."""
+
+    add_record = dbus._EntryGroup.AddRecord
+
+    def refuse(self, interface, protocol, flags, name, rclass, rtype, ttl, rdata):
+        if name in ("b.local", b"b.local") and rtype == AVAHI_DNS_TYPE_AAAA:
+            raise dbus.exceptions.DBusException("Invalid record", name="org.freedesktop.Avahi.InvalidRecordError")
+
+        return add_record(self, interface, protocol, flags, name, rclass, rtype, ttl, rdata)
+
+    monkeypatch.setattr(dbus._EntryGroup, "AddRecord", refuse)
+
+
+def make_records(publisher):
+    return [publisher.cname_record("a.local"),
+            publisher.address_record("b.local", "10.0.0.2"), publisher.address_record("b.local", "fd00::2"),
+            publisher.cname_record("c.local")]
+
+
+def published_names(avahi):
+    return set(key[2].decode("ascii") if isinstance(key[2], bytes) else key[2]
+               for group in avahi.groups.values() for key in group.records)
+
+
+def test_publish_many_reports_names_failing_part_way(avahi, failing_aaaa):
+    publisher = AvahiPublisher()
+
+    assert publisher.publish_many(make_records(publisher), force=True) == {"a.local": True, "b.local": False,
+                                                                           "c.local": True}
+    assert "b.local" not in publisher.published
+    assert published_names(avahi) == {"a.local", "c.local"}
+
+    # Rebuilding the group must not bring it back either...
+    publisher.unpublish("a.local")
+
+    assert published_names(avahi) == {"c.local"}
+
+
+def test_async_publish_many_reports_names_failing_part_way(avahi, failing_aaaa):
+    async def publish():
+        publisher = await AsyncAvahiPublisher.create()
+        results = await publisher.publish_many(make_records(publisher), force=True)
+        return publisher, results
+
+    publisher, results = asyncio.run(publish())
+
+    assert results == {"a.local": True, "b.local": False, "c.local": True}
+    assert "b.local" not in publisher.published
+    assert published_names(avahi) == {"a.local", "c.local"}
+
+
+def test_republishing_keeps_the_previous_records_on_failure(avahi, failing_aaaa, monkeypatch):
+    import gatekeeper
+
+    monkeypatch.setattr(gatekeeper, "broadcaster", gatekeeper.Broadcaster(), raising=False)
+
+    async def republish():
+        publisher = await AsyncAvahiPublisher.create()
+        batcher = gatekeeper.RecordBatcher(publisher)
+
+        first = batcher.publish([publisher.address_record("b.local", "10.0.0.2")], force=True)
+        assert await first["b.local"]
+
+        # Its A record is replaced in place, but the AAAA record can't be added...
+        second = batcher.publish([publisher.address_record("b.local", "10.0.0.3"),
+                                  publisher.address_record("b.local", "fd00::3")], force=True)
+
+        return publisher, await second["b.local"]
+
+    publisher, result = asyncio.run(republish())
+
+    assert result is False
+    assert publisher.records()["b.local"] == [publisher.address_record("b.local", "10.0.0.2")]
+    assert list(avahi.groups[publisher.published["b.local"].object_path].records.values()) == [b"\x0a\x00\x00\x02"]
+
+
+def test_republishing_checks_names_unless_forced(avahi, monkeypatch):
+    import gatekeeper
+
+    monkeypatch.setattr(gatekeeper, "broadcaster", gatekeeper.Broadcaster(), raising=False)
+
+    async def republish():
+        publisher = await AsyncAvahiPublisher.create()
+        batcher = gatekeeper.RecordBatcher(publisher)
+
+        assert await batcher.publish([publisher.address_record("b.local", "10.0.0.2")], force=True)["b.local"]
+
+        # Someone else answers for it now...
+        dbus.OWNERS["b.local"] = "10.9.9.9"
+        checked = await batcher.publish([publisher.address_record("b.local", "10.0.0.3")])["b.local"]
+        kept = publisher.records()["b.local"]
+
+        forced = await batcher.publish([publisher.address_record("b.local", "10.0.0.4")], force=True)["b.local"]
+        return publisher, checked, kept, forced
+
+    publisher, checked, kept, forced = asyncio.run(republish())
+
+    assert checked is False
+    assert kept == [publisher.address_record("b.local", "10.0.0.2")]
+    assert forced is True
+    assert publisher.records()["b.local"] == [publisher.address_record("b.local", "10.0.0.4")]
+
+
+@pytest.fixture
+def resolving(avahi, monkeypatch):
+    """Record the names published in established groups after each reset or freed group."""
+
+    snapshots = []
+
+    def watch(method):
+        original = getattr(dbus._EntryGroup, method)
+
+        def call(self):
+            original(self)
+            snapshots.append(set(key[2].decode("ascii") if isinstance(key[2], bytes) else key[2]
+                                 for group in avahi.groups.values() if group.state == dbus._ENTRY_GROUP_ESTABLISHED
+                                 for key in group.records))
+
+        monkeypatch.setattr(dbus._EntryGroup, method, call)
+
+    watch("Reset")
+    watch("Free")
+    return snapshots
+
+
+def test_other_names_stay_published_when_one_is_removed(resolving):
+    publisher = AvahiPublisher()
+    publisher.publish_many([publisher.cname_record(name) for name in ("a.local", "b.local", "c.local")], force=True)
+
+    publisher.unpublish("a.local")
+
+    assert resolving and all({"b.local", "c.local"} <= names for names in resolving)
+    assert resolving[-1] == {"b.local", "c.local"}
+
+
+def test_other_names_stay_published_when_one_is_rebuilt(resolving):
+    async def reconcile():
+        publisher = await AsyncAvahiPublisher.create()
+        await publisher.publish_many([publisher.cname_record("a.local"), publisher.cname_record("c.local")], force=True)
+
+        # A CNAME turning into an address can't be updated in place...
+        await publisher.reconcile([publisher.address_record("a.local", "10.0.0.1"), publisher.cname_record("c.local")])
+
+    asyncio.run(reconcile())
+
+    assert resolving and all("c.local" in names for names in resolving)
+    assert resolving[-1] == {"a.local", "c.local"}
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+#
+# test_records.py - Records for the gatekeeper's "/records" API, from their JSON form.
+#
+
+
+import asyncio
+import sys
+import types
+
+import pytest
+
+import gatekeeper
+
+from dnsrecords import BasePublisher, AVAHI_DNS_TYPE_A, AVAHI_DNS_TYPE_AAAA, AVAHI_DNS_TYPE_TXT
+
+
+@pytest.fixture(autouse=True)
+def publisher(monkeypatch):
+    publisher = BasePublisher()
+    publisher.hostname = "host.local"
+    monkeypatch.setattr(gatekeeper, "recordBatcher", types.SimpleNamespace(publisher=publisher))
+
+
+def test_address_families_must_match_the_type():
+    assert gatekeeper.record_from_json({"name": "a.local", "type": "a", "address": "10.0.0.1"}).type == AVAHI_DNS_TYPE_A
+    assert gatekeeper.record_from_json({"name": "a.local", "type": "aaaa", "address": "fd00::1"}).type == AVAHI_DNS_TYPE_AAAA
+    assert gatekeeper.record_from_json({"name": "a.local", "type": "address", "address": "fd00::1"}).type == AVAHI_DNS_TYPE_AAAA
+
+    with pytest.raises(ValueError):
+        gatekeeper.record_from_json({"name": "a.local", "type": "a", "address": "fd00::1"})
+
+    with pytest.raises(ValueError):
+        gatekeeper.record_from_json({"name": "a.local", "type": "aaaa", "address": "10.0.0.1"})
+
+
+@pytest.mark.parametrize("txt", [["a=b", "c"], {"a": "b", "n": 1}, []])
+def test_txt_data_from_lists_or_objects(txt):
+    assert gatekeeper.record_from_json({"name": "t.local", "type": "txt", "txt": txt}).type == AVAHI_DNS_TYPE_TXT
+
+
+@pytest.mark.parametrize("txt", ["hello", 42, ["a", 1], {"a": ["b"]}])
+def test_txt_data_of_other_shapes_is_refused(txt):
+    with pytest.raises(ValueError):
+        gatekeeper.record_from_json({"name": "t.local", "type": "txt", "txt": txt})
+
+
+@pytest.mark.parametrize("workers, enabled", [("1", True), ("2", False)])
+def test_records_need_a_single_worker(monkeypatch, workers, enabled):
+    monkeypatch.setattr(gatekeeper, "recordsEnabled", True)
+    monkeypatch.setattr(gatekeeper, "setup_logging", lambda verbose, sample: None)
+    monkeypatch.setattr(gatekeeper, "run_workers", lambda count, sock=None: None)
+    monkeypatch.setattr(sys, "argv", ["gatekeeper.py", "-w", workers])
+
+    gatekeeper.main()
+    assert gatekeeper.recordsEnabled == enabled
+
+    if not enabled:
+        with pytest.raises(gatekeeper.web.HTTPServiceUnavailable):
+            asyncio.run(gatekeeper.get_record_batcher())
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# test_service.py - What "publish-cname.py" records in its ownership journal, and tells the service manager.
+#
+
+
+import importlib.util
+import os.path
+import time
+
+import pytest
+
+from conftest import ROOT
+from dnsrecords import BasePublisher
+from journal import OwnershipJournal
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location("publish_cname", os.path.join(ROOT, "publish-cname.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+@pytest.fixture
+def service(avahi, tmp_path):
+    """Build a (started) service publishing some names, one of them already taken by another host."""
+
+    import dbus
+
+    dbus.OWNERS["taken.local"] = "10.0.0.1"
+    script = load_script()
+
+    def make(force=False, flush=True):
+        service = script.PublishService(["free.local", "taken.local"], 60, 1.0, force)
+        service.journal = OwnershipJournal(str(tmp_path / "journal"))
+
+        service.start()
+
+        if flush:
+            service.scheduler.flush()
+
+        return service
+
+    make.avahi = lambda: script.avahi
+    return make
+
+
+def test_only_checked_names_are_journaled(service):
+    assert set(service().journal.entries) == {"free.local"}
+
+
+def test_names_are_journaled_once_published(service):
+    published = service(flush=False)
+    assert published.journal.entries == {}
+
+    published.scheduler.flush()
+    assert set(published.journal.entries) == {"free.local"}
+
+
+def test_pending_names_are_not_journaled_on_withdraw(service):
+    published = service(flush=False)
+    published.withdraw()
+
+    assert published.journal.entries == {}
+
+
+def test_forced_names_are_never_journaled(service):
+    assert service(force=True).journal.entries == {}
+
+
+def test_failed_names_leave_the_journal(service):
+    published = service()
+    group = published.publishers[None].published["free.local"]
+
+    published._group_state_changed(service.avahi().ENTRY_GROUP_FAILURE, "failed", path=group.object_path)
+    assert published.journal.entries == {}
+
+    # ...and don't come back with the next refresh.
+    published._refresh_journal()
+    assert published.journal.entries == {}
+
+
+def test_journaled_names_are_fresh_with_the_same_records(service):
+    published = service()
+    checker = published.publishers[None]
+
+    journal = OwnershipJournal(published.journal.path)
+    names = ["free.local", "taken.local"]
+
+    assert journal.fresh(names, checker.hostname, published._desired(checker, names)) == {"free.local"}
+
+
+def test_names_with_other_records_are_not_fresh(tmp_path):
+    publisher = BasePublisher()
+    path = str(tmp_path / "journal")
+
+    def addresses(*addresses):
+        return {"a.local": [publisher.address_record("a.local", address) for address in addresses]}
+
+    journal = OwnershipJournal(path)
+    journal.confirm(["a.local"], "host.local", addresses("10.0.0.1", "fd00::1"))
+    journal.flush()
+
+    journal = OwnershipJournal(path)
+    assert journal.fresh(["a.local"], "host.local", addresses("fd00::1", "10.0.0.1")) == {"a.local"}
+    assert journal.fresh(["a.local"], "host.local", addresses("10.0.0.2", "fd00::1")) == set()
+    assert journal.fresh(["a.local"], "host.local", addresses("10.0.0.1")) == set()
+
+    # ...and entries without records (from before they were kept) aren't trusted either.
+    with open(path, "w") as f:
+        f.write("a.local host.local %d\n" % time.time())
+
+    assert OwnershipJournal(path).fresh(["a.local"], "host.local", addresses("10.0.0.1", "fd00::1")) == set()
+
+
+def test_status_follows_avahi(avahi, service):
+    avahi.stop()
+    published = service(flush=False)
+    assert published.status == "Waiting for Avahi"
+
+    avahi.start()
+    assert published.status == "Publishing 1 names"
+
+    published.scheduler.flush()
+    assert published.status == "Published 1 of 2 names"
+
+
+# vim: set expandtab ts=4 sw=4:
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+#
+# test_startup.py - Starting the gatekeeper with sockets passed by the service manager.
+#
+
+
+import os, os.path
+import socket
+import subprocess
+import sys
+
+from conftest import ROOT
+
+
+def test_gatekeeper_refuses_non_tcp_sockets(tmp_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(str(tmp_path / "gatekeeper.sock"))
+    sock.listen()
+
+    # Passed sockets start at descriptor 3, and the shell's PID is the gatekeeper's once it execs...
+    command = ["sh", "-c", 'LISTEN_PID=$$ exec "$0" "$@"', sys.executable, os.path.join(ROOT, "gatekeeper.py")]
+
+    process = subprocess.run(command, cwd=str(tmp_path), env=dict(os.environ, LISTEN_FDS="1"),
+                             preexec_fn=lambda: os.dup2(sock.fileno(), 3), pass_fds=[3],
+                             stderr=subprocess.PIPE, timeout=30)
+
+    assert process.returncode == 1
+    assert b"TCP socket" in process.stderr
+
+
+# vim: set expandtab ts=4 sw=4: